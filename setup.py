@@ -15,6 +15,7 @@ webapp_requires = [
     'redis >= 2.10.5',
     'pwgen == 0.4',
     'vccs_client >= 0.4.5',
+    'urllib3 >= 1.15',
     'PyNaCl >= 1.0.1',
     'python-etcd >= 0.4.5',
     'PyYAML >= 3.11',
@@ -31,6 +32,7 @@ idp_requires = [
     'pysaml2 >= 4.6.1',
     'redis >= 2.10.5',
     'vccs_client >= 0.4.2',
+    'urllib3 >= 1.15',
     'PyNaCl >= 1.0.1',
     'statsd==3.2.1',
 ]
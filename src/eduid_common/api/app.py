@@ -36,14 +36,19 @@ it with all attributes common to all eduID services.
 
 from werkzeug.contrib.fixers import ProxyFix
 
-from eduid_userdb import UserDB
 from eduid_common.authn.middleware import AuthnApp
 from eduid_common.authn.utils import no_authn_views
+from eduid_common.authn.eduid_saml2 import warm_up_saml2_client
+from eduid_common.authn.vccs_pool import configure_vccs_clients
+from eduid_common.authn.vccs_guard import configure_vccs_guard
+from eduid_common.authn.vccs import configure_password_checks
+from eduid_common.authn.vccs_hashing import configure_factor_pool
 from eduid_common.api.request import Request
-from eduid_common.api.session import SessionFactory
+from eduid_common.api.session import SessionFactory, end_redis_io_tracking
 from eduid_common.api.logging import init_logging
-from eduid_common.api.utils import init_template_functions
-from eduid_common.api.exceptions import init_exception_handlers, init_sentry
+from eduid_common.api.utils import init_template_functions, UserCache
+from eduid_common.api.userdb import CentralUserDB
+from eduid_common.api.exceptions import init_exception_handlers, init_sentry, BadConfiguration
 from eduid_common.api.middleware import PrefixMiddleware
 from eduid_common.config.parsers.etcd import EtcdConfigParser
 from eduid_common.stats import NoOpStats, Statsd
@@ -114,6 +119,7 @@ def eduid_init_app_no_db(name, config, app_class=AuthnApp):
     app = init_sentry(app)
     app = init_template_functions(app)
     app.session_interface = SessionFactory(app.config)
+    app.teardown_request(end_redis_io_tracking)
 
     stats_host = app.config.get('STATS_HOST', False)
     if not stats_host:
@@ -122,12 +128,43 @@ def eduid_init_app_no_db(name, config, app_class=AuthnApp):
         stats_port = app.config.get('STATS_PORT', 8125)
         app.stats = Statsd(host=stats_host, port=stats_port, prefix=name)
 
+    # The VCCS settings below are process wide, the last app initialized sets them. Apps
+    # with the same settings share the clients, pools and circuit breaker state.
+    # Timeouts and connection pool size of the VCCS clients
+    configure_vccs_clients(connect_timeout=app.config.get('VCCS_CONNECT_TIMEOUT'),
+                           read_timeout=app.config.get('VCCS_READ_TIMEOUT'),
+                           pool_size=app.config.get('VCCS_POOL_SIZE'))
+    # Timing, concurrency limit and circuit breaker of the VCCS calls
+    configure_vccs_guard(stats=app.stats,
+                         max_concurrent=app.config.get('VCCS_MAX_CONCURRENT'),
+                         failure_threshold=app.config.get('VCCS_BREAKER_FAILURES'),
+                         reset_timeout=app.config.get('VCCS_BREAKER_RESET_TIMEOUT'))
+    configure_password_checks(app.config.get('VCCS_CHECK_THREADS', 0))
+    # Processes computing the password factors, off the request threads
+    configure_factor_pool(app.config.get('VCCS_FACTOR_PROCESSES', 0),
+                          queue_size=app.config.get('VCCS_FACTOR_QUEUE_SIZE'),
+                          timeout=app.config.get('VCCS_FACTOR_TIMEOUT', 10),
+                          stats=app.stats)
+
+    # Do the expensive SAML2 setup now rather than on the first login
+    try:
+        warm_up_saml2_client(app.config)
+    except BadConfiguration:
+        # The crypto backend self-test failed
+        raise
+    except Exception:
+        app.logger.exception('Failed to initialize the SAML2 client')
+
     return app
 
 
 def eduid_init_app(name, config, app_class=AuthnApp):
     app = eduid_init_app_no_db(name, config, app_class=app_class)
-    app.central_userdb = UserDB(app.config['MONGO_URI'], 'eduid_am')  # XXX: Needs updating when we change db
+    app.central_userdb = CentralUserDB(app.config['MONGO_URI'], 'eduid_am')  # XXX: Needs updating when we change db
+    # Optional process wide cache of the users loaded by get_user
+    user_cache_size = int(app.config.get('CENTRAL_USER_CACHE_SIZE', 0))
+    if user_cache_size:
+        app.central_user_cache = UserCache(app.central_userdb, size=user_cache_size)
     # Set up generic health check views
     from eduid_common.api.views.status import status_views
     app.register_blueprint(status_views)
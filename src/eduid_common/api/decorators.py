@@ -74,6 +74,16 @@ def can_verify_identity(f):
     return verify_identity_decorator
 
 
+def read_only_session(f):
+    @wraps(f)
+    def read_only_session_decorator(*args, **kwargs):
+        # The session will not be written back to the backend at the end
+        # of the request, see eduid_common.api.session.Session.read_only
+        session.read_only = True
+        return f(*args, **kwargs)
+    return read_only_session_decorator
+
+
 class MarshalWith(object):
 
     def __init__(self, schema):
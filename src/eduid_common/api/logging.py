@@ -11,7 +11,7 @@ try:
     from flask.logging import default_handler  # Flask 0.13
 except ImportError:
     default_handler = None
-from flask import session, current_app
+from flask import session, current_app, has_request_context
 from eduid_common.api.exceptions import BadConfiguration
 
 __author__ = 'lundberg'
@@ -61,7 +61,8 @@ class UserFilter(logging.Filter):
 
     def filter(self, record):
         record.eppn = ''
-        if session:
+        # Don't load the session from the backend just to log the eppn
+        if has_request_context() and getattr(session, 'loaded', True) and session:
             record.eppn = session.get('user_eppn', '')
         return True
 
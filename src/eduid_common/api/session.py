@@ -30,103 +30,49 @@
 # POSSIBILITY OF SUCH DAMAGE.
 #
 
-import collections
-from time import time
 import os
 import binascii
 
-from flask import request, current_app
+from flask import request, current_app, g
 from flask.sessions import SessionInterface
 
 from eduid_common.session.session import SessionManager
+from eduid_common.session.request_session import RequestSession, ReadOnlySessionError
+from eduid_common.session.redis_io import start_request_tracking, stop_request_tracking
 
 
 class NoSessionDataFoundException(Exception):
     pass
 
 
-def manage(action):
-    """
-    Decorator which causes the session to be marked as modified, so that it
-    will be saved at the end of the request.
-
-    :param action: Whether the session data has been changed or just accessed.
-                   When it has been changed, the call to session.commit()
-                   implies setting the ttl on the backend, so there is no need
-                   to set it explicitly.
-    :type action: str ('accessed'|'changed')
-    """
-    def outer(wrapped):
-        def accessed(session, *arg, **kw):
-            renew_backend = action=='accessed'
-            session.renew_ttl(renew_backend=renew_backend)
-            return wrapped(session, *arg, **kw)
-        accessed.__doc__ = wrapped.__doc__
-        return accessed
-    return outer
-
-
-class Session(collections.MutableMapping):
+class Session(RequestSession):
     """
     Session implementing the flask.sessions.SessionMixin interface.
     It uses the Session defined in eduid_common.session.session
     to store the session data in redis.
+
+    The session is loaded lazily and written to redis at most once per
+    request, see eduid_common.session.request_session.
     """
 
-    def __init__(self, app, base_session, new=False):
+    def __init__(self, app, manager, token=None, read_only=False):
         """
         :param app: the flask app
-        :param base_session: The underlying session object
-        :param new: whether the session is new or not.
+        :param manager: The session manager providing the underlying session object
+        :param token: The session token from the request cookie, if any
+        :param read_only: whether the session data should be left untouched
+                          in the backend at the end of the request.
 
         :type app: flask.Flask
-        :type base_session: eduid_common.session.session.Session
-        :type new: bool
+        :type manager: eduid_common.session.session.SessionManager
+        :type token: str | unicode | None
+        :type read_only: bool
         """
+        super(Session, self).__init__(manager, token=token, read_only=read_only,
+                                      debug=app.debug, stats=getattr(app, 'stats', None))
         self.app = app
-        self._session = base_session
-        self._created = time()
-        self._new = new
-        self._modified = False
-        self._invalidated = False
         self._permanent = True
 
-    @manage('accessed')
-    def __getitem__(self, key, default=None):
-        return self._session.__getitem__(key, default=None)
-
-    @manage('changed')
-    def __setitem__(self, key, value):
-        self._session[key] = value
-        self._session.commit()
-
-    @manage('changed')
-    def __delitem__(self, key):
-        del self._session[key]
-        self._session.commit()
-
-    @manage('accessed')
-    def __iter__(self):
-        return self._session.__iter__()
-
-    @manage('accessed')
-    def __len__(self):
-        return len(self._session)
-
-    @manage('accessed')
-    def __contains__(self, key):
-        return self._session.__contains__(key)
-
-    @property
-    def token(self):
-        """
-        Return the token in the session,
-        or the empty string if the session has been invalidated.
-        """
-        if self._invalidated:
-            return ''
-        return self._session.token
-
     @property
     def permanent(self):
         """
@@ -134,59 +80,19 @@ class Session(collections.MutableMapping):
         """
         return self._permanent
 
-    @property
-    def new(self):
-        """
-        See flask.sessions.SessionMixin
-        """
-        return self._new
-
-    @property
-    def created(self):
-        """
-        Created timestamp
-        """
-        return self._created
-
     @property
     def modified(self):
         """
         See flask.sessions.SessionMixin
         """
-        return self._modified
+        return self._changed
 
     @modified.setter
     def modified(self, val):
-        self._modified = val
-
-    def persist(self):
-        """
-        Store the session data in the redis backend,
-        and renew the ttl for it.
-        """
-        self._session.commit()
-
-    def renew_ttl(self, renew_backend):
-        """
-        Reset the ttl for the session, both in the cookie and
-        (if `renew_backend==True`) in the redis backend.
-
-        :param renew_backend: whether to renew the ttl in the redis backend
-        :type renew_backend: bool
-        """
-        if not self.modified:
-            self.modified =True
-            if renew_backend:
-                self._session.renew_ttl()
-
-    def invalidate(self):
-        """
-        Invalidate the session. Clear the data from redis,
-        and set an empty session cookie.
-        """
-        self.modified = True
-        self._invalidated = True
-        self._session.clear()
+        if val:
+            self.mark_changed()
+        else:
+            self._changed = False
 
     def set_cookie(self, response):
         """
@@ -210,7 +116,6 @@ class Session(collections.MutableMapping):
                             max_age=max_age
                             )
 
-    @manage('changed')
     def new_csrf_token(self):
         """
         Copied from pyramid_session.py
@@ -221,10 +126,8 @@ class Session(collections.MutableMapping):
             token = binascii.hexlify(os.urandom(20))
             request._csrft_ = token
         self['_csrft_'] = token
-        self.persist()
         return token
 
-    @manage('accessed')
     def get_csrf_token(self):
         """
         Copied from pyramid_session.py
@@ -249,6 +152,10 @@ class SessionFactory(SessionInterface):
         secret = config['SECRET_KEY']
         ttl = 2 * int(config['PERMANENT_SESSION_LIFETIME'])
         self.manager = SessionManager(config, ttl=ttl, secret=secret)
+        # HTTP methods for which sessions are opened read-only by default,
+        # e.g. ['GET', 'HEAD']. Views can also opt in with the
+        # eduid_common.api.decorators.read_only_session decorator.
+        self.read_only_methods = config.get('SESSION_READ_ONLY_METHODS', [])
 
     def open_session(self, app, request):
         """
@@ -258,30 +165,33 @@ class SessionFactory(SessionInterface):
             cookie_name = app.config['SESSION_COOKIE_NAME']
         except KeyError:
             return None
+        # The Redis I/O done during the request is available as g.redis_io
+        g.redis_io = start_request_tracking()
         token = request.cookies.get(cookie_name, None)
         current_app.logger.debug('Session cookie {} == {}'.format(cookie_name, token))
-        if token is None:
-            # New session
-            base_session = self.manager.get_session(data={})
-            session = Session(app, base_session, new=True)
-            current_app.logger.debug('Created new session {}'.format(session))
-        else:
-            # Existing session
-            try:
-                base_session = self.manager.get_session(token=token)
-                session = Session(app, base_session, new=False)
-                current_app.logger.debug('Loaded existing session {}'.format(session))
-            except (KeyError, ValueError):
-                base_session = self.manager.get_session(data = {})
-                session = Session(app, base_session, new = True)
-                current_app.logger.warning('Re-created missing session {}'.format(session))
-                #raise NoSessionDataFoundException('No session data found')
-
-        return session
+        # The session data is not loaded from the backend until it is used
+        read_only = request.method in self.read_only_methods
+        return Session(app, self.manager, token=token, read_only=read_only)
 
     def save_session(self, app, session, response):
         """
         See flask.session.SessionInterface
         """
-        session.persist()
-        session.set_cookie(response)
+        if session.loaded:
+            session.commit()
+            session.set_cookie(response)
+        # else: session not used in this request, nothing to save
+        # The tracking itself is stopped in end_redis_io_tracking
+        redis_io = getattr(g, 'redis_io', None)
+        if app.debug and redis_io is not None:
+            response.headers['X-Redis-IO'] = str(redis_io)
+
+
+def end_redis_io_tracking(_exception=None):
+    """
+    Stop the Redis I/O tracking started in SessionFactory.open_session.
+
+    Registered as a teardown_request function, since Flask does not call
+    save_session when the request fails with an unhandled exception.
+    """
+    stop_request_tracking()
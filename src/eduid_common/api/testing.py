@@ -40,7 +40,6 @@ import subprocess
 from contextlib import contextmanager
 from copy import deepcopy
 
-import redis
 import etcd
 from flask.testing import FlaskClient
 
@@ -48,6 +47,8 @@ from eduid_userdb import User
 from eduid_userdb.data_samples import NEW_USER_EXAMPLE
 from eduid_userdb.testing import MongoTemporaryInstance
 
+from eduid_common.session.testing import RedisTemporaryInstance, RedisIOAssertionsMixin
+
 
 TEST_CONFIG = {
     'DEBUG': True,
@@ -79,7 +80,7 @@ TEST_CONFIG = {
 }
 
 
-class EduidAPITestCase(unittest.TestCase):
+class EduidAPITestCase(RedisIOAssertionsMixin, unittest.TestCase):
     """
     Base Test case for eduID APIs.
 
@@ -173,70 +174,6 @@ class EduidAPITestCase(unittest.TestCase):
         return True
 
 
-class RedisTemporaryInstance(object):
-    """Singleton to manage a temporary Redis instance
-
-    Use this for testing purpose only. The instance is automatically destroyed
-    at the end of the program.
-
-    """
-    _instance = None
-
-    @classmethod
-    def get_instance(cls):
-        if cls._instance is None:
-            cls._instance = cls()
-            atexit.register(cls._instance.shutdown)
-        return cls._instance
-
-    def __init__(self):
-        self._tmpdir = tempfile.mkdtemp()
-        self._port = random.randint(40000, 65535)
-        self._process = subprocess.Popen(['docker', 'run', '--rm',
-                                          '-p', '{!s}:6379'.format(self._port),
-                                          '-v', '{!s}:/data'.format(self._tmpdir),
-                                          '-e', 'extra_args=--daemonize no --bind 0.0.0.0',
-                                          'docker.sunet.se/eduid/redis:latest',
-                                          ],
-                                         stdout=open('/tmp/redis-temp.log', 'wb'),
-                                         stderr=subprocess.STDOUT)
-        for i in range(10):
-            time.sleep(0.2)
-            try:
-                self._conn = redis.Redis('localhost', self._port, 0)
-                self._conn.set('dummy', 'dummy')
-            except redis.exceptions.ConnectionError:
-                continue
-            else:
-                break
-        else:
-            self.shutdown()
-            assert False, 'Cannot connect to the redis test instance'
-
-    @property
-    def conn(self):
-        return self._conn
-
-    @property
-    def port(self):
-        return self._port
-
-    def shutdown(self):
-        if self._process:
-            self._process.terminate()
-            self._process.wait()
-            self._process = None
-        shutil.rmtree(self._tmpdir, ignore_errors=True)
-
-    def get_uri(self):
-        """
-        Convenience function to get a redis URI to the temporary database.
-
-        :return: host, port, dbname
-        """
-        return 'localhost', self.port, 0
-
-
 class EtcdTemporaryInstance(object):
     """Singleton to manage a temporary Etcd instance
 
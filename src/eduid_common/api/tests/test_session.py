@@ -0,0 +1,184 @@
+from __future__ import absolute_import
+
+from unittest import TestCase
+
+from flask import Flask, request, g
+
+from eduid_common.api.session import Session, SessionFactory, ReadOnlySessionError, end_redis_io_tracking
+from eduid_common.session import redis_io
+from eduid_common.session.testing import RedisTemporaryInstance
+from eduid_common.session.tests.test_request_session import CountingRedisConn, FakeSessionManager
+
+
+SESSION_CONFIG = {
+    'SECRET_KEY': 's3cr3t',
+    'SESSION_COOKIE_NAME': 'sessid',
+    'SESSION_COOKIE_DOMAIN': 'test.localhost',
+    'SESSION_COOKIE_PATH': '/',
+    'SESSION_COOKIE_HTTPONLY': False,
+    'SESSION_COOKIE_SECURE': False,
+    'PERMANENT_SESSION_LIFETIME': 60,
+    'REDIS_HOST': 'localhost',
+    'REDIS_PORT': '6379',
+    'REDIS_DB': '0',
+}
+
+
+class CountingStats(object):
+
+    def __init__(self):
+        self.counts = {}
+
+    def count(self, name, value=1):
+        self.counts[name] = self.counts.get(name, 0) + value
+
+
+class SessionTestCase(TestCase):
+
+    def setUp(self):
+        self.app = Flask('test_app')
+        self.app.config.update(SESSION_CONFIG)
+        self.app.stats = CountingStats()
+        self.factory = SessionFactory(self.app.config)
+        self.conn = CountingRedisConn()
+        self.factory.manager = FakeSessionManager(self.conn)
+        base = self.factory.manager.get_session(data={'user_eppn': 'hubba-bubba'})
+        base.commit()
+        self.token = base.token
+        self.conn.round_trips = []
+        self.headers = {'Cookie': 'sessid={}'.format(self.token)}
+
+    def _request(self, method='GET', headers=None):
+        if headers is None:
+            headers = self.headers
+        return self.app.test_request_context('/', method=method, headers=headers)
+
+
+class SessionTests(SessionTestCase):
+
+    def test_not_used(self):
+        with self._request():
+            sess = self.factory.open_session(self.app, request)
+            response = self.app.response_class()
+            self.factory.save_session(self.app, sess, response)
+        self.assertEqual(self.conn.round_trips, [])
+        self.assertNotIn('Set-Cookie', response.headers)
+
+    def test_read(self):
+        with self._request():
+            sess = self.factory.open_session(self.app, request)
+            self.assertEqual(sess['user_eppn'], 'hubba-bubba')
+            response = self.app.response_class()
+            self.factory.save_session(self.app, sess, response)
+        self.assertEqual(self.conn.round_trips, [['get', 'expire']])
+        self.assertIn(self.token, response.headers['Set-Cookie'])
+
+    def test_write_once(self):
+        with self._request(method='POST'):
+            sess = self.factory.open_session(self.app, request)
+            sess['foo'] = 'bar'
+            sess['bar'] = 'baz'
+            sess.get_csrf_token()
+            self.factory.save_session(self.app, sess, self.app.response_class())
+        self.assertEqual(self.conn.round_trips, [['get', 'expire'], ['setex']])
+
+    def test_new_session(self):
+        with self._request(headers={}):
+            sess = self.factory.open_session(self.app, request)
+            self.assertTrue(sess.new)
+            self.assertIsNone(sess.get('user_eppn'))
+            response = self.app.response_class()
+            self.factory.save_session(self.app, sess, response)
+        self.assertEqual(self.conn.round_trips, [['setex']])
+        self.assertIn(sess.token, response.headers['Set-Cookie'])
+
+
+class ReadOnlySessionTests(SessionTestCase):
+
+    def _load_session(self, read_only):
+        return Session(self.app, self.factory.manager, token=self.token, read_only=read_only)
+
+    def test_read_only_write_debug(self):
+        self.app.debug = True
+        with self._request():
+            sess = self._load_session(read_only=True)
+            with self.assertRaises(ReadOnlySessionError):
+                sess['foo'] = 'bar'
+            self.factory.save_session(self.app, sess, self.app.response_class())
+        self.assertNotIn(['setex'], self.conn.round_trips)
+
+    def test_read_only_write_production(self):
+        self.app.debug = False
+        with self._request():
+            sess = self._load_session(read_only=True)
+            sess['foo'] = 'bar'
+            self.assertFalse(sess.read_only)
+            self.assertEqual(sess['foo'], 'bar')
+            self.factory.save_session(self.app, sess, self.app.response_class())
+        self.assertEqual(self.app.stats.counts, {'session_read_only_write': 1})
+        self.assertIn(['setex'], self.conn.round_trips)
+
+    def test_read_only_methods(self):
+        self.app.config['SESSION_READ_ONLY_METHODS'] = ['GET', 'HEAD']
+        factory = SessionFactory(self.app.config)
+        with self._request(method='GET'):
+            self.assertTrue(factory.open_session(self.app, request).read_only)
+        with self._request(method='POST'):
+            self.assertFalse(factory.open_session(self.app, request).read_only)
+
+
+class RedisIOHeaderTests(SessionTestCase):
+
+    def test_header_debug(self):
+        self.app.debug = True
+        with self._request():
+            sess = self.factory.open_session(self.app, request)
+            self.assertIsNotNone(g.redis_io)
+            response = self.app.response_class()
+            self.factory.save_session(self.app, sess, response)
+        self.assertIn('round_trips=0', response.headers['X-Redis-IO'])
+
+    def test_no_header_production(self):
+        self.app.debug = False
+        with self._request():
+            sess = self.factory.open_session(self.app, request)
+            response = self.app.response_class()
+            self.factory.save_session(self.app, sess, response)
+        self.assertNotIn('X-Redis-IO', response.headers)
+
+    def test_tracking_stopped_on_exception(self):
+        self.app.session_interface = self.factory
+        self.app.teardown_request(end_redis_io_tracking)
+        self.app.config['PROPAGATE_EXCEPTIONS'] = False
+
+        @self.app.route('/fail')
+        def fail():
+            raise RuntimeError('unhandled')
+
+        response = self.app.test_client().get('/fail', headers=self.headers)
+        self.assertEqual(response.status_code, 500)
+        self.assertIsNone(getattr(redis_io._local, 'request', None))
+
+
+class RedisIOHeaderRedisTests(TestCase):
+
+    def setUp(self):
+        self.redis_instance = RedisTemporaryInstance.get_instance()
+        self.app = Flask('test_app')
+        self.app.config.update(SESSION_CONFIG)
+        self.app.config['REDIS_PORT'] = self.redis_instance.port
+        self.app.debug = True
+        self.factory = SessionFactory(self.app.config)
+        base = self.factory.manager.get_session(data={'user_eppn': 'hubba-bubba'})
+        base.commit()
+        self.headers = {'Cookie': 'sessid={}'.format(base.token)}
+
+    def test_header_load_and_commit(self):
+        with self.app.test_request_context('/', method='POST', headers=self.headers):
+            sess = self.factory.open_session(self.app, request)
+            sess['foo'] = 'bar'
+            response = self.app.response_class()
+            self.factory.save_session(self.app, sess, response)
+            end_redis_io_tracking()
+        # GET and EXPIRE pipelined, then SETEX
+        self.assertIn('commands=3, round_trips=2', response.headers['X-Redis-IO'])
@@ -0,0 +1,177 @@
+# -*- coding: utf-8 -*-
+
+from __future__ import absolute_import
+
+from datetime import datetime
+from unittest import TestCase
+
+from bson import ObjectId
+from flask import Flask, session
+
+from eduid_common.api.userdb import UserDocumentsMixin
+from eduid_common.api.utils import UserCache, get_user, invalidate_user, get_users, get_user_documents
+
+
+class FakeUser(object):
+
+    def __init__(self, data):
+        self.data = data
+        self.eppn = data['eduPersonPrincipalName']
+        self.modified_ts = data.get('modified_ts')
+
+    def to_dict(self):
+        return dict(self.data)
+
+
+class FakeCollection(object):
+
+    def __init__(self, docs):
+        self.docs = docs
+        self.projections = []
+
+    def find_one(self, spec, projection):
+        self.projections.append(projection)
+        doc = self.docs.get(spec['eduPersonPrincipalName'])
+        if doc is None:
+            return None
+        return {k: v for k, v in doc.items() if k in projection}
+
+    def find(self, spec, projection=None):
+        self.queries = getattr(self, 'queries', 0) + 1
+        ((attr, cond),) = spec.items()
+        for doc in self.docs.values():
+            if doc.get(attr) in cond['$in']:
+                if projection is None:
+                    yield dict(doc)
+                else:
+                    yield {k: v for k, v in doc.items() if k in projection}
+
+
+class FakeUserDB(UserDocumentsMixin):
+
+    UserClass = FakeUser
+
+    def __init__(self, docs):
+        self._coll = FakeCollection(docs)
+        self.loads = 0
+
+    def get_user_by_eppn(self, eppn, raise_on_missing=True):
+        self.loads += 1
+        return FakeUser(dict(self._coll.docs[eppn]))
+
+
+class UserCacheTests(TestCase):
+
+    def setUp(self):
+        self.docs = {
+            'hubba-bubba': {'eduPersonPrincipalName': 'hubba-bubba', 'modified_ts': datetime(2017, 1, 1)},
+            'hubba-baar': {'eduPersonPrincipalName': 'hubba-baar', 'modified_ts': datetime(2017, 1, 1)},
+        }
+        self.userdb = FakeUserDB(self.docs)
+        self.cache = UserCache(self.userdb, size=1)
+
+    def test_cached(self):
+        user = self.cache.get_user_by_eppn('hubba-bubba')
+        user2 = self.cache.get_user_by_eppn('hubba-bubba')
+        self.assertEqual(self.userdb.loads, 1)
+        self.assertIsNot(user, user2)
+        self.assertEqual(user2.to_dict(), user.to_dict())
+        self.assertEqual(self.userdb._coll.projections, [{'modified_ts': True}])
+
+    def test_modified(self):
+        self.cache.get_user_by_eppn('hubba-bubba')
+        self.docs['hubba-bubba']['modified_ts'] = datetime(2017, 1, 2)
+        user = self.cache.get_user_by_eppn('hubba-bubba')
+        self.assertEqual(self.userdb.loads, 2)
+        self.assertEqual(user.modified_ts, datetime(2017, 1, 2))
+
+    def test_size_and_invalidate(self):
+        self.cache.get_user_by_eppn('hubba-bubba')
+        self.cache.get_user_by_eppn('hubba-baar')
+        self.assertEqual(list(self.cache._users.keys()), ['hubba-baar'])
+        self.cache.invalidate('hubba-baar')
+        self.cache.get_user_by_eppn('hubba-baar')
+        self.assertEqual(self.userdb.loads, 3)
+
+
+class GetUserTests(TestCase):
+
+    def setUp(self):
+        self.app = Flask('test_app')
+        self.app.secret_key = 's3cr3t'
+        self.app.central_userdb = FakeUserDB({
+            'hubba-bubba': {'eduPersonPrincipalName': 'hubba-bubba', 'modified_ts': datetime(2017, 1, 1)},
+        })
+
+    def test_once_per_request(self):
+        with self.app.test_request_context('/'):
+            session['user_eppn'] = 'hubba-bubba'
+            user = get_user()
+            self.assertEqual(get_user().to_dict(), user.to_dict())
+            self.assertEqual(self.app.central_userdb.loads, 1)
+            invalidate_user('hubba-bubba')
+            get_user()
+            self.assertEqual(self.app.central_userdb.loads, 2)
+        with self.app.test_request_context('/'):
+            session['user_eppn'] = 'hubba-bubba'
+            get_user()
+            self.assertEqual(self.app.central_userdb.loads, 3)
+
+    def test_not_shared(self):
+        with self.app.test_request_context('/'):
+            session['user_eppn'] = 'hubba-bubba'
+            user = get_user()
+            user2 = get_user()
+            self.assertIsNot(user2, user)
+            # Changes by one caller are not seen by the others
+            user.data['givenName'] = 'Changed'
+            user2.data['givenName'] = 'Changed too'
+            self.assertNotIn('givenName', get_user().to_dict())
+            self.assertEqual(self.app.central_userdb.loads, 1)
+
+    def test_user_cache(self):
+        self.app.central_user_cache = UserCache(self.app.central_userdb)
+        for _ in range(2):
+            with self.app.test_request_context('/'):
+                session['user_eppn'] = 'hubba-bubba'
+                get_user()
+        self.assertEqual(self.app.central_userdb.loads, 1)
+
+
+class GetUsersTests(TestCase):
+
+    def setUp(self):
+        self.user_id = ObjectId()
+        self.userdb = FakeUserDB({
+            'hubba-bubba': {'_id': self.user_id, 'eduPersonPrincipalName': 'hubba-bubba',
+                            'givenName': 'Hubba', 'passwords': ['secret']},
+            'hubba-baar': {'_id': ObjectId(), 'eduPersonPrincipalName': 'hubba-baar',
+                           'givenName': 'Baar', 'passwords': ['secret']},
+        })
+
+    def test_get_users(self):
+        users = get_users(eppns=['hubba-bubba', 'hubba-baar', 'missing'], userdb=self.userdb)
+        self.assertEqual(sorted(users.keys()), ['hubba-baar', 'hubba-bubba'])
+        self.assertIsInstance(users['hubba-bubba'], FakeUser)
+        self.assertEqual(self.userdb._coll.queries, 1)
+        self.assertEqual(self.userdb.loads, 0)
+
+    def test_get_users_by_id(self):
+        users = get_users(user_ids=[str(self.user_id)], userdb=self.userdb)
+        self.assertEqual(list(users.keys()), [str(self.user_id)])
+        self.assertEqual(users[str(self.user_id)].eppn, 'hubba-bubba')
+
+    def test_get_users_by_object_id(self):
+        users = get_users(user_ids=[self.user_id, ObjectId()], userdb=self.userdb)
+        # Keyed by the user ids as given
+        self.assertEqual(list(users.keys()), [self.user_id])
+        self.assertIsInstance(list(users.keys())[0], ObjectId)
+        self.assertEqual(users[self.user_id].eppn, 'hubba-bubba')
+
+    def test_get_user_documents(self):
+        docs = get_user_documents(['givenName'], eppns=['hubba-bubba'], userdb=self.userdb)
+        self.assertEqual(docs, {'hubba-bubba': {'eduPersonPrincipalName': 'hubba-bubba', 'givenName': 'Hubba'}})
+        docs = get_user_documents(['givenName'], user_ids=[self.user_id], userdb=self.userdb)
+        self.assertEqual(docs, {self.user_id: {'_id': self.user_id, 'givenName': 'Hubba'}})
+        docs = get_user_documents(['givenName'], user_ids=[str(self.user_id)], userdb=self.userdb)
+        self.assertEqual(list(docs.keys()), [str(self.user_id)])
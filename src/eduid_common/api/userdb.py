@@ -0,0 +1,65 @@
+# -*- coding: utf-8 -*-
+
+from __future__ import absolute_import
+
+from eduid_userdb import UserDB
+
+
+class UserDocumentsMixin(object):
+    """
+    Queries returning single fields or subsets of user documents, for
+    eduid_common.api.utils.UserCache and get_users / get_user_documents.
+
+    To be mixed into an eduid_userdb.UserDB (sub)class.
+    """
+
+    def get_modified_ts_by_eppn(self, eppn):
+        """
+        Get the modified_ts of a user without loading the whole user document.
+
+        :param eppn: The eppn of the user
+        :type eppn: str | unicode
+
+        :return: The modified_ts of the user, None if the user or modified_ts is missing
+        :rtype: datetime.datetime | None
+        """
+        doc = self._coll.find_one({'eduPersonPrincipalName': eppn}, {'modified_ts': True})
+        if doc is None:
+            return None
+        return doc.get('modified_ts')
+
+    def get_user_documents_by_attr(self, attr, values, fields=None, batch_size=1000):
+        """
+        Find user documents in batches, with one query per batch_size values.
+
+        :param attr: The attribute to match, e.g. 'eduPersonPrincipalName'
+        :param values: The values of attr to look for
+        :param fields: Names of the fields to load, None for the whole documents
+        :param batch_size: Max number of values per query
+
+        :type attr: str
+        :type values: list
+        :type fields: list | None
+        :type batch_size: int
+
+        :return: {value: user document}
+        :rtype: dict
+        """
+        projection = None
+        if fields is not None:
+            projection = dict([(field, True) for field in fields])
+            projection[attr] = True
+        values = list(set(values))
+        res = {}
+        for start in range(0, len(values), batch_size):
+            spec = {attr: {'$in': values[start:start + batch_size]}}
+            for doc in self._coll.find(spec, projection):
+                res[doc[attr]] = doc
+        return res
+
+
+class CentralUserDB(UserDocumentsMixin, UserDB):
+    """
+    The central userdb (eduid_am), see eduid_common.api.app.eduid_init_app.
+    """
+    pass
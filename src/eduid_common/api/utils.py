@@ -1,9 +1,13 @@
 # -*- coding: utf-8 -*-
 
 import re
+import copy
+import threading
+from collections import OrderedDict
 from uuid import uuid4
 import sys
-from flask import current_app, session
+from flask import current_app, session, g
+from bson import ObjectId
 
 from eduid_userdb import User
 from eduid_userdb.dashboard import DashboardUser
@@ -68,17 +72,89 @@ def update_modified_ts(user):
         user, private_user, private_user.modified_ts))
 
 
+class UserCache(object):
+    """
+    Process wide cache of users from a userdb, keyed by eppn.
+
+    A cached user is only used after checking that the modified_ts of the
+    user document is unchanged, which only fetches that field from the
+    database instead of the whole user document.
+
+    :param userdb: The user database
+    :param size: Max number of users to cache
+
+    :type userdb: eduid_common.api.userdb.CentralUserDB
+    :type size: int
+    """
+
+    def __init__(self, userdb, size=1000):
+        self.userdb = userdb
+        self.size = size
+        # {eppn: (modified_ts, user_dict)}, least recently used first
+        self._users = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get_user_by_eppn(self, eppn):
+        """
+        :param eppn: The eppn of the user
+
+        :return: The user, a new object on every call
+        :rtype: eduid_userdb.User
+
+        :raise UserDoesNotExist: No user with that eppn
+        :raise MultipleUsersReturned: More than one user with that eppn
+        """
+        with self._lock:
+            entry = self._users.pop(eppn, None)
+            if entry is not None:
+                self._users[eppn] = entry
+        if entry is not None:
+            modified_ts, data = entry
+            if self.userdb.get_modified_ts_by_eppn(eppn) == modified_ts:
+                return self.userdb.UserClass(data=copy.deepcopy(data))
+        user = self.userdb.get_user_by_eppn(eppn, raise_on_missing=True)
+        if user.modified_ts is not None:
+            with self._lock:
+                self._users[eppn] = (user.modified_ts, copy.deepcopy(user.to_dict()))
+                while len(self._users) > self.size:
+                    self._users.popitem(last=False)
+        return user
+
+    def invalidate(self, eppn):
+        """
+        :param eppn: The eppn of the user to remove from the cache
+        """
+        with self._lock:
+            self._users.pop(eppn, None)
+
+
+def _get_central_user(eppn):
+    user_cache = getattr(current_app, 'central_user_cache', None)
+    if user_cache is not None:
+        return user_cache.get_user_by_eppn(eppn)
+    return current_app.central_userdb.get_user_by_eppn(eppn, raise_on_missing=True)
+
+
 def get_user():
     """
+    The user is only loaded from the central userdb once per request
+    (and eppn). Every call returns a new user object, so that changes made
+    to the user by one caller are not seen by the others until saved.
+
     :return: Central userdb user
     :rtype: eduid_userdb.user.User
     """
     eppn = session.get('user_eppn', None)
     if not eppn:
         raise ApiException('Not authorized', status_code=401)
+    users = getattr(g, 'central_users', None)
+    if users is None:
+        users = g.central_users = {}
+    if eppn in users:
+        return current_app.central_userdb.UserClass(data=copy.deepcopy(users[eppn]))
     try:
         # Get user from central database
-        return current_app.central_userdb.get_user_by_eppn(eppn, raise_on_missing=True)
+        user = _get_central_user(eppn)
     except UserDoesNotExist as e:
         current_app.logger.error('Could not find user in central database.')
         current_app.logger.error(e)
@@ -87,6 +163,86 @@ def get_user():
         current_app.logger.error('Found multiple users in central database.')
         current_app.logger.error(e)
         raise ApiException('Not authorized', status_code=401)
+    users[eppn] = copy.deepcopy(user.to_dict())
+    return user
+
+
+def _find_users(userdb, eppns, user_ids, fields=None):
+    """
+    :return: {eppn or user_id as given: user document}
+    :rtype: dict
+    """
+    if eppns is not None:
+        return userdb.get_user_documents_by_attr('eduPersonPrincipalName', eppns, fields=fields)
+    # The documents have ObjectId user ids, the user ids may have been given as strings
+    user_ids = dict([(ObjectId(user_id), user_id) for user_id in user_ids or []])
+    docs = userdb.get_user_documents_by_attr('_id', list(user_ids.keys()), fields=fields)
+    return dict([(user_ids[user_id], doc) for user_id, doc in docs.items()])
+
+
+def get_users(eppns=None, user_ids=None, userdb=None):
+    """
+    Load many users in one database query (per thousand users), instead of one
+    query per user.
+
+    :param eppns: eppns of the users to load
+    :param user_ids: Ids of the users to load, if eppns is not given
+    :param userdb: The user database, default the central userdb
+
+    :type eppns: list | None
+    :type user_ids: list | None
+    :type userdb: eduid_common.api.userdb.CentralUserDB | None
+
+    :return: The users found, keyed by the eppns or user_ids as given
+    :rtype: dict
+    """
+    if userdb is None:
+        userdb = current_app.central_userdb
+    docs = _find_users(userdb, eppns, user_ids)
+    return dict([(key, userdb.UserClass(data=doc)) for key, doc in docs.items()])
+
+
+def get_user_documents(fields, eppns=None, user_ids=None, userdb=None):
+    """
+    Load selected fields of many users in one database query (per thousand
+    users), e.g. only the names for a list of users, without transferring
+    credentials, nins and mail addresses.
+
+    The user documents are returned as they are stored in the database, as
+    a user object can not be created from a subset of the fields.
+
+    :param fields: Names of the user document fields to load, e.g. ['givenName', 'surname']
+    :param eppns: eppns of the users to load
+    :param user_ids: Ids of the users to load, if eppns is not given
+    :param userdb: The user database, default the central userdb
+
+    :type fields: list
+    :type eppns: list | None
+    :type user_ids: list | None
+    :type userdb: eduid_common.api.userdb.CentralUserDB | None
+
+    :return: The user documents found, keyed by the eppns or user_ids as given
+    :rtype: dict
+    """
+    if userdb is None:
+        userdb = current_app.central_userdb
+    return _find_users(userdb, eppns, user_ids, fields=fields)
+
+
+def invalidate_user(eppn):
+    """
+    Forget the central userdb user loaded by get_user, in this request and in
+    the process wide cache.
+
+    :param eppn: The eppn of the user
+    :type eppn: str | unicode
+    """
+    users = getattr(g, 'central_users', None)
+    if users is not None:
+        users.pop(eppn, None)
+    user_cache = getattr(current_app, 'central_user_cache', None)
+    if user_cache is not None:
+        user_cache.invalidate(eppn)
 
 
 def save_and_sync_user(user):
@@ -101,6 +257,7 @@ def save_and_sync_user(user):
     if not isinstance(user, current_app.private_userdb.UserClass):
         raise EduIDUserDBError('user is not of type {}'.format(current_app.private_userdb.UserClass))
     current_app.private_userdb.save(user)
+    invalidate_user(user.eppn)
     return current_app.am_relay.request_user_sync(user)
 
 
@@ -32,6 +32,7 @@
 
 import vccs_client
 
+from eduid_common.authn.vccs_guard import get_guarded_vccs_client
 
 TESTING = False
 _test_client = None
@@ -39,11 +40,11 @@ _test_client = None
 
 def get_vccs_client(vccs_url):
     """
-    Instantiate a VCCS client.
+    Get the VCCS client for vccs_url, shared by all threads of the process.
     :param vccs_url: VCCS authentication backend URL
     :type vccs_url: string
     :return: vccs client
-    :rtype: VCCSClient
+    :rtype: eduid_common.authn.vccs_guard.GuardedVCCSClient | VCCSClient
     """
     if TESTING and vccs_url == 'dummy':
         global _test_client
@@ -52,6 +53,4 @@ def get_vccs_client(vccs_url):
             from eduid_common.authn.testing import TestVCCSClient
             _test_client = TestVCCSClient()
         return _test_client
-    return vccs_client.VCCSClient(
-        base_url=vccs_url,
-    )
+    return get_guarded_vccs_client(vccs_url)
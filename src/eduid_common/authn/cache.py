@@ -17,45 +17,195 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import time
+
 from saml2.cache import Cache
+from saml2.ident import code
+
+from eduid_common.session.request_session import RequestSubSession, register_sub_session_namespace
+
+try:
+    # Only used to find the cache store of the current Flask app, see IdentityCache
+    from flask import current_app, has_app_context
+except ImportError:
+    current_app = None
+
+    def has_app_context():
+        return False
+
+# Max number of outstanding queries kept in a session
+OUTSTANDING_QUERIES_MAX_ENTRIES = 10
+# Seconds after which an outstanding query is discarded
+OUTSTANDING_QUERIES_MAX_AGE = 3600
+
+# The sub session holding the identity and state caches, see get_saml2_cache_backend
+SAML2_SUB_SESSION = 'saml2'
+register_sub_session_namespace(SAML2_SUB_SESSION)
+
+
+def get_saml2_cache_backend(config, session):
+    """
+    Get the storage for the SAML identity and state caches.
+
+    With SAML2_SEPARATE_CACHE_STORE set, the caches are kept in a sub session
+    (see eduid_common.session.request_session), so that they are only loaded
+    and stored by the requests using a Saml2Client instead of by every request
+    using the session.
+
+    :param config: The app configuration
+    :param session: The session of the current request, or the storage returned before
+
+    :type config: dict
+    :type session: eduid_common.api.session.Session | dict
+
+    :rtype: eduid_common.session.request_session.RequestSession | dict
+    """
+    if isinstance(session, RequestSubSession):
+        return session
+    if config.get('SAML2_SEPARATE_CACHE_STORE', False) and hasattr(session, 'sub_session'):
+        return session.sub_session(SAML2_SUB_SESSION)
+    return session
+
+
+def _cache_backend(backend):
+    """
+    Caches created with the session of a Flask request, rather than with the
+    storage from get_saml2_cache_backend, use the storage configured for the app.
+    """
+    if hasattr(backend, 'sub_session') and has_app_context():
+        return get_saml2_cache_backend(current_app.config, backend)
+    return backend
 
 
 class SessionCacheAdapter(dict):
-    """A cache of things that are stored in some backend"""
+    """A cache of things that are stored in some backend
+
+    Only the keys that have been changed are written back to the backend. If
+    the backend supports commit hooks (eduid_common.session.request_session),
+    the changes are written right before the session is stored, so that all
+    cache changes of a request end up in the session's single write.
+    Otherwise they are written by sync().
+
+    Values stored in the cache that are changed in place have to be flagged
+    with mark_changed().
+    """
 
     key_prefix = '_saml2'
 
     def __init__(self, backend, key_suffix):
         self.session = backend
         self.key = self.key_prefix + key_suffix
+        self._changed_keys = set()
+        self._deleted_keys = set()
+        self._hook_registered = False
 
         super(SessionCacheAdapter, self).__init__(self._get_objects())
 
+    def __setitem__(self, key, value):
+        super(SessionCacheAdapter, self).__setitem__(key, value)
+        self.mark_changed(key)
+
+    def __delitem__(self, key):
+        super(SessionCacheAdapter, self).__delitem__(key)
+        self._changed_keys.discard(key)
+        self._deleted_keys.add(key)
+        self._register_hook()
+
     def _get_objects(self):
         return self.session.get(self.key, {})
 
     def _set_objects(self, objects):
         self.session[self.key] = objects
 
-    def sync(self):
-        objs = {}
-        objs.update(self)
+    def _register_hook(self):
+        if not self._hook_registered and hasattr(self.session, 'add_commit_hook'):
+            self.session.add_commit_hook(self._flush)
+            self._hook_registered = True
+
+    def mark_changed(self, key):
+        """
+        Flag a key as changed, after changing its value in place.
+
+        :param key: The cache key
+        """
+        self._deleted_keys.discard(key)
+        self._changed_keys.add(key)
+        self._register_hook()
+
+    def _flush(self):
+        self._hook_registered = False
+        if not (self._changed_keys or self._deleted_keys):
+            return
+        objs = self._get_objects()
+        for key in self._changed_keys:
+            if key in self:
+                objs[key] = self[key]
+        for key in self._deleted_keys:
+            objs.pop(key, None)
+        self._changed_keys = set()
+        self._deleted_keys = set()
         self._set_objects(objs)
 
+    def sync(self):
+        if self._hook_registered:
+            # written when the session is committed
+            return
+        self._flush()
+
 
 class OutstandingQueriesCache(object):
     """Handles the queries that have been sent to the IdP and have not
     been replied yet.
+
+    The queries are stored with the time they were sent, as
+    {saml2_session_id: {'came_from': came_from, 'ts': timestamp}}. Queries
+    that are never replied to (abandoned logins, reloaded login pages) would
+    otherwise pile up in the session, so on every write queries older than
+    max_age seconds are removed, and then the oldest queries until at most
+    max_entries remain.
+
+    Queries stored as a plain came_from string by earlier versions are
+    considered older than any timestamped query.
     """
 
-    def __init__(self, backend):
+    def __init__(self, backend, max_entries=OUTSTANDING_QUERIES_MAX_ENTRIES,
+                 max_age=OUTSTANDING_QUERIES_MAX_AGE):
         self._db = SessionCacheAdapter(backend, '_outstanding_queries')
+        self.max_entries = max_entries
+        self.max_age = max_age
+
+    @staticmethod
+    def _timestamp(entry):
+        if isinstance(entry, dict):
+            return entry.get('ts', 0)
+        return 0
 
     def outstanding_queries(self):
-        return self._db._get_objects()
+        """
+        :return: The outstanding queries, as {saml2_session_id: came_from}
+        :rtype: dict
+        """
+        res = {}
+        for saml2_session_id, entry in self._db.items():
+            if isinstance(entry, dict):
+                entry = entry.get('came_from')
+            res[saml2_session_id] = entry
+        return res
+
+    def _prune(self, now):
+        for saml2_session_id, entry in list(self._db.items()):
+            ts = self._timestamp(entry)
+            if ts and now - ts > self.max_age:
+                del self._db[saml2_session_id]
+        if len(self._db) > self.max_entries:
+            by_age = sorted(self._db.items(), key=lambda x: self._timestamp(x[1]))
+            for saml2_session_id, _entry in by_age[:len(self._db) - self.max_entries]:
+                del self._db[saml2_session_id]
 
     def set(self, saml2_session_id, came_from):
-        self._db[saml2_session_id] = came_from
+        now = int(time.time())
+        self._db[saml2_session_id] = {'came_from': came_from, 'ts': now}
+        self._prune(now)
         self._db.sync()
 
     def delete(self, saml2_session_id):
@@ -73,9 +223,15 @@ class IdentityCache(Cache):
     """
 
     def __init__(self, backend):
-        self._db = SessionCacheAdapter(backend, '_identities')
+        self._db = SessionCacheAdapter(_cache_backend(backend), '_identities')
         self._sync = True
 
+    def set(self, name_id, entity_id, info, not_on_or_after=0):
+        # saml2.Cache changes the value of an existing subject in place,
+        # and syncs before returning
+        self._db.mark_changed(code(name_id))
+        super(IdentityCache, self).set(name_id, entity_id, info, not_on_or_after)
+
     def delete(self, subject_id):
         super(IdentityCache, self).delete(subject_id)
         # saml2.Cache doesn't do a sync after a delete
@@ -90,4 +246,4 @@ class StateCache(SessionCacheAdapter):
     """
 
     def __init__(self, backend):
-        super(StateCache, self).__init__(backend, '_state')
+        super(StateCache, self).__init__(_cache_backend(backend), '_state')
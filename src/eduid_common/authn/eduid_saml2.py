@@ -30,16 +30,30 @@
 # POSSIBILITY OF SUCH DAMAGE.
 #
 
+import copy
 import pprint
-from saml2 import BINDING_HTTP_REDIRECT, BINDING_HTTP_POST
+import threading
+from saml2 import BINDING_HTTP_REDIRECT, BINDING_HTTP_POST, class_name
 from saml2.client import Saml2Client
-from saml2.saml import AuthnContextClassRef
+from saml2.population import Population
+from saml2.saml import Assertion, AuthnContextClassRef, Issuer
 from saml2.samlp import RequestedAuthnContext
+from saml2.sigver import pre_signature_part
+from saml2.time_util import instant
 
 from xml.etree.ElementTree import ParseError
 
-from .cache import IdentityCache, OutstandingQueriesCache, StateCache
-from .utils import get_saml2_config, get_saml_attribute
+from redis import RedisError
+
+from flask import current_app, has_app_context
+
+from eduid_common.api.exceptions import BadConfiguration
+from eduid_common.stats import NoOpStats
+from .cache import IdentityCache, OutstandingQueriesCache, StateCache, get_saml2_cache_backend
+from .cache import OUTSTANDING_QUERIES_MAX_ENTRIES, OUTSTANDING_QUERIES_MAX_AGE
+from .replay import get_replay_cache
+from .utils import get_saml2_config, get_saml_attribute, configure_crypto_backend, on_saml2_config_released
+from .verification import get_verification_pool, SAMLVerificationBusy, SAMLVerificationTimeout
 
 import logging
 logger = logging.getLogger(__name__)
@@ -49,6 +63,123 @@ class BadSAMLResponse(Exception):
     '''Bad SAML response'''
 
 
+# Fully initialized Saml2Client objects, one per SPConfig, used as templates
+# for the per request clients. {SPConfig: Saml2Client}
+_client_templates = {}
+_client_templates_lock = threading.Lock()
+
+
+def _release_client_template(saml2_config):
+    with _client_templates_lock:
+        _client_templates.pop(saml2_config, None)
+
+on_saml2_config_released(_release_client_template)
+
+
+def get_saml2_client(saml2_config, session):
+    """
+    Get a Saml2Client for the current request.
+
+    Setting up a Saml2Client (the crypto backend, which checks the xmlsec1
+    binary, and the metadata lookups) is expensive, so it is only done once
+    per SPConfig and process (and dropped when get_saml2_config replaces the
+    SPConfig with a reloaded one). The request gets a shallow copy of that
+    client, with the identity and state caches bound to the session of the
+    request.
+
+    :param saml2_config: The SAML2 SP configuration
+    :param session: Where to keep the caches, the session of the current
+                    request or the storage from get_saml2_cache_backend
+
+    :type saml2_config: saml2.config.SPConfig
+    :type session: eduid_common.api.session.Session | dict
+
+    :rtype: saml2.client.Saml2Client
+    """
+    template = _client_templates.get(saml2_config)
+    if template is None:
+        with _client_templates_lock:
+            template = _client_templates.get(saml2_config)
+            if template is None:
+                logger.debug('Initializing Saml2Client for SP {!s}'.format(saml2_config.entityid))
+                template = Saml2Client(saml2_config)
+                _client_templates[saml2_config] = template
+
+    client = copy.copy(template)
+    # Per request state, see saml2.client_base.Base.__init__
+    client.users = Population(IdentityCache(session))
+    client.state = StateCache(session)
+    client.lock = threading.Lock()
+    client.artifact2response = {}
+    return client
+
+
+def self_test_crypto_backend(client):
+    """
+    Check that the crypto backend of a Saml2Client works, by signing an
+    assertion with the SP key and verifying it with the SP certificate.
+    Without an SP key and certificate, only the availability of the
+    backend is checked.
+
+    :param client: The SAML2 client
+    :type client: saml2.client.Saml2Client
+
+    :raise BadConfiguration: if the crypto backend does not work
+    """
+    sec = client.sec
+    backend = client.config.crypto_backend
+    try:
+        version = sec.crypto.version()
+    except Exception as e:
+        raise BadConfiguration('SAML2 crypto backend {!s} not usable: {!s}'.format(backend, e))
+    key_file = client.config.key_file
+    cert_file = client.config.cert_file
+    if not key_file or not cert_file:
+        logger.info('SAML2 crypto backend {!s} ({!s}) available'.format(backend, version))
+        return
+
+    assertion_id = 'id-eduid-crypto-self-test'
+    assertion = Assertion(id=assertion_id, version='2.0', issue_instant=instant(),
+                          issuer=Issuer(text=client.config.entityid))
+    assertion.signature = pre_signature_part(assertion_id)
+    node_name = class_name(assertion)
+    try:
+        signed = sec.sign_statement(str(assertion), node_name, key_file=key_file, node_id=assertion_id)
+        verified = sec.verify_signature(signed, cert_file=cert_file, node_name=node_name, node_id=assertion_id)
+    except Exception as e:
+        raise BadConfiguration('SAML2 crypto backend {!s} self-test failed: {!s}'.format(backend, e))
+    if not verified:
+        raise BadConfiguration('SAML2 crypto backend {!s} self-test failed: signature not verified'.format(backend))
+    logger.info('SAML2 crypto backend {!s} ({!s}) self-test passed'.format(backend, version))
+
+
+def warm_up_saml2_client(config):
+    """
+    Load the SAML2 configuration and initialize the Saml2Client template at
+    app start, so that the first login after a deploy is not slow. The
+    crypto backend (SAML2_CRYPTO_BACKEND) is checked with a self-test, and
+    the verification processes (SAML2_VERIFY_PROCESSES) are started.
+
+    :param config: The app configuration
+    :type config: dict
+
+    :raise BadConfiguration: if the crypto backend does not work
+    """
+    crypto_backend = config.get('SAML2_CRYPTO_BACKEND')
+    saml2_configs = []
+    if config.get('SAML2_SETTINGS_MODULE'):
+        saml2_configs.append(get_saml2_config(config['SAML2_SETTINGS_MODULE']))
+    if config.get('SAML2_CONFIG'):
+        saml2_configs.append(config['SAML2_CONFIG'])
+    for saml2_config in saml2_configs:
+        saml2_config = configure_crypto_backend(saml2_config, crypto_backend)
+        client = get_saml2_client(saml2_config, {})
+        self_test_crypto_backend(client)
+        verification_pool = get_verification_pool(config, saml2_config)
+        if verification_pool is not None:
+            verification_pool.start()
+
+
 def get_authn_ctx(session_info):
     """
     Get the SAML2 AuthnContext of the currently logged in users session.
@@ -88,7 +219,9 @@ def get_authn_request(config, session, came_from, selected_idp,
         "force_authn": str(force_authn).lower(),
     }
 
-    client = Saml2Client(get_saml2_config(config['SAML2_SETTINGS_MODULE']))
+    saml2_config = configure_crypto_backend(get_saml2_config(config['SAML2_SETTINGS_MODULE']),
+                                            config.get('SAML2_CRYPTO_BACKEND'))
+    client = get_saml2_client(saml2_config, get_saml2_cache_backend(config, session))
     try:
         (session_id, info) = client.prepare_for_authenticate(
             entityid=selected_idp,
@@ -100,24 +233,50 @@ def get_authn_request(config, session, came_from, selected_idp,
         logger.error('Unable to know which IdP to use')
         raise
 
-    oq_cache = OutstandingQueriesCache(session)
+    oq_cache = OutstandingQueriesCache(
+        session,
+        max_entries=int(config.get('SAML2_OUTSTANDING_QUERIES_MAX_ENTRIES', OUTSTANDING_QUERIES_MAX_ENTRIES)),
+        max_age=int(config.get('SAML2_OUTSTANDING_QUERIES_MAX_AGE', OUTSTANDING_QUERIES_MAX_AGE)))
     oq_cache.set(session_id, came_from)
     return info
 
 
+def _get_stats():
+    if has_app_context():
+        return getattr(current_app, 'stats', NoOpStats())
+    return NoOpStats()
+
+
 def get_authn_response(config, session, raw_response):
 
-    client = Saml2Client(config['SAML2_CONFIG'],
-                         identity_cache=IdentityCache(session))
+    saml2_config = configure_crypto_backend(config['SAML2_CONFIG'], config.get('SAML2_CRYPTO_BACKEND'))
+    client = get_saml2_client(saml2_config, get_saml2_cache_backend(config, session))
 
     oq_cache = OutstandingQueriesCache(session)
     outstanding_queries = oq_cache.outstanding_queries()
 
+    verification_pool = get_verification_pool(config, saml2_config)
     try:
-        # process the authentication response
-        response = client.parse_authn_request_response(raw_response,
-                BINDING_HTTP_POST,
-                outstanding_queries)
+        if verification_pool is not None:
+            # parse and verify the authentication response in a worker process
+            result = verification_pool.verify_authn_response(raw_response, outstanding_queries, _get_stats())
+        else:
+            # process the authentication response. parse_authn_request_response adds the subject
+            # to the identity cache, so it gets an empty one until the assertion has been checked
+            # for replay below, like in the worker processes.
+            identity_cache = client.users
+            client.users = Population()
+            try:
+                response = client.parse_authn_request_response(raw_response,
+                        BINDING_HTTP_POST,
+                        outstanding_queries)
+                add_to_identity_cache = bool(client.users.subjects())
+            finally:
+                client.users = identity_cache
+            result = None
+            if response is not None:
+                result = (response.session_id(), response.session_info(), response.assertion.id,
+                          add_to_identity_cache)
     except AssertionError:
         logger.error('SAML response is not verified')
         raise BadSAMLResponse(
@@ -130,15 +289,35 @@ def get_authn_response(config, session, raw_response):
             """SAML response is not correctly formatted and therefore the
             XML document could not be parsed.
             """)
+    except (SAMLVerificationBusy, SAMLVerificationTimeout) as e:
+        logger.error('SAML response could not be verified: {!s}'.format(e))
+        raise BadSAMLResponse(
+            "SAML response could not be verified in time. Please try again")
 
-    if response is None:
+    if result is None:
         logger.error('SAML response is None')
         raise BadSAMLResponse(
             "SAML response has errors. Please check the logs")
 
-    session_id = response.session_id()
+    session_id, session_info, assertion_id, add_to_identity_cache = result
+
+    replay_cache = get_replay_cache(config, saml2_config)
+    if replay_cache is not None:
+        try:
+            is_new = replay_cache.check_and_record(assertion_id, session_info['issuer'])
+        except RedisError as e:
+            logger.error('Could not check SAML assertion {!s} for replay: {!r}'.format(assertion_id, e))
+            raise BadSAMLResponse(
+                "SAML response could not be verified. Please try again")
+        if not is_new:
+            logger.error('SAML assertion {!s} has already been used'.format(assertion_id))
+            _get_stats().count('saml2_replay_detected')
+            raise BadSAMLResponse(
+                "SAML response has already been used")
+
+    if add_to_identity_cache:
+        client.users.add_information_about_person(session_info)
     oq_cache.delete(session_id)
-    session_info = response.session_info()
 
     logger.debug('Session info:\n{!s}\n\n'.format(pprint.pformat(session_info)))
 
@@ -0,0 +1,777 @@
+# -*- coding: utf-8 -*-
+"""
+Pre-parsed snapshots of SAML federation metadata.
+
+Parsing and verifying the federation metadata XML takes seconds of CPU for a
+large federation, and used to be done by every worker. A snapshot is the
+metadata parsed (and its signature verified) once, stored in the JSON format
+pysaml2 reads with the `mdfile' metadata type. To use a snapshot, configure
+the SP with
+
+    SAML_CONFIG = {
+        ...
+        'metadata': {
+            'mdfile': ['/opt/eduid/metadata/swamid.json'],
+        },
+    }
+
+Snapshots are created and refreshed by eduid_common/authn/scripts/metadata_snapshot.py,
+and replaced atomically, so workers never see a partially written snapshot.
+eduid_common.authn.utils.get_saml2_config reloads the SP configuration when a
+snapshot it uses has been replaced.
+
+When the app is preloaded before forking (e.g. gunicorn --preload) and the
+SAML2 client is warmed up at app start, the loaded metadata is shared between
+the worker processes copy-on-write.
+
+Most logins go to a handful of IdPs though, so instead of holding the whole
+federation in memory a worker can look up entities on demand:
+
+ * IndexedMetaData keeps an index of entityIDs to their offsets in the
+   metadata XML file, and only parses the EntityDescriptors actually used.
+ * MDQDirectoryMetaData reads entities from a directory with one XML file per
+   entity, named like in the MDQ protocol (see split_metadata). The directory
+   can also be served to SPs on the same host as an MDQ service with mdq_app.
+
+Both only index entities covered by the verified signature of the metadata,
+and enforce its validUntil and cacheDuration.
+
+Both keep the most recently used entities in a bounded LRU cache. They are
+configured with the list style metadata configuration:
+
+    'metadata': [
+        {'class': 'eduid_common.authn.metadata.IndexedMetaData',
+         'metadata': [('/opt/eduid/metadata/swamid.xml', '/opt/eduid/metadata/md-signer2.crt')]},
+    ]
+"""
+
+from __future__ import absolute_import
+
+import os
+import re
+import mmap
+import time
+import calendar
+import hashlib
+import tempfile
+import threading
+from collections import OrderedDict
+from xml.parsers import expat
+from xml.sax.saxutils import quoteattr
+
+from saml2 import SAMLError
+from saml2 import md
+from saml2 import xmldsig
+from saml2.attribute_converter import ac_factory
+from saml2.config import SPConfig
+from saml2.mdstore import InMemoryMetaData, MetaDataFile
+from saml2.sigver import security_context
+from saml2.time_util import TIME_FORMAT, parse_duration, str_to_time
+from six import string_types
+
+import logging
+logger = logging.getLogger(__name__)
+
+
+class MetadataSnapshotError(Exception):
+    """
+    The metadata could not be verified or converted to a snapshot.
+    """
+    pass
+
+
+def load_signed_metadata(metadata_file, cert_file, xmlsec_binary=None):
+    """
+    Parse a federation metadata file, requiring a valid signature by `cert_file'.
+
+    :param metadata_file: Path to the metadata XML
+    :param cert_file: Path to the federation metadata signing certificate
+    :param xmlsec_binary: Path to xmlsec1, found in PATH if not given
+
+    :type metadata_file: str | unicode
+    :type cert_file: str | unicode
+    :type xmlsec_binary: str | unicode | None
+
+    :return: The parsed metadata
+    :rtype: saml2.mdstore.MetaDataFile
+    """
+    metadata = MetaDataFile(ac_factory(), metadata_file, cert=cert_file,
+                            security=_get_security_context(xmlsec_binary))
+    try:
+        verified = metadata.load()
+    except SAMLError as e:
+        raise MetadataSnapshotError('Failed to load metadata {!s}: {!s}'.format(metadata_file, e))
+    if not metadata.signed():
+        raise MetadataSnapshotError('Metadata {!s} is not signed'.format(metadata_file))
+    if not verified:
+        raise MetadataSnapshotError('Signature verification of metadata {!s} failed'.format(metadata_file))
+    return metadata
+
+
+def _get_security_context(xmlsec_binary=None):
+    """
+    :param xmlsec_binary: Path to xmlsec1, found in PATH if not given
+    :type xmlsec_binary: str | unicode | None
+
+    :rtype: saml2.sigver.SecurityContext
+    """
+    conf = SPConfig()
+    conf.load({'entityid': 'urn:x-eduid:metadata',
+               'xmlsec_binary': xmlsec_binary,
+               })
+    return security_context(conf)
+
+
+def write_snapshot(metadata, snapshot_file):
+    """
+    Atomically write parsed metadata as a snapshot, in the pysaml2 `mdfile' format.
+
+    :param metadata: Parsed metadata
+    :param snapshot_file: Path to the snapshot
+
+    :type metadata: saml2.mdstore.InMemoryMetaData
+    :type snapshot_file: str | unicode
+    """
+    snapshot_dir = os.path.dirname(os.path.abspath(snapshot_file))
+    fd, tmp = tempfile.mkstemp(dir=snapshot_dir, prefix='.metadata-snapshot-')
+    try:
+        with os.fdopen(fd, 'w') as f:
+            f.write(metadata.dumps())
+            f.flush()
+            os.fsync(f.fileno())
+        os.chmod(tmp, 0o644)
+        os.rename(tmp, snapshot_file)
+    except Exception:
+        os.unlink(tmp)
+        raise
+
+
+def create_snapshot(metadata_file, snapshot_file, cert_file, xmlsec_binary=None):
+    """
+    Verify and parse a federation metadata file, and write it as a snapshot.
+
+    An existing snapshot is left untouched unless the new metadata verifies.
+
+    :param metadata_file: Path to the metadata XML
+    :param snapshot_file: Path to the snapshot
+    :param cert_file: Path to the federation metadata signing certificate
+    :param xmlsec_binary: Path to xmlsec1, found in PATH if not given
+
+    :type metadata_file: str | unicode
+    :type snapshot_file: str | unicode
+    :type cert_file: str | unicode
+    :type xmlsec_binary: str | unicode | None
+
+    :return: Number of entities in the snapshot
+    :rtype: int
+    """
+    metadata = load_signed_metadata(metadata_file, cert_file, xmlsec_binary=xmlsec_binary)
+    write_snapshot(metadata, snapshot_file)
+    logger.info('Wrote metadata snapshot {!s} with {!s} entities'.format(snapshot_file, len(metadata)))
+    return len(metadata)
+
+
+def get_metadata_files(saml_config):
+    """
+    The local files a SAML_CONFIG reads metadata from.
+
+    With the dict style metadata configuration, these are the `local' and
+    `mdfile' sources. With the list style configuration, the first argument of
+    each source is used: a metadata file, or for a directory the `entities'
+    file written last by split_metadata (for MDQDirectoryMetaData) or else the
+    files in it.
+
+    :param saml_config: The SAML_CONFIG dict of a settings module
+    :type saml_config: dict
+
+    :rtype: list
+    """
+    metadata = saml_config.get('metadata', {})
+    if isinstance(metadata, dict):
+        paths = metadata.get('local', []) + metadata.get('mdfile', [])
+    else:
+        paths = []
+        for source in metadata:
+            for args in source.get('metadata', []):
+                if isinstance(args, (list, tuple)) and args:
+                    paths.append(args[0])
+    files = []
+    for path in paths:
+        if not isinstance(path, string_types):
+            continue
+        if os.path.isfile(path):
+            files.append(path)
+        elif os.path.isdir(path):
+            index_file = os.path.join(path, 'entities')
+            if os.path.isfile(index_file):
+                files.append(index_file)
+            else:
+                files.extend(sorted([os.path.join(path, x) for x in os.listdir(path)
+                                     if os.path.isfile(os.path.join(path, x))]))
+    return files
+
+
+_MD_ENTITIES = '{!s} EntitiesDescriptor'.format(md.NAMESPACE)
+_MD_ENTITY = '{!s} EntityDescriptor'.format(md.NAMESPACE)
+_DS_SIGNATURE = '{!s} Signature'.format(xmldsig.NAMESPACE)
+_DS_REFERENCE = '{!s} Reference'.format(xmldsig.NAMESPACE)
+
+
+def _parse_valid_until(value):
+    """
+    :param value: A validUntil attribute (xs:dateTime)
+    :type value: str | unicode
+
+    :return: The time as a timestamp
+    :rtype: int
+    """
+    try:
+        return calendar.timegm(str_to_time(value))
+    except (ValueError, AttributeError):
+        raise SAMLError('Invalid validUntil {!r}'.format(value))
+
+
+def _parse_cache_duration(value):
+    """
+    :param value: A cacheDuration attribute (xs:duration)
+    :type value: str | unicode
+
+    :return: The duration in seconds, counting a month as 30 days and a year as 365
+    :rtype: int
+    """
+    try:
+        sign, dur = parse_duration(value)
+    except Exception:
+        raise SAMLError('Invalid cacheDuration {!r}'.format(value))
+    if sign != '+':
+        raise SAMLError('Invalid cacheDuration {!r}'.format(value))
+    days = dur['tm_year'] * 365 + dur['tm_mon'] * 30 + dur['tm_mday']
+    return int(((days * 24 + dur['tm_hour']) * 60 + dur['tm_min']) * 60 + dur['tm_sec'])
+
+
+def _element(name):
+    """
+    :param name: Element name from expat, 'uri local prefix', 'uri local' or 'local'
+    :type name: unicode
+
+    :return: The name without the prefix
+    :rtype: unicode
+    """
+    if name.count(' ') == 2:
+        return name.rsplit(' ', 1)[0]
+    return name
+
+
+def _qname(name):
+    """
+    :param name: Element or attribute name from expat, 'uri local prefix', 'uri local' or 'local'
+    :type name: unicode
+
+    :return: The name as written in the document
+    :rtype: unicode
+    """
+    parts = name.split(' ')
+    if len(parts) == 3:
+        return u'{!s}:{!s}'.format(parts[2], parts[1])
+    return parts[-1]
+
+
+class _EntityIndexer(object):
+    """
+    expat handlers finding the EntityDescriptors of a metadata XML document.
+
+    The offsets, entityIDs and namespaces are taken from what the XML parser
+    reports, so e.g. an EntityDescriptor in a comment (not covered by the
+    signature of the document) is not indexed.
+
+    :param data: The metadata XML document
+    :param reference_time: Time the cacheDuration attributes are counted from
+
+    :type data: str | mmap.mmap
+    :type reference_time: int | float
+    """
+
+    def __init__(self, data, reference_time):
+        self.data = data
+        self.reference_time = reference_time
+        self.index = {}
+        # ID and expiration time of the root element
+        self.root_id = None
+        self.expires = None
+        # Reference URIs of the first signature in the document, if it is a child of the root element
+        self.signature_refs = None
+        self._seen_signature = False
+        self._in_signature = False
+        self._depth = 0
+        # Namespace declarations, and expiration time, in effect for each open element
+        self._scopes = [()]
+        self._expires = [None]
+        self._new_ns = []
+        self._interned = {}
+        # [entityID, qname, attributes, namespaces, expiration time, offset of the content, depth]
+        self._entity = None
+
+        self.parser = expat.ParserCreate(namespace_separator=' ')
+        self.parser.namespace_prefixes = True
+        self.parser.ordered_attributes = True
+        self.parser.StartElementHandler = self.start_element
+        self.parser.EndElementHandler = self.end_element
+        self.parser.StartNamespaceDeclHandler = self.start_namespace
+        self.parser.StartDoctypeDeclHandler = self.doctype
+
+    def parse(self, chunk_size=1024 * 1024):
+        try:
+            for pos in range(0, len(self.data), chunk_size):
+                self.parser.Parse(self.data[pos:pos + chunk_size], False)
+            self.parser.Parse(b'', True)
+        except expat.ExpatError as e:
+            raise SAMLError('Invalid metadata XML: {!s}'.format(e))
+
+    @property
+    def signed_root(self):
+        """
+        Whether the first signature of the document is a child of the root
+        element, only referencing the root element. This is the signature
+        checked by xmlsec1, and then the indexed entities are all covered by it.
+        """
+        if not self.signature_refs:
+            return False
+        for uri in self.signature_refs:
+            if uri != '' and (not self.root_id or uri != '#' + self.root_id):
+                return False
+        return True
+
+    def doctype(self, *args):
+        raise SAMLError('DTDs are not allowed in metadata')
+
+    def start_namespace(self, prefix, uri):
+        self._new_ns.append((prefix, uri))
+
+    def _set_content_handlers(self, handler):
+        self.parser.CharacterDataHandler = handler
+        self.parser.CommentHandler = handler
+        self.parser.ProcessingInstructionHandler = handler
+        self.parser.StartCdataSectionHandler = handler
+
+    def content(self, *args):
+        # The content of an EntityDescriptor starts at the first thing after its start tag.
+        # The handlers are only set while looking for it, since they are called a lot.
+        if self._entity is not None and self._entity[5] is None:
+            self._entity[5] = self.parser.CurrentByteIndex
+            self._set_content_handlers(None)
+
+    def start_element(self, name, attrs):
+        self.content()
+        scope = self._scopes[-1]
+        if self._new_ns:
+            declared = dict(scope)
+            declared.update(self._new_ns)
+            scope = tuple(sorted(declared.items(), key=lambda x: x[0] or ''))
+            scope = self._interned.setdefault(scope, scope)
+            self._new_ns = []
+        attrs = list(zip(attrs[::2], attrs[1::2]))
+        element = _element(name)
+
+        expires = self._expires[-1]
+        if element in (_MD_ENTITIES, _MD_ENTITY):
+            for attr, value in attrs:
+                if attr == 'validUntil':
+                    this = _parse_valid_until(value)
+                elif attr == 'cacheDuration':
+                    this = self.reference_time + _parse_cache_duration(value)
+                else:
+                    continue
+                expires = this if expires is None else min(expires, this)
+
+        if self._depth == 0:
+            if element not in (_MD_ENTITIES, _MD_ENTITY):
+                raise SAMLError('Not SAML metadata, the root element is {!s}'.format(_qname(name)))
+            self.root_id = dict(attrs).get('ID')
+            self.expires = expires
+        elif element == _DS_SIGNATURE and not self._seen_signature:
+            self._seen_signature = True
+            if self._depth == 1:
+                self._in_signature = True
+                self.signature_refs = []
+        elif element == _DS_REFERENCE and self._in_signature:
+            self.signature_refs.append(dict(attrs).get('URI', ''))
+
+        if element == _MD_ENTITY:
+            if self._entity is not None:
+                raise SAMLError('Nested EntityDescriptor at offset {!s}'.format(self.parser.CurrentByteIndex))
+            entity_id = dict(attrs).get('entityID')
+            if not entity_id:
+                raise SAMLError('EntityDescriptor without entityID at offset {!s}'.format(
+                    self.parser.CurrentByteIndex))
+            if entity_id in self.index:
+                raise SAMLError('Duplicate EntityDescriptor for {!s}'.format(entity_id))
+            attrs = tuple([(_qname(attr), value) for attr, value in attrs
+                           if attr not in ('validUntil', 'cacheDuration')])
+            self._entity = [entity_id, _qname(name), attrs, scope, expires, None, self._depth]
+            self._set_content_handlers(self.content)
+
+        self._scopes.append(scope)
+        self._expires.append(expires)
+        self._depth += 1
+
+    def end_element(self, name):
+        self._depth -= 1
+        self._scopes.pop()
+        self._expires.pop()
+        if self._in_signature and self._depth == 1 and _element(name) == _DS_SIGNATURE:
+            self._in_signature = False
+        if self._entity is None or self._entity[6] != self._depth:
+            return
+        entity_id, qname, attrs, scope, expires, content_start, _depth = self._entity
+        self._set_content_handlers(None)
+        pos = self.parser.CurrentByteIndex
+        if content_start is None and self.data[pos - 2:pos] == b'/>':
+            # <EntityDescriptor .../>, expat reports the end after the start tag
+            content_start = end = pos
+        else:
+            if content_start is None:
+                content_start = pos
+            end = self.data.find(b'>', pos) + 1
+        self.index[entity_id] = (qname, attrs, scope, content_start, end, expires)
+        self._entity = None
+
+
+def index_entities(data, reference_time=None):
+    """
+    Find the EntityDescriptors in a metadata XML document, parsing it with
+    expat without building the element tree.
+
+    The expiration time of an entity is the earliest of the validUntil
+    attributes of the entity and its EntitiesDescriptors, and of their
+    cacheDuration attributes counted from `reference_time'.
+
+    :param data: The metadata XML document
+    :param reference_time: Time the cacheDuration attributes are counted from, default now
+
+    :type data: str | mmap.mmap
+    :type reference_time: int | float | None
+
+    :return: {entityID: entry for _entity_xml}, whether the first signature
+             of the document covers the whole document (see
+             _EntityIndexer.signed_root), and the expiration time of the
+             document (or None)
+    :rtype: (dict, bool, int | float | None)
+    """
+    if reference_time is None:
+        reference_time = time.time()
+    indexer = _EntityIndexer(data, reference_time)
+    indexer.parse()
+    return indexer.index, indexer.signed_root, indexer.expires
+
+
+def _entity_xml(data, entry):
+    """
+    A standalone EntityDescriptor from a metadata document.
+
+    The start tag is recreated from the parsed element, with the namespace
+    declarations inherited from the enclosing elements and the expiration
+    time of the entity as validUntil (replacing validUntil and cacheDuration).
+
+    :param data: The metadata XML document
+    :param entry: The entry of the entity from index_entities
+
+    :type data: str | mmap.mmap
+    :type entry: tuple
+
+    :rtype: bytes
+    """
+    qname, attrs, namespaces, content_start, end, expires = entry
+    start_tag = [u'<', qname]
+    for prefix, uri in namespaces:
+        start_tag.append(u' xmlns:{!s}={!s}'.format(prefix, quoteattr(uri)) if prefix else
+                         u' xmlns={!s}'.format(quoteattr(uri)))
+    for attr, value in attrs:
+        start_tag.append(u' {!s}={!s}'.format(attr, quoteattr(value)))
+    if expires is not None:
+        start_tag.append(u' validUntil="{!s}"'.format(time.strftime(TIME_FORMAT, time.gmtime(int(expires)))))
+    start_tag.append(u'/>' if content_start == end else u'>')
+    return u''.join(start_tag).encode('utf-8') + data[content_start:end]
+
+
+class _LazyMetaData(InMemoryMetaData):
+    """
+    Metadata parsed one EntityDescriptor at a time, on demand, keeping
+    at most `cache_size' parsed entities.
+
+    Subclasses implement _entity_ids(), returning a container of the entityIDs,
+    and _get_entity_xml(entity_id), and optionally _expires(entity_id).
+    Entities are dropped from the cache when their validUntil has passed.
+    """
+
+    def __init__(self, attrc, cache_size=100, **kwargs):
+        super(_LazyMetaData, self).__init__(attrc, **kwargs)
+        self.cache_size = cache_size
+        # {entityID: expiration time or None}, in least recently used order
+        self._lru = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _entity_ids(self):
+        raise NotImplementedError()
+
+    def _get_entity_xml(self, entity_id):
+        raise NotImplementedError()
+
+    def _expires(self, entity_id):
+        """
+        The expiration time of an entity, if known without parsing it.
+
+        :rtype: int | float | None
+        """
+        return None
+
+    def _expired(self, expires):
+        return self.check_validity and expires is not None and expires <= time.time()
+
+    def __getitem__(self, item):
+        with self._lock:
+            if item in self._lru:
+                expires = self._lru.pop(item)
+                if not self._expired(expires):
+                    # Put back at the end, as the most recently used
+                    self._lru[item] = expires
+                    return self.entity[item]
+                del self.entity[item]
+            if self._expired(self._expires(item)):
+                raise KeyError(item)
+            entity_descr = md.entity_descriptor_from_string(self._get_entity_xml(item))
+            if entity_descr is None:
+                raise KeyError(item)
+            # Expired and filtered entities are not added by do_entity_descriptor
+            self.do_entity_descriptor(entity_descr)
+            if item not in self.entity:
+                # Not kept around, they are logged every time they are looked up
+                del self.to_old[:]
+                raise KeyError(item)
+            expires = None
+            if entity_descr.valid_until:
+                expires = _parse_valid_until(entity_descr.valid_until)
+            self._lru[item] = expires
+            while len(self._lru) > self.cache_size:
+                old, _ = self._lru.popitem(last=False)
+                del self.entity[old]
+            return self.entity[item]
+
+    def keys(self):
+        return [x for x in self._entity_ids() if not self._expired(self._expires(x))]
+
+    def items(self):
+        res = []
+        for entity_id in self.keys():
+            try:
+                res.append((entity_id, self[entity_id]))
+            except KeyError:
+                pass
+        return res
+
+    def values(self):
+        return [ent for _, ent in self.items()]
+
+    def __len__(self):
+        return len(self.keys())
+
+    def __contains__(self, item):
+        return item in self._entity_ids() and not self._expired(self._expires(item))
+
+
+class IndexedMetaData(_LazyMetaData):
+    """
+    Metadata from a federation metadata XML file, where only an index of the
+    entities is kept in memory. The file is memory mapped, and the
+    EntityDescriptors are parsed when they are used.
+
+    If a certificate is given, the signature of the file is verified when it
+    is loaded, and must cover the whole document. The file must not be
+    modified in place while in use, replace it (rename) and reload the SP
+    configuration.
+
+    The validUntil and cacheDuration attributes of the document are enforced
+    (unless check_validity is False), the latter counted from the modification
+    time of the file: loading expired metadata fails, and entities are no
+    longer found when it expires.
+    """
+
+    def __init__(self, attrc, filename, cert=None, security=None, cache_size=100, **kwargs):
+        super(IndexedMetaData, self).__init__(attrc, cache_size=cache_size, **kwargs)
+        self.filename = filename
+        self.cert = cert
+        self.security = security
+        self._index = {}
+        self._data = None
+
+    def load(self, *args, **kwargs):
+        with open(self.filename, 'rb') as fp:
+            self._data = mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ)
+            mtime = os.fstat(fp.fileno()).st_mtime
+        if self.cert:
+            if self.security is None:
+                self.security = _get_security_context()
+            node_name = '{!s}:{!s}'.format(md.EntitiesDescriptor.c_namespace, md.EntitiesDescriptor.c_tag)
+            if not self.security.verify_signature(self._data[:], node_name=node_name, cert_file=self.cert):
+                raise SAMLError('Signature verification of metadata {!s} failed'.format(self.filename))
+        index, signed_root, expires = index_entities(self._data, reference_time=mtime)
+        if self.cert and not signed_root:
+            raise SAMLError('The signature of metadata {!s} does not cover the whole document'.format(self.filename))
+        if self._expired(expires):
+            raise SAMLError('Metadata {!s} expired at {!s}'.format(
+                self.filename, time.strftime(TIME_FORMAT, time.gmtime(int(expires)))))
+        self._index = index
+        logger.debug('Indexed {!s} entities in {!s}'.format(len(self._index), self.filename))
+        return True
+
+    def _entity_ids(self):
+        return self._index
+
+    def _get_entity_xml(self, entity_id):
+        return _entity_xml(self._data, self._index[entity_id])
+
+    def _expires(self, entity_id):
+        return self._index[entity_id][5]
+
+
+def mdq_filename(entity_id):
+    """
+    File name of an entity in an MDQ directory, the sha1 transformed entityID
+    as used in MDQ requests (without the {sha1} prefix).
+
+    :type entity_id: str | unicode
+    :rtype: str
+    """
+    return '{!s}.xml'.format(hashlib.sha1(entity_id.encode('utf-8')).hexdigest())
+
+
+class MDQDirectoryMetaData(_LazyMetaData):
+    """
+    Metadata from a directory with one EntityDescriptor per file, named by
+    mdq_filename(). The directory is created with split_metadata, from
+    verified metadata.
+
+    The list of entities is read when the metadata is loaded.
+    """
+
+    def __init__(self, attrc, directory, cache_size=100, **kwargs):
+        super(MDQDirectoryMetaData, self).__init__(attrc, cache_size=cache_size, **kwargs)
+        self.directory = directory
+        self._entities = set()
+
+    def load(self, *args, **kwargs):
+        index_file = os.path.join(self.directory, 'entities')
+        with open(index_file, 'rb') as fp:
+            self._entities = set([line.rstrip(b'\n').decode('utf-8') for line in fp if line.strip()])
+        return True
+
+    def _entity_ids(self):
+        return self._entities
+
+    def _get_entity_xml(self, entity_id):
+        if entity_id not in self._entities:
+            raise KeyError(entity_id)
+        with open(os.path.join(self.directory, mdq_filename(entity_id)), 'rb') as fp:
+            return fp.read()
+
+
+def split_metadata(metadata_file, directory, cert_file, xmlsec_binary=None):
+    """
+    Verify a federation metadata file, and write its entities to one file each
+    for MDQDirectoryMetaData and mdq_app. An `entities' file lists all entityIDs.
+
+    The expiration time of each entity, from the validUntil and cacheDuration
+    of the metadata (counted from the modification time of `metadata_file'),
+    is written as its validUntil. Entities that have already expired are
+    left out.
+
+    :param metadata_file: Path to the metadata XML
+    :param directory: Directory to write the entities to
+    :param cert_file: Path to the federation metadata signing certificate
+    :param xmlsec_binary: Path to xmlsec1, found in PATH if not given
+
+    :type metadata_file: str | unicode
+    :type directory: str | unicode
+    :type cert_file: str | unicode
+    :type xmlsec_binary: str | unicode | None
+
+    :return: Number of entities written
+    :rtype: int
+    """
+    metadata = IndexedMetaData(ac_factory(), metadata_file, cert=cert_file,
+                               security=_get_security_context(xmlsec_binary))
+    try:
+        metadata.load()
+    except SAMLError as e:
+        raise MetadataSnapshotError(str(e))
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+    entity_ids = sorted(metadata.keys())
+    for entity_id in entity_ids:
+        _write_atomic(os.path.join(directory, mdq_filename(entity_id)), metadata._get_entity_xml(entity_id))
+    # Written last, so that all listed entities are present
+    _write_atomic(os.path.join(directory, 'entities'),
+                  b''.join([x.encode('utf-8') + b'\n' for x in entity_ids]))
+    return len(entity_ids)
+
+
+def _write_atomic(path, data):
+    fd, tmp = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(path)), prefix='.tmp-')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(data)
+        os.chmod(tmp, 0o644)
+        os.rename(tmp, path)
+    except Exception:
+        os.unlink(tmp)
+        raise
+
+
+def _is_loopback(address):
+    """
+    :param address: IPv4 or IPv6 address
+    :type address: str | unicode | None
+
+    :rtype: bool
+    """
+    if not address:
+        return False
+    if address.startswith('::ffff:'):
+        address = address[len('::ffff:'):]
+    return address.startswith('127.') or address == '::1'
+
+
+def mdq_app(directory):
+    """
+    A minimal MDQ service (GET /entities/{sha1}<hex>) serving a directory
+    written by split_metadata, for SPs configured with the pysaml2 `mdq'
+    metadata type on the same host.
+
+    The entities are served as written by split_metadata, without a signature,
+    so only requests from the loopback interface are answered (403 Forbidden
+    for other clients). Run the server bound to localhost; other hosts should
+    get the signed federation metadata, or a copy of the directory, instead.
+
+    :param directory: The directory written by split_metadata
+    :type directory: str | unicode
+
+    :return: WSGI application
+    """
+    def app(environ, start_response):
+        if not _is_loopback(environ.get('REMOTE_ADDR')):
+            start_response('403 Forbidden', [('Content-Type', 'text/plain')])
+            return [b'Forbidden']
+        path = environ.get('PATH_INFO', '')
+        match = re.match(r'^/entities/(?:%7[Bb]|\{)sha1(?:%7[Dd]|\})([0-9a-f]{40})$', path)
+        if environ.get('REQUEST_METHOD') != 'GET' or not match:
+            start_response('404 Not Found', [('Content-Type', 'text/plain')])
+            return [b'Not Found']
+        try:
+            with open(os.path.join(directory, '{!s}.xml'.format(match.group(1))), 'rb') as fp:
+                data = fp.read()
+        except IOError:
+            start_response('404 Not Found', [('Content-Type', 'text/plain')])
+            return [b'Not Found']
+        start_response('200 OK', [('Content-Type', 'application/samlmetadata+xml'),
+                                  ('Content-Length', str(len(data)))])
+        return [data]
+    return app
@@ -38,42 +38,134 @@ except ImportError:
 
 import re
 import logging
+import threading
+from collections import OrderedDict
 from urllib import urlencode
 
 from werkzeug import get_current_url
 from werkzeug.http import parse_cookie, dump_cookie
-from flask import Flask, session, current_app, request
+from flask import Flask, session, current_app, request, redirect
 from eduid_common.api.session import NoSessionDataFoundException
 from eduid_common.api.utils import urlappend
 
 no_context_logger = logging.getLogger(__name__)
 
 
+class NoAuthnMatcher(object):
+    """
+    Matches paths against the NO_AUTHN_URLS whitelist of regular expressions.
+
+    The whitelist is compiled once, into a single alternation. Patterns with
+    named groups or references to groups are matched one at a time, since
+    the group names and numbers change when combined. The decisions for the
+    most recently requested paths are also remembered.
+
+    :param whitelist: Regular expressions of paths not requiring authentication
+    :type whitelist: list
+    :param cache_size: Max number of path decisions to remember
+    :type cache_size: int
+    """
+
+    # Backreferences and conditionals refer to groups by number or name
+    _group_reference = re.compile(r'\\[1-9]|\(\?P=|\(\?\(')
+
+    def __init__(self, whitelist, cache_size=1000):
+        # A copy, so that changes to the whitelist are noticed by is_current
+        self.whitelist = tuple(whitelist)
+        self.cache_size = cache_size
+        self._decisions = OrderedDict()
+        self._lock = threading.Lock()
+        no_context_logger.debug('No auth whitelist: {}'.format(whitelist))
+        combinable = []
+        self._regexes = []
+        for pattern in self.whitelist:
+            regex = re.compile(pattern)
+            if regex.groupindex or (regex.groups and self._group_reference.search(pattern)):
+                self._regexes.append(regex)
+            else:
+                combinable.append(pattern)
+        if combinable:
+            try:
+                self._regexes.insert(0, re.compile('|'.join(['(?:{!s})'.format(pattern) for pattern in combinable])))
+            except (re.error, AssertionError, OverflowError):
+                # e.g. too many groups in total
+                self._regexes[:0] = [re.compile(pattern) for pattern in combinable]
+
+    def is_current(self, whitelist):
+        """
+        :return: Whether this matcher was built from whitelist, as it is now
+        :rtype: bool
+        """
+        return tuple(whitelist) == self.whitelist
+
+    def match(self, path):
+        """
+        :param path: Request path
+        :type path: str | unicode
+
+        :return: Whether path matches the whitelist
+        :rtype: bool
+        """
+        with self._lock:
+            decision = self._decisions.pop(path, None)
+            if decision is not None:
+                self._decisions[path] = decision
+                return decision
+        decision = any(regex.match(path) is not None for regex in self._regexes)
+        with self._lock:
+            self._decisions[path] = decision
+            if len(self._decisions) > self.cache_size:
+                self._decisions.popitem(last=False)
+        return decision
+
+
 class AuthnApp(Flask):
     """
-    WSGI middleware that checks whether the request is authenticated,
+    Flask app that checks whether the request is authenticated,
     and in case it isn't, redirects to the authn service.
+
+    The check runs in the request context (and with the session) used for
+    the dispatch of the request, but before any of the request handlers of
+    the app. The redirect of an unauthenticated request does not pass
+    through the before_first_request, before_request or after_request
+    functions, as when the check was done in front of the app.
     """
-    def __call__(self, environ, start_response):
-        next_url = get_current_url(environ)
-        next_path = list(urlparse.urlparse(next_url))[2]
+
+    # Built from NO_AUTHN_URLS on first use, reset by no_authn_views
+    no_authn_matcher = None
+
+    def _get_no_authn_matcher(self):
         whitelist = self.config.get('NO_AUTHN_URLS', [])
-        no_context_logger.debug('No auth whitelist: {}'.format(whitelist))
-        for regex in whitelist:
-            m = re.match(regex, next_path)
-            if m is not None:
-                no_context_logger.debug('{} matched whitelist'.format(next_path))
-                return super(AuthnApp, self).__call__(environ, start_response)
+        matcher = self.no_authn_matcher
+        if matcher is None or not matcher.is_current(whitelist):
+            matcher = NoAuthnMatcher(whitelist)
+            self.no_authn_matcher = matcher
+        return matcher
+
+    def full_dispatch_request(self):
+        response = self._check_authn()
+        if response is None:
+            return super(AuthnApp, self).full_dispatch_request()
+        # Sets the session cookie, without running the after_request functions
+        self.save_session(session, response)
+        return response
+
+    def _check_authn(self):
+        """
+        :return: A redirect to the authn service if the request is not authenticated
+        :rtype: werkzeug.wrappers.Response | None
+        """
+        next_url = get_current_url(request.environ)
+        next_path = list(urlparse.urlparse(next_url))[2]
+        if self._get_no_authn_matcher().match(next_path):
+            no_context_logger.debug('{} matched whitelist'.format(next_path))
+            return None
 
-        with self.request_context(environ):
-            try:
-                if session.get('user_eppn'):
-                    return super(AuthnApp, self).__call__(environ, start_response)
-            except NoSessionDataFoundException:
-                current_app.logger.info('Caught a NoSessionDataFoundException - forcing the user to authenticate')
-                del environ['HTTP_COOKIE']  # Force relogin
-                # If HTTP_COOKIE is not removed self.request_context(environ) below
-                # will try to look up the Session data in the backend
+        try:
+            if session.get('user_eppn'):
+                return None
+        except NoSessionDataFoundException:
+            current_app.logger.info('Caught a NoSessionDataFoundException - forcing the user to authenticate')
 
         ts_url = urlappend(self.config.get('TOKEN_SERVICE_URL'), 'login')
 
@@ -86,20 +178,8 @@ class AuthnApp(Flask):
         url_parts[4] = urlencode(query)
         location = urlparse.urlunparse(url_parts)
 
-        with self.request_context(environ):
-            cookie_name = self.config.get('SESSION_COOKIE_NAME')
-            headers = [ ('Location', location) ]
-            cookie = dump_cookie(cookie_name, session._session.token,
-                                 max_age=int(self.config.get('PERMANENT_SESSION_LIFETIME')),
-                                 path=self.config.get('SESSION_COOKIE_PATH'),
-                                 domain=self.config.get('SESSION_COOKIE_DOMAIN'),
-                                 secure=self.config.get('SESSION_COOKIE_SECURE'),
-                                 httponly=self.config.get('SESSION_COOKIE_HTTPONLY'))
-            session.persist()
-            headers.append(('Set-Cookie', cookie))
-
-            start_response('302 Found', headers)
-            return []
+        session.persist()
+        return redirect(location)
 
 
 class UnAuthnApp(Flask):
@@ -0,0 +1,146 @@
+# -*- coding: utf-8 -*-
+"""
+Detection of replayed SAML assertions.
+
+The ID of every assertion consumed by get_authn_response is recorded in Redis,
+together with the entityID of the issuing IdP (assertion IDs are only unique
+per issuer), with SET NX EX. That checks and records the ID in a single
+round trip, and lets Redis expire it when the assertion can no longer be
+valid anyway. All workers using the same Redis share the record, and a
+lookup is O(1) regardless of the number of IDs stored.
+
+Each process also remembers the IDs it has seen itself (bounded, expiring),
+so that an assertion replayed to the same process is rejected without asking
+Redis. A local miss does not tell whether another worker has seen the ID, so
+new IDs always go to Redis.
+
+Settings:
+
+    SAML2_REPLAY_CACHE:             enable the replay cache, default False
+    SAML2_REPLAY_CACHE_TTL:         seconds to remember an assertion ID, default 3600
+    SAML2_REPLAY_CACHE_LOCAL_SIZE:  max number of IDs remembered per process, default 10000
+
+The Redis connection is configured with the session settings (REDIS_HOST etc.).
+
+Metrics (see eduid_common.stats):
+
+    saml2_replay_detected   count, replayed assertions rejected
+"""
+
+from __future__ import absolute_import
+
+import time
+import threading
+from collections import OrderedDict
+
+import redis
+
+from eduid_common.authn.utils import on_saml2_config_released
+from eduid_common.session.session import get_redis_pool
+
+import logging
+logger = logging.getLogger(__name__)
+
+
+class AssertionReplayCache(object):
+    """
+    Record of consumed assertion IDs.
+
+    :param conn: Redis client
+    :param ttl: Seconds to remember an assertion ID
+    :param local_size: Max number of IDs remembered by this process
+    :param key_prefix: Prefix of the Redis keys
+
+    :type conn: redis.StrictRedis
+    :type ttl: int
+    :type local_size: int
+    :type key_prefix: str
+    """
+
+    def __init__(self, conn, ttl=3600, local_size=10000, key_prefix='saml2_assertion_'):
+        self.conn = conn
+        self.ttl = ttl
+        self.local_size = local_size
+        self.key_prefix = key_prefix
+        # {(issuer, assertion_id): expires}, oldest first
+        self._local = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _seen_locally(self, key, now):
+        with self._lock:
+            expires = self._local.get(key)
+            if expires is None:
+                return False
+            if expires > now:
+                return True
+            del self._local[key]
+            return False
+
+    def _remember(self, key, now):
+        with self._lock:
+            self._local[key] = now + self.ttl
+            while len(self._local) > self.local_size:
+                self._local.popitem(last=False)
+
+    def check_and_record(self, assertion_id, issuer):
+        """
+        Record an assertion ID as consumed.
+
+        :param assertion_id: The ID of the assertion
+        :param issuer: The entityID of the IdP issuing the assertion
+
+        :type assertion_id: str | unicode
+        :type issuer: str | unicode
+
+        :return: True if the ID was new, False if the assertion has been consumed before
+        :rtype: bool
+        """
+        now = time.time()
+        key = (issuer, assertion_id)
+        if self._seen_locally(key, now):
+            return False
+        # The assertion ID can not contain spaces (xs:ID)
+        new = self.conn.set(u'{!s}{!s} {!s}'.format(self.key_prefix, assertion_id, issuer), 1,
+                            nx=True, ex=self.ttl)
+        self._remember(key, now)
+        return bool(new)
+
+
+# {SPConfig: AssertionReplayCache}
+_replay_caches = {}
+_replay_caches_lock = threading.Lock()
+
+
+def _release_replay_cache(saml2_config):
+    with _replay_caches_lock:
+        _replay_caches.pop(saml2_config, None)
+
+on_saml2_config_released(_release_replay_cache)
+
+
+def get_replay_cache(config, saml2_config):
+    """
+    The IDs remembered by the process are dropped when get_saml2_config
+    replaces saml2_config, the record in Redis is kept.
+
+    :param config: The app configuration
+    :param saml2_config: The SAML2 SP configuration
+
+    :type config: dict
+    :type saml2_config: saml2.config.SPConfig
+
+    :return: The replay cache for saml2_config, or None if not configured
+    :rtype: AssertionReplayCache | None
+    """
+    if not config.get('SAML2_REPLAY_CACHE', False):
+        return None
+    cache = _replay_caches.get(saml2_config)
+    if cache is None:
+        with _replay_caches_lock:
+            cache = _replay_caches.get(saml2_config)
+            if cache is None:
+                conn = redis.StrictRedis(connection_pool=get_redis_pool(config))
+                cache = AssertionReplayCache(conn, ttl=int(config.get('SAML2_REPLAY_CACHE_TTL', 3600)),
+                                             local_size=int(config.get('SAML2_REPLAY_CACHE_LOCAL_SIZE', 10000)))
+                _replay_caches[saml2_config] = cache
+    return cache
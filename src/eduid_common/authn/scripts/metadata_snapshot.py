@@ -0,0 +1,105 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Create a pre-parsed snapshot of SAML federation metadata, see eduid_common.authn.metadata.
+
+The metadata signature is verified with the federation signing certificate,
+and the snapshot is only replaced if the verification succeeds. Run it from
+cron, or with --interval to keep refreshing the snapshot:
+
+    metadata_snapshot.py -m https://mds.swamid.se/md/swamid-idp.xml -c md-signer2.crt \\
+        -o /opt/eduid/metadata/swamid.json --interval 3600
+
+With --mdq, the output is instead a directory with one file per entity, for
+eduid_common.authn.metadata.MDQDirectoryMetaData and mdq_app.
+"""
+
+import os
+import sys
+import time
+import shutil
+import argparse
+import tempfile
+
+from six.moves.urllib.request import urlopen
+
+from eduid_common.authn.metadata import create_snapshot, split_metadata, MetadataSnapshotError
+
+VERBOSE = False
+
+
+def fetch_metadata(source, tmpdir):
+    """
+    :param source: Path or http(s) URL of the metadata
+    :type source: str | unicode
+    :param tmpdir: Directory to download remote metadata to
+    :type tmpdir: str | unicode
+
+    :return: Path to a local copy of the metadata
+    :rtype: str | unicode
+    """
+    if not source.startswith(('http://', 'https://')):
+        return source
+    if VERBOSE:
+        print('Fetching metadata from {!s}'.format(source))
+    local_file = os.path.join(tmpdir, 'metadata.xml')
+    response = urlopen(source, timeout=60)
+    try:
+        with open(local_file, 'wb') as f:
+            shutil.copyfileobj(response, f)
+    finally:
+        response.close()
+    return local_file
+
+
+def refresh(source, snapshot_file, cert_file, xmlsec_binary=None, mdq=False):
+    """
+    :return: True if the snapshot was refreshed
+    :rtype: bool
+    """
+    tmpdir = tempfile.mkdtemp()
+    try:
+        metadata_file = fetch_metadata(source, tmpdir)
+        t0 = time.time()
+        if mdq:
+            entities = split_metadata(metadata_file, snapshot_file, cert_file, xmlsec_binary=xmlsec_binary)
+        else:
+            entities = create_snapshot(metadata_file, snapshot_file, cert_file, xmlsec_binary=xmlsec_binary)
+        if VERBOSE:
+            print('Wrote {!s} entities to {!s} in {:.1f}s'.format(entities, snapshot_file, time.time() - t0))
+        return True
+    except (IOError, MetadataSnapshotError) as e:
+        sys.stderr.writelines('Snapshot not refreshed: {!s}\n'.format(e))
+        return False
+    finally:
+        shutil.rmtree(tmpdir)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Create a pre-parsed SAML metadata snapshot.')
+    parser.add_argument('-m', '--metadata', required=True, help='Path or URL of the federation metadata.')
+    parser.add_argument('-c', '--cert', required=True, help='Path to the metadata signing certificate.')
+    parser.add_argument('-o', '--output', required=True, help='Path to the snapshot file.')
+    parser.add_argument('--xmlsec', help='Path to the xmlsec1 binary.')
+    parser.add_argument('--mdq', action='store_true', default=False,
+                        help='Write one file per entity to the output directory.')
+    parser.add_argument('-i', '--interval', default=0, type=int,
+                        help='Seconds between refreshes, 0 to create the snapshot once and exit.')
+    parser.add_argument('-v', '--verbose', action='store_true', default=False)
+    args = parser.parse_args()
+
+    if args.verbose:
+        global VERBOSE
+        VERBOSE = True
+
+    if not args.interval:
+        if not refresh(args.metadata, args.output, args.cert, args.xmlsec, args.mdq):
+            sys.exit(1)
+        return
+
+    while True:
+        refresh(args.metadata, args.output, args.cert, args.xmlsec, args.mdq)
+        time.sleep(args.interval)
+
+if __name__ == '__main__':
+    main()
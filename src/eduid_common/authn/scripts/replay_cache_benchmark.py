@@ -0,0 +1,118 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Measure the lookup rate of the SAML assertion replay cache
+(eduid_common.authn.replay) with a large number of stored assertion IDs.
+
+The Redis connection is configured with a yaml file with the session
+settings (see redis_transport_benchmark.py), e.g.
+
+    replay_cache_benchmark.py redis.yaml --stored 1000000 --stored 5000000
+
+For each --stored count, that many assertion IDs are first recorded in Redis
+(pipelined, untimed), and then the rate of check_and_record calls is measured
+for new IDs (the common case, one SET NX round trip each), for IDs recorded
+by another process (one round trip) and for IDs already seen by this process
+(answered locally). Redis memory use is reported after filling.
+
+The keys are written under a separate prefix and expire after --ttl seconds.
+"""
+
+import os
+import sys
+import time
+import argparse
+
+import redis
+import yaml
+
+from eduid_common.authn.replay import AssertionReplayCache
+from eduid_common.session.session import get_redis_pool
+
+
+def load_yaml(file_path):
+    """
+    :param file_path: Full path to a file with Redis configuration in yaml
+    :type file_path: str | unicode
+
+    :return: dict representation of the yaml
+    :rtype: dict
+    """
+    try:
+        with open(file_path) as f:
+            return yaml.safe_load(f)
+    except IOError as e:
+        sys.stderr.writelines(str(e) + '\n')
+        sys.exit(1)
+
+
+def new_ids(count):
+    # Assertion IDs are typically 'id-' or '_' followed by 32-40 hex digits
+    return ['_{!s}'.format(os.urandom(20).encode('hex')) for _ in range(count)]
+
+
+def fill(conn, key_prefix, count, ttl, batch_size=10000):
+    """
+    Record count random assertion IDs in Redis.
+
+    :return: A sample of the recorded IDs
+    :rtype: list
+    """
+    sample = []
+    for start in range(0, count, batch_size):
+        ids = new_ids(min(batch_size, count - start))
+        pipe = conn.pipeline(transaction=False)
+        for assertion_id in ids:
+            pipe.set(key_prefix + assertion_id, 1, nx=True, ex=ttl)
+        pipe.execute()
+        if len(sample) < 10000:
+            sample.extend(ids[:100])
+    return sample
+
+
+def lookup_rate(cache, ids):
+    """
+    :return: check_and_record calls per second
+    :rtype: float
+    """
+    t0 = time.time()
+    for assertion_id in ids:
+        cache.check_and_record(assertion_id)
+    return len(ids) / (time.time() - t0)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the SAML assertion replay cache.')
+    parser.add_argument('configuration', help='Path to a yaml file with Redis configuration.')
+    parser.add_argument('-s', '--stored', action='append', type=int,
+                        help='Number of stored assertion IDs, can be repeated. Default: 1000000.')
+    parser.add_argument('-n', '--lookups', default=10000, type=int, help='Number of lookups per measurement.')
+    parser.add_argument('--ttl', default=600, type=int, help='Expiry of the stored IDs, in seconds.')
+    args = parser.parse_args()
+
+    conn = redis.StrictRedis(connection_pool=get_redis_pool(load_yaml(args.configuration)))
+    key_prefix = 'saml2_replay_benchmark_{!s}_'.format(os.getpid())
+    print('{:>12} {:>12} {:>15} {:>15} {:>15}'.format('stored', 'memory MB', 'new/s', 'other proc/s', 'local/s'))
+    stored = 0
+    try:
+        for count in sorted(args.stored or [1000000]):
+            sample = fill(conn, key_prefix, count - stored, args.ttl)
+            stored = count
+            memory = conn.info('memory')['used_memory'] / (1024.0 * 1024)
+
+            cache = AssertionReplayCache(conn, ttl=args.ttl, local_size=args.lookups,
+                                         key_prefix=key_prefix)
+            new_rate = lookup_rate(cache, new_ids(args.lookups))
+            stored += args.lookups
+            # Recorded by another process, i.e. not seen by this cache
+            known = sample[:args.lookups]
+            other_rate = lookup_rate(cache, known)
+            local_rate = lookup_rate(cache, known)
+            print('{:>12} {:>12.1f} {:>15.0f} {:>15.0f} {:>15.0f}'.format(
+                count, memory, new_rate, other_rate, local_rate))
+    except redis.RedisError as e:
+        sys.stderr.writelines('{!s}\n'.format(e))
+        sys.exit(1)
+
+if __name__ == '__main__':
+    main()
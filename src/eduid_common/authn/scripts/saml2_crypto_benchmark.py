@@ -0,0 +1,186 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Measure how many SAML authentication responses per second and core the ACS
+can verify with each pysaml2 crypto backend (see SAML2_CRYPTO_BACKEND).
+
+A throw-away IdP key, certificate and metadata are generated, and the canned
+response from eduid_common.authn.tests.responses is signed with them. The
+signed responses are then parsed and verified like in get_authn_response:
+
+    saml2_crypto_benchmark.py -b xmlsec1 -b XMLSecurity -n 500
+
+With --processes, that many processes verify responses in parallel, to
+measure the scaling over the cores.
+"""
+
+import os
+import sys
+import time
+import base64
+import shutil
+import argparse
+import datetime
+import tempfile
+import multiprocessing
+
+from cryptography import x509
+from cryptography.hazmat.backends import default_backend
+from cryptography.hazmat.primitives import hashes, serialization
+from cryptography.hazmat.primitives.asymmetric import rsa
+from cryptography.x509.oid import NameOID
+from saml2 import BINDING_HTTP_POST, class_name
+from saml2.client import Saml2Client
+from saml2.config import SPConfig
+from saml2.samlp import response_from_string
+from saml2.sigver import pre_signature_part
+
+from eduid_common.authn.eduid_saml2 import self_test_crypto_backend
+from eduid_common.authn.tests.responses import auth_response
+
+IDP_ENTITYID = 'https://idp.example.com/simplesaml/saml2/idp/metadata.php'
+SP_BASEURL = 'http://test.localhost:6544/'
+
+IDP_METADATA = """<?xml version="1.0" encoding="UTF-8"?>
+<md:EntityDescriptor xmlns:md="urn:oasis:names:tc:SAML:2.0:metadata"
+                     xmlns:ds="http://www.w3.org/2000/09/xmldsig#" entityID="{entityid}">
+  <md:IDPSSODescriptor protocolSupportEnumeration="urn:oasis:names:tc:SAML:2.0:protocol">
+    <md:KeyDescriptor use="signing">
+      <ds:KeyInfo><ds:X509Data><ds:X509Certificate>{cert}</ds:X509Certificate></ds:X509Data></ds:KeyInfo>
+    </md:KeyDescriptor>
+    <md:SingleSignOnService Binding="urn:oasis:names:tc:SAML:2.0:bindings:HTTP-Redirect"
+                            Location="https://idp.example.com/sso"/>
+  </md:IDPSSODescriptor>
+</md:EntityDescriptor>
+"""
+
+
+def generate_idp(tmpdir):
+    """
+    Generate a key, a self-signed certificate and metadata for the test IdP.
+
+    :return: Paths to the key, certificate and metadata files
+    :rtype: (str, str, str)
+    """
+    key = rsa.generate_private_key(public_exponent=65537, key_size=2048, backend=default_backend())
+    name = x509.Name([x509.NameAttribute(NameOID.COMMON_NAME, u'idp.example.com')])
+    now = datetime.datetime.utcnow()
+    cert = x509.CertificateBuilder().subject_name(name).issuer_name(name).public_key(key.public_key()) \
+        .serial_number(1).not_valid_before(now - datetime.timedelta(days=1)) \
+        .not_valid_after(now + datetime.timedelta(days=30)) \
+        .sign(key, hashes.SHA256(), default_backend())
+
+    key_file = os.path.join(tmpdir, 'idp.key')
+    cert_file = os.path.join(tmpdir, 'idp.crt')
+    metadata_file = os.path.join(tmpdir, 'idp.xml')
+    with open(key_file, 'wb') as f:
+        f.write(key.private_bytes(serialization.Encoding.PEM, serialization.PrivateFormat.TraditionalOpenSSL,
+                                  serialization.NoEncryption()))
+    cert_pem = cert.public_bytes(serialization.Encoding.PEM)
+    with open(cert_file, 'wb') as f:
+        f.write(cert_pem)
+    cert_body = b''.join([x for x in cert_pem.splitlines() if not x.startswith(b'-----')])
+    with open(metadata_file, 'w') as f:
+        f.write(IDP_METADATA.format(entityid=IDP_ENTITYID, cert=cert_body.decode('ascii')))
+    return key_file, cert_file, metadata_file
+
+
+def get_sp_config(crypto_backend, metadata_file, key_file=None, cert_file=None):
+    conf = SPConfig()
+    conf.load({
+        'entityid': '{!s}saml2-metadata'.format(SP_BASEURL),
+        'crypto_backend': crypto_backend,
+        'key_file': key_file,
+        'cert_file': cert_file,
+        'service': {
+            'sp': {
+                'endpoints': {
+                    'assertion_consumer_service': [('{!s}saml2-acs'.format(SP_BASEURL), BINDING_HTTP_POST)],
+                },
+                'want_response_signed': True,
+            },
+        },
+        'metadata': {'local': [metadata_file]},
+    })
+    return conf
+
+
+def signed_responses(client, key_file, count):
+    """
+    :return: Base64 encoded, signed responses and the session ids they respond to
+    :rtype: list
+    """
+    res = []
+    for i in range(count):
+        session_id = 'id-{!s}'.format(os.urandom(8).encode('hex'))
+        response = response_from_string(auth_response(session_id, 'user{!s}@example.com'.format(i)))
+        response.signature = pre_signature_part(response.id)
+        signed = client.sec.sign_statement(str(response), class_name(response), key_file=key_file,
+                                           node_id=response.id)
+        res.append((base64.b64encode(signed.encode('utf-8') if not isinstance(signed, bytes) else signed),
+                    session_id))
+    return res
+
+
+_bench_client = None
+_bench_responses = None
+
+
+def _verify_all(_arg):
+    t0 = time.time()
+    for raw_response, session_id in _bench_responses:
+        response = _bench_client.parse_authn_request_response(raw_response, BINDING_HTTP_POST, {session_id: '/'})
+        if response is None:
+            raise RuntimeError('Response not verified')
+    return time.time() - t0
+
+
+def run_backend(crypto_backend, idp, count, processes):
+    """
+    :return: Responses verified per second, in total and per process
+    :rtype: (float, float)
+    """
+    global _bench_client, _bench_responses
+    key_file, cert_file, metadata_file = idp
+    # The IdP key doubles as SP key, for the self-test
+    _bench_client = Saml2Client(get_sp_config(crypto_backend, metadata_file, key_file, cert_file))
+    self_test_crypto_backend(_bench_client)
+    _bench_responses = signed_responses(_bench_client, key_file, count)
+    _verify_all(None)  # warm up
+
+    if processes > 1:
+        pool = multiprocessing.Pool(processes)
+        t0 = time.time()
+        pool.map(_verify_all, range(processes))
+        elapsed = time.time() - t0
+        pool.terminate()
+    else:
+        elapsed = _verify_all(None)
+    total = count * processes / elapsed
+    return total, total / processes
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark SAML response verification per crypto backend.')
+    parser.add_argument('-b', '--backend', action='append', choices=['xmlsec1', 'XMLSecurity'],
+                        help='Crypto backend to benchmark, can be repeated. Default: all.')
+    parser.add_argument('-n', '--responses', default=200, type=int, help='Responses to verify per process.')
+    parser.add_argument('-p', '--processes', default=1, type=int, help='Number of parallel processes.')
+    args = parser.parse_args()
+
+    tmpdir = tempfile.mkdtemp()
+    try:
+        idp = generate_idp(tmpdir)
+        print('{:<15} {:>10} {:>15} {:>20}'.format('backend', 'processes', 'responses/s', 'responses/s/process'))
+        for backend in args.backend or ['xmlsec1', 'XMLSecurity']:
+            try:
+                total, per_process = run_backend(backend, idp, args.responses, args.processes)
+            except Exception as e:
+                sys.stderr.writelines('{!s}: {!s}\n'.format(backend, e))
+                continue
+            print('{:<15} {:>10} {:>15.1f} {:>20.1f}'.format(backend, args.processes, total, per_process))
+    finally:
+        shutil.rmtree(tmpdir)
+
+if __name__ == '__main__':
+    main()
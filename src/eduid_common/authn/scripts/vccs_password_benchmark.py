@@ -0,0 +1,187 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Measure the throughput and latency of the password flows in
+eduid_common.authn.vccs (check_password, change_password, reset_password)
+at different levels of concurrency, with a real VCCS client talking HTTP.
+
+By default a local VCCS stand-in server (eduid_common.authn.testing.VCCSStandInServer)
+is started in this process, e.g.
+
+    vccs_password_benchmark.py -c 1 -c 8 -c 64 --flow check
+
+Use --vccs-url to benchmark against a VCCS backend, or a stand-in running
+elsewhere, instead. The users are created for the benchmark, and their
+passwords are left in the backend.
+
+For each concurrency level, that many threads run the flow for one user each,
+like the request threads of a web worker. The options --check-threads,
+--factor-processes, --pool-size and --max-concurrent set up the password
+checks, password factor pool and VCCS clients like the corresponding
+VCCS_* settings of an app, for comparing them.
+"""
+
+import sys
+import time
+import argparse
+import threading
+from copy import deepcopy
+
+from bson import ObjectId
+from eduid_userdb.credentials import Password
+from eduid_userdb.data_samples import NEW_USER_EXAMPLE
+from eduid_userdb.user import User
+
+from eduid_common.authn import vccs
+from eduid_common.authn.testing import VCCSStandInServer
+from eduid_common.authn.vccs_guard import configure_vccs_guard
+from eduid_common.authn.vccs_hashing import configure_factor_pool
+from eduid_common.authn.vccs_pool import configure_vccs_clients
+
+FLOWS = ['check', 'change', 'reset']
+
+
+def percentile(values, pct):
+    """
+    :param values: Sorted list of values
+    :type values: list
+    :param pct: Percentile, 0-100
+    :type pct: int
+
+    :rtype: float
+    """
+    idx = min(len(values) - 1, int(round(pct / 100.0 * (len(values) - 1))))
+    return values[idx]
+
+
+class BenchmarkUser(object):
+    """
+    A user with passwords in the VCCS backend, and the plaintext of the first one.
+    """
+
+    def __init__(self, vccs_url, client, num_passwords):
+        data = deepcopy(NEW_USER_EXAMPLE)
+        data['_id'] = ObjectId()
+        data['eduPersonPrincipalName'] = 'bench-{!s}'.format(data['_id'])
+        self.user = User(data=data)
+        for password in self.user.credentials.filter(Password).to_list():
+            self.user.credentials.remove(password.key)
+        self.vccs_url = vccs_url
+        self.client = client
+        self.generation = 0
+        self.password = None
+        for _ in range(num_passwords):
+            self._add_password()
+
+    def _new_password(self):
+        self.generation += 1
+        return '{!s}-password-{!s}'.format(self.user.eppn, self.generation)
+
+    def _add_password(self):
+        password = self._new_password()
+        if not vccs.add_password(self.user, password, 'benchmark', vccs_url=self.vccs_url, vccs=self.client):
+            raise RuntimeError('Failed adding password')
+        if self.password is None:
+            self.password = password
+
+    def check(self):
+        return bool(vccs.check_password(self.vccs_url, self.password, self.user, vccs=self.client))
+
+    def change(self):
+        new_password = self._new_password()
+        if not vccs.change_password(self.user, new_password, self.password, 'benchmark', vccs_url=self.vccs_url,
+                                    vccs=self.client):
+            return False
+        self.password = new_password
+        return True
+
+    def reset(self):
+        new_password = self._new_password()
+        if not vccs.reset_password(self.user, new_password, 'benchmark', vccs_url=self.vccs_url,
+                                   vccs=self.client):
+            return False
+        self.password = new_password
+        return True
+
+
+def run_flow(users, flow, operations):
+    """
+    Run operations flows evenly spread over one thread per user.
+
+    :return: Operations per second, latencies in milliseconds (sorted) and number of errors
+    :rtype: (float, list, int)
+    """
+    timings = []
+    errors = []
+    per_user = max(1, operations // len(users))
+
+    def worker(user):
+        for _ in range(per_user):
+            t0 = time.time()
+            try:
+                ok = getattr(user, flow)()
+            except Exception as e:
+                sys.stderr.writelines('{!s}: {!r}\n'.format(flow, e))
+                ok = False
+            timings.append((time.time() - t0) * 1000)
+            if not ok:
+                errors.append(1)
+
+    threads = [threading.Thread(target=worker, args=(user,)) for user in users]
+    t0 = time.time()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.time() - t0
+    return len(timings) / elapsed, sorted(timings), len(errors)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the VCCS password flows.')
+    parser.add_argument('-c', '--concurrency', action='append', type=int,
+                        help='Number of concurrent threads, can be repeated. Default: 1, 2, 4, 8, 16, 32, 64.')
+    parser.add_argument('-f', '--flow', action='append', choices=FLOWS,
+                        help='Password flow to benchmark, can be repeated. Default: all.')
+    parser.add_argument('-n', '--operations', default=256, type=int, help='Operations per measurement.')
+    parser.add_argument('--passwords', default=1, type=int, help='Number of passwords per user.')
+    parser.add_argument('--vccs-url', help='URL of a VCCS backend. Default: start a local stand-in.')
+    parser.add_argument('--kdf-iterations', default=50000, type=int,
+                        help='PBKDF2 iterations per factor in the local stand-in.')
+    parser.add_argument('--check-threads', default=0, type=int, help='Like VCCS_CHECK_THREADS.')
+    parser.add_argument('--factor-processes', default=0, type=int, help='Like VCCS_FACTOR_PROCESSES.')
+    parser.add_argument('--pool-size', default=None, type=int,
+                        help='Like VCCS_POOL_SIZE. Default: the highest concurrency.')
+    parser.add_argument('--max-concurrent', default=0, type=int, help='Like VCCS_MAX_CONCURRENT.')
+    args = parser.parse_args()
+
+    levels = sorted(args.concurrency or [1, 2, 4, 8, 16, 32, 64])
+    configure_vccs_clients(pool_size=args.pool_size or levels[-1])
+    configure_vccs_guard(max_concurrent=args.max_concurrent)
+    vccs.configure_password_checks(args.check_threads)
+    configure_factor_pool(args.factor_processes, queue_size=max(levels) * args.passwords)
+
+    server = None
+    vccs_url = args.vccs_url
+    if vccs_url is None:
+        server = VCCSStandInServer(kdf_iterations=args.kdf_iterations)
+        server.start()
+        vccs_url = server.url
+    try:
+        client = vccs.get_vccs_client(vccs_url)
+        users = [BenchmarkUser(vccs_url, client, args.passwords) for _ in range(levels[-1])]
+        print('{:<8} {:>12} {:>10} {:>10} {:>10} {:>10} {:>8}'.format(
+            'flow', 'concurrency', 'ops/s', 'p50 ms', 'p90 ms', 'p99 ms', 'errors'))
+        for flow in args.flow or FLOWS:
+            for level in levels:
+                rate, timings, errors = run_flow(users[:level], flow, args.operations)
+                print('{:<8} {:>12} {:>10.1f} {:>10.1f} {:>10.1f} {:>10.1f} {:>8}'.format(
+                    flow, level, rate, percentile(timings, 50), percentile(timings, 90),
+                    percentile(timings, 99), errors))
+    finally:
+        configure_factor_pool(0)
+        if server is not None:
+            server.stop()
+
+if __name__ == '__main__':
+    main()
@@ -31,8 +31,14 @@
 #
 
 import json
+import time
+import socket
+import hashlib
+import threading
 
 from bson import ObjectId
+from six.moves import BaseHTTPServer, socketserver
+from six.moves.urllib.parse import parse_qs
 import vccs_client
 from eduid_userdb.credentials import Password
 from eduid_userdb.dashboard import DashboardLegacyUser, DashboardUser
@@ -136,6 +142,144 @@ class TestVCCSClient(object):
                         break
 
 
+class _VCCSStandInHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+
+    protocol_version = 'HTTP/1.1'
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers['Content-Length']))
+        handler = {
+            '/authenticate': self.server.authenticate,
+            '/add_creds': self.server.add_credentials,
+            '/revoke_creds': self.server.revoke_credentials,
+        }.get(self.path)
+        status, data = 404, 'Not found'
+        if handler is not None:
+            try:
+                request = json.loads(parse_qs(body)['request'][0])
+                status, data = 200, json.dumps(handler(request))
+            except (KeyError, ValueError) as exc:
+                status, data = 500, 'Bad request: {!r}'.format(exc)
+        self.send_response(status)
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, *args):
+        pass
+
+
+class VCCSStandInServer(socketserver.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    """
+    Local HTTP server speaking the VCCS backend protocol, for measuring the
+    password flows with a real VCCS client (see
+    eduid_common.authn.scripts.vccs_password_benchmark) without a VCCS backend.
+
+    The password factors are stored in memory, after a PBKDF2 key derivation
+    with kdf_iterations rounds standing in for the hashing done by the backend.
+    As in the backend, all factors of a request must match to authenticate,
+    and revoking an unknown credential is an error.
+
+        server = VCCSStandInServer()
+        server.start()
+        client = vccs_client.VCCSClient(base_url=server.url)
+        ...
+        server.stop()
+
+    :param port: Port to listen on, 0 for any free port
+    :param kdf_iterations: PBKDF2 iterations per password factor
+
+    :type port: int
+    :type kdf_iterations: int
+    """
+
+    daemon_threads = True
+
+    def __init__(self, port=0, kdf_iterations=1):
+        BaseHTTPServer.HTTPServer.__init__(self, ('127.0.0.1', port), _VCCSStandInHandler)
+        self.kdf_iterations = kdf_iterations
+        # {user_id: {credential_id: H2}}
+        self.credentials = {}
+        self._lock = threading.Lock()
+        self._thread = None
+        # Connections kept alive by the clients
+        self._connections = set()
+
+    @property
+    def url(self):
+        return 'http://127.0.0.1:{!s}/'.format(self.server_port)
+
+    def start(self):
+        self._thread = threading.Thread(target=self.serve_forever)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+        self._thread.join()
+        with self._lock:
+            connections = list(self._connections)
+        for connection in connections:
+            try:
+                connection.shutdown(socket.SHUT_RDWR)
+            except socket.error:
+                pass
+        # Let the request threads finish before the interpreter possibly exits
+        for _ in range(100):
+            with self._lock:
+                if not self._connections:
+                    break
+            time.sleep(0.01)
+
+    def process_request(self, request, client_address):
+        with self._lock:
+            self._connections.add(request)
+        socketserver.ThreadingMixIn.process_request(self, request, client_address)
+
+    def shutdown_request(self, request):
+        with self._lock:
+            self._connections.discard(request)
+        BaseHTTPServer.HTTPServer.shutdown_request(self, request)
+
+    def _hash(self, user_id, factor):
+        salt = '{!s}{!s}'.format(user_id, factor['credential_id'])
+        return hashlib.pbkdf2_hmac('sha512', factor['H1'].encode('ascii'), salt.encode('utf-8'),
+                                   self.kdf_iterations)
+
+    def authenticate(self, request):
+        request = request['auth']
+        user_id = request['user_id']
+        hashes = [(factor['credential_id'], self._hash(user_id, factor)) for factor in request['factors']]
+        with self._lock:
+            stored = self.credentials.get(user_id, {})
+            authenticated = bool(hashes) and all(stored.get(credential_id) == h2 for credential_id, h2 in hashes)
+        return {'auth_response': {'version': 1, 'authenticated': authenticated}}
+
+    def add_credentials(self, request):
+        request = request['add_creds']
+        user_id = request['user_id']
+        hashes = [(factor['credential_id'], self._hash(user_id, factor)) for factor in request['factors']]
+        with self._lock:
+            stored = self.credentials.setdefault(user_id, {})
+            if any(credential_id in stored for credential_id, _h2 in hashes):
+                return {'add_creds_response': {'version': 1, 'success': False}}
+            stored.update(hashes)
+        return {'add_creds_response': {'version': 1, 'success': True}}
+
+    def revoke_credentials(self, request):
+        request = request['revoke_creds']
+        credential_ids = [factor['credential_id'] for factor in request['factors']]
+        with self._lock:
+            stored = self.credentials.get(request['user_id'], {})
+            unknown = [credential_id for credential_id in credential_ids if credential_id not in stored]
+            if unknown:
+                raise KeyError('Unknown credentials {!r}'.format(unknown))
+            for credential_id in credential_ids:
+                del stored[credential_id]
+        return {'revoke_creds_response': {'version': 1, 'success': True}}
+
+
 def provision_credentials(vccs_url, new_password, user,
                           vccs=None, source='dashboard'):
     """
@@ -31,11 +31,37 @@
 #
 import unittest
 
+from flask import Flask
+from mock import patch
+from saml2.saml import NameID
+
 from eduid_common.authn.cache import (SessionCacheAdapter,
                                         OutstandingQueriesCache,
                                         IdentityCache, StateCache)
 
 
+class FakeRequestSession(dict):
+    """
+    Session with commit hooks, like eduid_common.session.request_session.RequestSession
+    """
+
+    def __init__(self, *args, **kwargs):
+        super(FakeRequestSession, self).__init__(*args, **kwargs)
+        self.hooks = []
+        self.writes = 0
+
+    def __setitem__(self, key, value):
+        super(FakeRequestSession, self).__setitem__(key, value)
+        self.writes += 1
+
+    def add_commit_hook(self, callback):
+        self.hooks.append(callback)
+
+    def commit(self):
+        while self.hooks:
+            self.hooks.pop(0)()
+
+
 class pyramidSessionCacheAdapterTests(unittest.TestCase):
 
     def test_init(self):
@@ -81,6 +107,40 @@ class pyramidSessionCacheAdapterTests(unittest.TestCase):
         psca.sync()
         self.assertEqual(psca._get_objects(), {'onekey': 'onevalue'})
 
+    def test_sync_only_changed_keys(self):
+        fake_session_dict = {
+            '_saml2saml2': {'onekey': 'onevalue', 'twokey': 'twovalue'},
+        }
+        psca = SessionCacheAdapter(fake_session_dict, 'saml2')
+        psca2 = SessionCacheAdapter(fake_session_dict, 'saml2')
+
+        psca['threekey'] = 'threevalue'
+        psca.sync()
+        del psca2['onekey']
+        psca2.sync()
+
+        self.assertEqual(psca._get_objects(), {'twokey': 'twovalue', 'threekey': 'threevalue'})
+
+    def test_sync_deferred_to_commit(self):
+        session = FakeRequestSession()
+        oqc = OutstandingQueriesCache(session)
+        oqc.set('session_id', '/next')
+        oqc.set('session_id2', '/next2')
+        oqc.delete('session_id')
+        self.assertEqual(session.writes, 0)
+        self.assertEqual(oqc.outstanding_queries(), {'session_id2': '/next2'})
+
+        session.commit()
+        self.assertEqual(session.writes, 1)
+        self.assertEqual(OutstandingQueriesCache(session).outstanding_queries(), {'session_id2': '/next2'})
+
+    def test_no_changes_no_write(self):
+        session = FakeRequestSession({'_saml2_state': {'id': {'entity_id': 'idp'}}})
+        state = StateCache(session)
+        state.sync()
+        session.commit()
+        self.assertEqual(session.writes, 0)
+
 
 class OutstandingQueriesCacheTests(unittest.TestCase):
 
@@ -116,6 +176,49 @@ class OutstandingQueriesCacheTests(unittest.TestCase):
 
         self.assertEqual(oqc.outstanding_queries(), {})
 
+    def test_set_stores_timestamp(self):
+        session = {}
+        oqc = OutstandingQueriesCache(session)
+        with patch('eduid_common.authn.cache.time.time', return_value=1000):
+            oqc.set('session_id', '/next')
+        self.assertEqual(session['_saml2_outstanding_queries'],
+                         {'session_id': {'came_from': '/next', 'ts': 1000}})
+
+    def test_prune_by_age(self):
+        oqc = OutstandingQueriesCache({}, max_age=60)
+        with patch('eduid_common.authn.cache.time.time', return_value=1000):
+            oqc.set('old', '/old')
+        with patch('eduid_common.authn.cache.time.time', return_value=1030):
+            oqc.set('recent', '/recent')
+        with patch('eduid_common.authn.cache.time.time', return_value=1070):
+            oqc.set('new', '/new')
+        self.assertEqual(oqc.outstanding_queries(), {'recent': '/recent', 'new': '/new'})
+
+    def test_max_entries(self):
+        oqc = OutstandingQueriesCache({}, max_entries=3)
+        for i in range(10):
+            with patch('eduid_common.authn.cache.time.time', return_value=1000 + i):
+                oqc.set('session_id_{!s}'.format(i), '/next')
+        self.assertEqual(sorted(oqc.outstanding_queries().keys()),
+                         ['session_id_7', 'session_id_8', 'session_id_9'])
+
+    def test_legacy_entries(self):
+        session = {'_saml2_outstanding_queries': {'legacy1': '/one', 'legacy2': '/two'}}
+        oqc = OutstandingQueriesCache(session, max_entries=2)
+        self.assertEqual(oqc.outstanding_queries(), {'legacy1': '/one', 'legacy2': '/two'})
+        oqc.set('session_id', '/next')
+        queries = oqc.outstanding_queries()
+        self.assertEqual(len(queries), 2)
+        self.assertEqual(queries['session_id'], '/next')
+        oqc.delete('session_id')
+        self.assertEqual(len(oqc.outstanding_queries()), 1)
+
+
+class FakeSubSessions(dict):
+
+    def sub_session(self, namespace):
+        return self.setdefault(namespace, {})
+
 
 class IdentityCacheTests(unittest.TestCase):
 
@@ -124,3 +227,38 @@ class IdentityCacheTests(unittest.TestCase):
 
         self.assertIsInstance(ic._db, SessionCacheAdapter)
         self.assertTrue(ic._sync, True)
+
+    def test_set_existing_subject(self):
+        session = FakeRequestSession()
+        ic = IdentityCache(session)
+        ic.set(NameID(text='subject'), 'https://idp1.example.com', {'uid': ['one']})
+        session.commit()
+
+        ic = IdentityCache(session)
+        ic.set(NameID(text='subject'), 'https://idp2.example.com', {'uid': ['two']})
+        session.commit()
+
+        self.assertEqual(sorted(IdentityCache(session).entities(NameID(text='subject'))),
+                         ['https://idp1.example.com', 'https://idp2.example.com'])
+
+    def test_separate_store_of_app(self):
+        session = FakeSubSessions()
+        app = Flask(__name__)
+        app.config['SAML2_SEPARATE_CACHE_STORE'] = True
+        with app.app_context():
+            IdentityCache(session).set(NameID(text='subject'), 'https://idp1.example.com', {'uid': ['one']})
+            state = StateCache(session)
+            state['state'] = 'data'
+            state.sync()
+        self.assertEqual(list(session.keys()), ['saml2'])
+        self.assertEqual(sorted(session['saml2'].keys()), ['_saml2_identities', '_saml2_state'])
+        # Without an app, or with the caches in the session
+        app.config['SAML2_SEPARATE_CACHE_STORE'] = False
+        with app.app_context():
+            state = StateCache(session)
+            state['state'] = 'data'
+            state.sync()
+        state = StateCache(session)
+        state['other'] = 'data'
+        state.sync()
+        self.assertEqual(session['_saml2_state'], {'state': 'data', 'other': 'data'})
@@ -0,0 +1,87 @@
+import os
+import time
+import shutil
+import tempfile
+import unittest
+
+from saml2.config import SPConfig
+from saml2.sigver import get_xmlsec_binary, SigverError
+
+from eduid_common.authn import eduid_saml2
+from eduid_common.authn.cache import IdentityCache, StateCache
+from eduid_common.authn.eduid_saml2 import get_saml2_client, get_saml2_cache_backend
+from eduid_common.authn.utils import get_saml2_config
+
+SETTINGS = """
+SAML_CONFIG = {{
+    'entityid': 'https://sp.example.com/reloaded',
+    'xmlsec_binary': '{xmlsec_binary}',
+    'service': {{'sp': {{'endpoints': {{}}}}}},
+}}
+"""
+
+
+class FakeSession(dict):
+
+    def sub_session(self, namespace):
+        return self.setdefault(namespace, {})
+
+
+class GetSaml2CacheBackendTests(unittest.TestCase):
+
+    def test_session(self):
+        session = FakeSession()
+        self.assertIs(get_saml2_cache_backend({}, session), session)
+        self.assertIs(get_saml2_cache_backend({'SAML2_SEPARATE_CACHE_STORE': False}, session), session)
+
+    def test_separate_store(self):
+        session = FakeSession()
+        self.assertIs(get_saml2_cache_backend({'SAML2_SEPARATE_CACHE_STORE': True}, session), session['saml2'])
+        # Plain dicts have no sub sessions
+        session = {}
+        self.assertIs(get_saml2_cache_backend({'SAML2_SEPARATE_CACHE_STORE': True}, session), session)
+
+
+class GetSaml2ClientTests(unittest.TestCase):
+
+    def setUp(self):
+        try:
+            self.xmlsec_binary = get_xmlsec_binary()
+        except SigverError:
+            self.skipTest('xmlsec1 not installed')
+        self.saml2_config = SPConfig()
+        self.saml2_config.load({
+            'entityid': 'https://sp.example.com/',
+            'xmlsec_binary': self.xmlsec_binary,
+            'service': {'sp': {'endpoints': {}}},
+        })
+
+    def test_per_request_caches(self):
+        session1, session2 = {}, {}
+        client1 = get_saml2_client(self.saml2_config, session1)
+        client2 = get_saml2_client(self.saml2_config, session2)
+        self.assertIsNot(client1, client2)
+        # The expensive setup is shared
+        self.assertIs(client1.sec, client2.sec)
+        self.assertIs(client1.config, self.saml2_config)
+        # The caches are bound to the session of each request
+        self.assertIsInstance(client1.users.cache, IdentityCache)
+        self.assertIsInstance(client1.state, StateCache)
+        self.assertIs(client1.state.session, session1)
+        self.assertIs(client2.state.session, session2)
+
+    def test_template_released_on_reload(self):
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        module_path = os.path.join(tmpdir, 'saml2_settings.py')
+        with open(module_path, 'w') as f:
+            f.write(SETTINGS.format(xmlsec_binary=self.xmlsec_binary))
+        confs = []
+        for i in range(3):
+            mtime = time.time() + 10 * i
+            os.utime(module_path, (mtime, mtime))
+            confs.append(get_saml2_config(module_path))
+            self.assertIs(get_saml2_client(confs[-1], {}).config, confs[-1])
+        self.assertEqual(len(set([id(x) for x in confs])), 3)
+        templates = [x for x in eduid_saml2._client_templates if x.entityid == 'https://sp.example.com/reloaded']
+        self.assertEqual(templates, [confs[-1]])
@@ -0,0 +1,320 @@
+import os
+import time
+import shutil
+import tempfile
+import unittest
+
+from mock import patch
+from saml2 import SAMLError
+from saml2.attribute_converter import ac_factory
+from saml2.mdstore import InMemoryMetaData, MetaDataMD
+from saml2.sigver import get_xmlsec_binary, SigverError
+from saml2.time_util import instant
+
+from eduid_common.authn.metadata import create_snapshot, write_snapshot, MetadataSnapshotError
+from eduid_common.authn.metadata import IndexedMetaData, MDQDirectoryMetaData, split_metadata, mdq_app, mdq_filename
+from eduid_common.authn.metadata import get_metadata_files
+from eduid_common.authn.utils import get_saml2_config
+
+IDP_METADATA = """<?xml version="1.0" encoding="UTF-8"?>
+<md:EntitiesDescriptor xmlns:md="urn:oasis:names:tc:SAML:2.0:metadata">
+  <md:EntityDescriptor entityID="https://idp.example.com/idp.xml">
+    <md:IDPSSODescriptor protocolSupportEnumeration="urn:oasis:names:tc:SAML:2.0:protocol">
+      <md:SingleSignOnService Binding="urn:oasis:names:tc:SAML:2.0:bindings:HTTP-Redirect"
+                              Location="https://idp.example.com/sso/redirect"/>
+    </md:IDPSSODescriptor>
+  </md:EntityDescriptor>
+</md:EntitiesDescriptor>
+"""
+
+SETTINGS = """
+SAML_CONFIG = {{
+    'entityid': 'https://sp.example.com/',
+    'service': {{'sp': {{'endpoints': {{}}}}}},
+    'metadata': {{'mdfile': ['{snapshot}']}},
+}}
+"""
+
+LIST_STYLE_SETTINGS = """
+SAML_CONFIG = {{
+    'entityid': 'https://sp.example.com/',
+    'service': {{'sp': {{'endpoints': {{}}}}}},
+    'metadata': [
+        {{'class': 'eduid_common.authn.metadata.IndexedMetaData',
+         'metadata': [('{metadata}',)]}},
+    ],
+}}
+"""
+
+
+class MetadataSnapshotTests(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.metadata_file = os.path.join(self.tmpdir, 'metadata.xml')
+        with open(self.metadata_file, 'w') as f:
+            f.write(IDP_METADATA)
+        self.snapshot_file = os.path.join(self.tmpdir, 'metadata.json')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def _write_snapshot(self):
+        md = InMemoryMetaData(ac_factory(), IDP_METADATA)
+        md.load()
+        write_snapshot(md, self.snapshot_file)
+        return md
+
+    def test_write_snapshot(self):
+        md = self._write_snapshot()
+        # No temporary files left behind
+        self.assertEqual(sorted(os.listdir(self.tmpdir)), ['metadata.json', 'metadata.xml'])
+        snapshot = MetaDataMD(ac_factory(), self.snapshot_file)
+        snapshot.load()
+        self.assertEqual(list(snapshot.keys()), ['https://idp.example.com/idp.xml'])
+        self.assertEqual(snapshot.entity, md.entity)
+
+    def test_unsigned_metadata(self):
+        try:
+            get_xmlsec_binary()
+        except SigverError:
+            self.skipTest('xmlsec1 not installed')
+        with self.assertRaises(MetadataSnapshotError):
+            create_snapshot(self.metadata_file, self.snapshot_file, cert_file='/dev/null')
+        self.assertFalse(os.path.exists(self.snapshot_file))
+
+    def test_saml2_config_reloaded_on_new_snapshot(self):
+        self._write_snapshot()
+        module_path = os.path.join(self.tmpdir, 'saml2_settings.py')
+        with open(module_path, 'w') as f:
+            f.write(SETTINGS.format(snapshot=self.snapshot_file))
+        conf = get_saml2_config(module_path)
+        self.assertIn('https://idp.example.com/idp.xml', conf.metadata.identity_providers())
+        self.assertIs(get_saml2_config(module_path), conf)
+
+        self._write_snapshot()
+        later = time.time() + 10
+        os.utime(self.snapshot_file, (later, later))
+        self.assertIsNot(get_saml2_config(module_path), conf)
+
+
+FEDERATION_METADATA = """<?xml version="1.0" encoding="UTF-8"?>
+<md:EntitiesDescriptor xmlns:md="urn:oasis:names:tc:SAML:2.0:metadata"
+                       xmlns:mdui="urn:oasis:names:tc:SAML:metadata:ui" Name="test-federation"{attrs}>
+{signature}
+{entities}
+</md:EntitiesDescriptor>
+"""
+
+# The signature is not verified in the tests, only its placement
+SIGNATURE = """  <ds:Signature xmlns:ds="http://www.w3.org/2000/09/xmldsig#">
+    <ds:SignedInfo>
+      <ds:CanonicalizationMethod Algorithm="http://www.w3.org/2001/10/xml-exc-c14n#"/>
+      <ds:SignatureMethod Algorithm="http://www.w3.org/2001/04/xmldsig-more#rsa-sha256"/>
+      <ds:Reference URI="{uri}">
+        <ds:DigestMethod Algorithm="http://www.w3.org/2001/04/xmlenc#sha256"/>
+        <ds:DigestValue>AAAA</ds:DigestValue>
+      </ds:Reference>
+    </ds:SignedInfo>
+    <ds:SignatureValue>AAAA</ds:SignatureValue>
+  </ds:Signature>"""
+
+FEDERATION_ENTITY = """  <md:EntityDescriptor entityID="https://idp{num}.example.com/idp.xml?a=1&amp;b=2">
+    <md:IDPSSODescriptor protocolSupportEnumeration="urn:oasis:names:tc:SAML:2.0:protocol">
+      <md:Extensions>
+        <mdui:UIInfo><mdui:DisplayName xml:lang="en">IdP {num}</mdui:DisplayName></mdui:UIInfo>
+      </md:Extensions>
+      <md:SingleSignOnService Binding="urn:oasis:names:tc:SAML:2.0:bindings:HTTP-Redirect"
+                              Location="https://idp{num}.example.com/sso/redirect"/>
+    </md:IDPSSODescriptor>
+  </md:EntityDescriptor>"""
+
+
+def _entity_id(num):
+    return 'https://idp{!s}.example.com/idp.xml?a=1&b=2'.format(num)
+
+
+def _federation_metadata(nums, attrs='', signature=SIGNATURE.format(uri=''), extra=''):
+    entities = '\n'.join([FEDERATION_ENTITY.format(num=i) for i in nums])
+    return FEDERATION_METADATA.format(attrs=attrs, signature=signature, entities=entities + extra)
+
+
+class LazyMetadataTests(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.metadata_file = os.path.join(self.tmpdir, 'federation.xml')
+        with open(self.metadata_file, 'w') as f:
+            f.write(_federation_metadata(range(10)))
+        self.full = InMemoryMetaData(ac_factory(), open(self.metadata_file).read())
+        self.full.load()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def _check_lazy(self, metadata):
+        self.assertEqual(len(metadata), 10)
+        self.assertEqual(sorted(metadata.keys()), sorted(self.full.keys()))
+        self.assertIn(_entity_id(3), metadata)
+        self.assertEqual(metadata[_entity_id(3)], self.full[_entity_id(3)])
+        self.assertEqual(metadata.service(_entity_id(4), 'idpsso_descriptor', 'single_sign_on_service',
+                                          'urn:oasis:names:tc:SAML:2.0:bindings:HTTP-Redirect'),
+                         self.full.service(_entity_id(4), 'idpsso_descriptor', 'single_sign_on_service',
+                                           'urn:oasis:names:tc:SAML:2.0:bindings:HTTP-Redirect'))
+        # Only the most recently used entities are kept
+        for i in range(10):
+            metadata[_entity_id(i)]
+        self.assertEqual(sorted(metadata.entity.keys()), [_entity_id(8), _entity_id(9)])
+        with self.assertRaises(KeyError):
+            metadata['https://unknown.example.com/']
+
+    def test_indexed(self):
+        metadata = IndexedMetaData(ac_factory(), self.metadata_file, cache_size=2)
+        metadata.load()
+        self.assertEqual(metadata.entity, {})
+        self._check_lazy(metadata)
+
+    def _write(self, data):
+        with open(self.metadata_file, 'w') as f:
+            f.write(data)
+
+    def _split(self, directory):
+        with patch('saml2.sigver.CryptoBackendXmlSec1.validate_signature', return_value=True):
+            return split_metadata(self.metadata_file, directory, cert_file='/dev/null')
+
+    def _load(self):
+        metadata = IndexedMetaData(ac_factory(), self.metadata_file)
+        metadata.load()
+        return metadata
+
+    def test_commented_out_entity(self):
+        self._write(_federation_metadata([1], extra='<!--\n' + FEDERATION_ENTITY.format(num=2) + '\n-->'))
+        metadata = self._load()
+        self.assertEqual(metadata.keys(), [_entity_id(1)])
+        self.assertNotIn(_entity_id(2), metadata)
+
+    def test_duplicate_entity(self):
+        self._write(_federation_metadata([1, 2, 1]))
+        with self.assertRaises(SAMLError):
+            self._load()
+
+    def test_doctype(self):
+        self._write(_federation_metadata([1]).replace('<md:EntitiesDescriptor',
+                                                      '<!DOCTYPE md:EntitiesDescriptor []>\n<md:EntitiesDescriptor'))
+        with self.assertRaises(SAMLError):
+            self._load()
+
+    def test_signature_must_cover_document(self):
+        try:
+            get_xmlsec_binary()
+        except SigverError:
+            self.skipTest('xmlsec1 not installed')
+        directory = os.path.join(self.tmpdir, 'mdq')
+        # A signature of another element (e.g. a wrapped, signed document)
+        self._write(_federation_metadata([1], attrs=' ID="root"', signature=SIGNATURE.format(uri='#other')))
+        with self.assertRaises(MetadataSnapshotError):
+            self._split(directory)
+        self._write(_federation_metadata([1], signature='<md:EntitiesDescriptor>{!s}</md:EntitiesDescriptor>'.format(
+            SIGNATURE.format(uri=''))))
+        with self.assertRaises(MetadataSnapshotError):
+            self._split(directory)
+        self._write(_federation_metadata([1], attrs=' ID="root"', signature=SIGNATURE.format(uri='#root')))
+        self.assertEqual(self._split(directory), 1)
+
+    def test_valid_until(self):
+        self._write(_federation_metadata([1], attrs=' validUntil="2001-01-01T00:00:00Z"'))
+        with self.assertRaises(SAMLError):
+            self._load()
+
+        valid_until = instant(time_stamp=time.time() + 3600)
+        self._write(_federation_metadata([1], attrs=' validUntil="{!s}"'.format(valid_until)))
+        metadata = self._load()
+        self.assertIn(_entity_id(1), metadata)
+        self.assertIn('validUntil="{!s}"'.format(valid_until).encode('utf-8'),
+                      metadata._get_entity_xml(_entity_id(1)))
+        entity = dict(metadata[_entity_id(1)])
+        self.assertEqual(entity.pop('valid_until'), valid_until)
+        self.assertEqual(entity, self.full[_entity_id(1)])
+        with patch('time.time', return_value=time.time() + 7200):
+            self.assertNotIn(_entity_id(1), metadata)
+            self.assertEqual(metadata.keys(), [])
+            with self.assertRaises(KeyError):
+                metadata[_entity_id(1)]
+
+        # Entities with their own validUntil
+        self._write(_federation_metadata([1, 2]).replace(
+            'entityID="https://idp2', 'validUntil="2001-01-01T00:00:00Z" entityID="https://idp2'))
+        metadata = self._load()
+        self.assertEqual(metadata.keys(), [_entity_id(1)])
+        with self.assertRaises(KeyError):
+            metadata[_entity_id(2)]
+
+    def test_cache_duration(self):
+        self._write(_federation_metadata([1], attrs=' cacheDuration="PT1H"'))
+        metadata = self._load()
+        self.assertIn(_entity_id(1), metadata)
+        # Counted from the modification time of the file
+        earlier = time.time() - 7200
+        os.utime(self.metadata_file, (earlier, earlier))
+        with self.assertRaises(SAMLError):
+            self._load()
+
+    def test_split_writes_valid_until(self):
+        self._write(_federation_metadata([1], attrs=' cacheDuration="P1D"'))
+        directory = os.path.join(self.tmpdir, 'mdq')
+        self.assertEqual(self._split(directory), 1)
+        with open(os.path.join(directory, mdq_filename(_entity_id(1)))) as f:
+            self.assertIn('validUntil="{!s}"'.format(instant(time_stamp=os.path.getmtime(self.metadata_file) + 86400)),
+                          f.read())
+
+    def test_mdq_directory(self):
+        try:
+            get_xmlsec_binary()
+        except SigverError:
+            self.skipTest('xmlsec1 not installed')
+        directory = os.path.join(self.tmpdir, 'mdq')
+        self.assertEqual(self._split(directory), 10)
+        metadata = MDQDirectoryMetaData(ac_factory(), directory, cache_size=2)
+        metadata.load()
+        self._check_lazy(metadata)
+
+        app = mdq_app(directory)
+        status = []
+        path = '/entities/%7Bsha1%7D' + mdq_filename(_entity_id(5))[:-len('.xml')]
+        environ = {'REQUEST_METHOD': 'GET', 'PATH_INFO': path, 'REMOTE_ADDR': '127.0.0.1'}
+        body = b''.join(app(environ, lambda s, h: status.append(s)))
+        self.assertEqual(status, ['200 OK'])
+        self.assertIn(b'https://idp5.example.com/sso/redirect', body)
+        # Only served to the local host
+        environ['REMOTE_ADDR'] = '192.0.2.1'
+        self.assertEqual(b''.join(app(environ, lambda s, h: status.append(s))), b'Forbidden')
+        self.assertEqual(status[-1], '403 Forbidden')
+
+    def test_list_style_config(self):
+        module_path = os.path.join(self.tmpdir, 'saml2_settings.py')
+        with open(module_path, 'w') as f:
+            f.write(LIST_STYLE_SETTINGS.format(metadata=self.metadata_file))
+        conf = get_saml2_config(module_path)
+        self.assertIn(_entity_id(3), conf.metadata.identity_providers())
+        self.assertIs(get_saml2_config(module_path), conf)
+        # Reloaded when the metadata file is replaced
+        later = time.time() + 10
+        os.utime(self.metadata_file, (later, later))
+        self.assertIsNot(get_saml2_config(module_path), conf)
+
+    def test_get_metadata_files(self):
+        directory = os.path.join(self.tmpdir, 'mdq')
+        os.mkdir(directory)
+        self.assertEqual(get_metadata_files({'metadata': [
+            {'class': 'eduid_common.authn.metadata.IndexedMetaData', 'metadata': [(self.metadata_file, '/dev/null')]},
+            {'class': 'eduid_common.authn.metadata.MDQDirectoryMetaData', 'metadata': [(directory,)]},
+            {'class': 'saml2.mdstore.MetaDataExtern', 'metadata': [('https://mds.example.com/', '/dev/null')]},
+        ]}), [self.metadata_file])
+        with open(os.path.join(directory, 'entities'), 'w') as f:
+            f.write(_entity_id(1) + '\n')
+        self.assertEqual(get_metadata_files({'metadata': [
+            {'class': 'eduid_common.authn.metadata.MDQDirectoryMetaData', 'metadata': [(directory,)]},
+        ]}), [os.path.join(directory, 'entities')])
+        self.assertEqual(get_metadata_files({'metadata': {'local': [self.metadata_file],
+                                                          'remote': [{'url': 'https://mds.example.com/'}]}}),
+                         [self.metadata_file])
@@ -31,13 +31,18 @@
 # POSSIBILITY OF SUCH DAMAGE.
 
 import json
+import unittest
 from contextlib import contextmanager
 from mock import patch
 from flask import Flask
 
 from eduid_common.api.testing import EduidAPITestCase
 from eduid_common.api.app import eduid_init_app
-from eduid_common.authn.middleware import UnAuthnApp
+from eduid_common.authn.middleware import AuthnApp, UnAuthnApp, NoAuthnMatcher
+from eduid_common.authn.utils import no_authn_views
+from eduid_common.api.session import SessionFactory
+from eduid_common.api.tests.test_session import SESSION_CONFIG
+from eduid_common.session.tests.test_request_session import CountingRedisConn, FakeSessionManager
 
 
 class AuthnTests(EduidAPITestCase):
@@ -114,3 +119,134 @@ class UnAuthnTests(EduidAPITestCase):
             response2 = client.get('/status/healthy')
             self.assertEqual(response2.status_code, 200)
 
+
+
+class NoAuthnMatcherTests(unittest.TestCase):
+
+    def test_match(self):
+        matcher = NoAuthnMatcher(['^/status/healthy$', '^/static/.*', '^/(?P<lang>en|sv)/help$'])
+        self.assertTrue(matcher.match('/status/healthy'))
+        self.assertTrue(matcher.match('/static/app.js'))
+        self.assertTrue(matcher.match('/sv/help'))
+        self.assertFalse(matcher.match('/status/healthy/more'))
+        self.assertFalse(matcher.match('/personal-data'))
+        # Remembered decisions
+        self.assertTrue(matcher.match('/status/healthy'))
+        self.assertFalse(matcher.match('/personal-data'))
+
+    def test_decisions_bounded(self):
+        matcher = NoAuthnMatcher(['^/static/.*'], cache_size=2)
+        for path in ['/static/a', '/b', '/static/c']:
+            matcher.match(path)
+        self.assertEqual(list(matcher._decisions.keys()), ['/b', '/static/c'])
+
+    def test_incompatible_patterns(self):
+        # Duplicate group names can not be combined into one regex
+        matcher = NoAuthnMatcher(['^/(?P<x>a)$', '^/(?P<x>b)$'])
+        self.assertEqual(len(matcher._regexes), 2)
+        self.assertTrue(matcher.match('/b'))
+        self.assertFalse(matcher.match('/c'))
+
+    def test_group_references(self):
+        # Group numbers change when combined, so the backreference is matched on its own
+        matcher = NoAuthnMatcher(['^/(b)$', r'^/(a)\1$', '^/c$|^/d$'])
+        self.assertEqual(len(matcher._regexes), 2)
+        self.assertTrue(matcher.match('/aa'))
+        self.assertFalse(matcher.match('/ab'))
+        self.assertTrue(matcher.match('/b'))
+        self.assertTrue(matcher.match('/d'))
+
+    def test_alternation_wrapped(self):
+        matcher = NoAuthnMatcher(['^/a$|^/b', '^/c$'])
+        self.assertEqual(len(matcher._regexes), 1)
+        self.assertTrue(matcher.match('/bx'))
+        self.assertFalse(matcher.match('/ax'))
+        self.assertFalse(matcher.match('/cx'))
+
+    def test_is_current(self):
+        whitelist = ['^/a$', '^/b$']
+        matcher = NoAuthnMatcher(whitelist)
+        self.assertTrue(matcher.is_current(whitelist))
+        self.assertTrue(matcher.is_current(list(whitelist)))
+        # Changed in place, without changing the length
+        whitelist[1] = '^/c$'
+        self.assertFalse(matcher.is_current(whitelist))
+
+    def test_rebuilt_by_no_authn_views(self):
+        app = AuthnApp(__name__)
+        app.config['NO_AUTHN_URLS'] = []
+        no_authn_views(app, ['/status/healthy'])
+        self.assertTrue(app._get_no_authn_matcher().match('/status/healthy'))
+        matcher = app._get_no_authn_matcher()
+        self.assertIs(app._get_no_authn_matcher(), matcher)
+        self.assertFalse(matcher.match('/other'))
+
+        no_authn_views(app, ['/other'])
+        self.assertIsNot(app._get_no_authn_matcher(), matcher)
+        self.assertTrue(app._get_no_authn_matcher().match('/other'))
+
+
+class AuthnAppDispatchTests(unittest.TestCase):
+
+    def setUp(self):
+        self.app = AuthnApp('test_app')
+        self.app.config.update(SESSION_CONFIG)
+        self.app.config['TOKEN_SERVICE_URL'] = 'https://login.example.com/'
+        self.app.config['NO_AUTHN_URLS'] = []
+        no_authn_views(self.app, ['/public'])
+        self.app.session_interface = SessionFactory(self.app.config)
+        self.conn = CountingRedisConn()
+        self.app.session_interface.manager = FakeSessionManager(self.conn)
+        base = self.app.session_interface.manager.get_session(data={'user_eppn': 'hubba-bubba'})
+        base.commit()
+        self.token = base.token
+        self.conn.round_trips = []
+
+        @self.app.route('/private')
+        def private():
+            return 'private'
+
+        @self.app.route('/public')
+        def public():
+            return 'public'
+
+    def test_authenticated(self):
+        client = self.app.test_client()
+        client.set_cookie('test.localhost', 'sessid', self.token)
+        response = client.get('/private')
+        self.assertEqual(response.status_code, 200)
+        # The session is loaded once, for both the check and the view
+        self.assertEqual(self.conn.round_trips, [['get', 'expire']])
+
+    def test_not_authenticated(self):
+        response = self.app.test_client().get('/private')
+        self.assertEqual(response.status_code, 302)
+        self.assertTrue(response.location.startswith('https://login.example.com/login?next='))
+        self.assertIn('sessid=', response.headers['Set-Cookie'])
+        self.assertEqual(self.conn.round_trips, [['setex']])
+
+    def test_not_authenticated_skips_handlers(self):
+        called = []
+        self.app.before_first_request(lambda: called.append('before_first_request'))
+        self.app.before_request(lambda: called.append('before_request'))
+
+        @self.app.after_request
+        def after_request(response):
+            called.append('after_request')
+            return response
+
+        response = self.app.test_client().get('/private')
+        self.assertEqual(response.status_code, 302)
+        self.assertIn('sessid=', response.headers['Set-Cookie'])
+        self.assertEqual(called, [])
+
+        # The handlers run for the first request that gets through
+        client = self.app.test_client()
+        client.set_cookie('test.localhost', 'sessid', self.token)
+        self.assertEqual(client.get('/private').status_code, 200)
+        self.assertEqual(called, ['before_first_request', 'before_request', 'after_request'])
+
+    def test_whitelisted(self):
+        response = self.app.test_client().get('/public')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(self.conn.round_trips, [])
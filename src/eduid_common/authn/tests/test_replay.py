@@ -0,0 +1,162 @@
+import os
+import time
+import shutil
+import tempfile
+import unittest
+
+from mock import patch
+from saml2 import saml
+from saml2.client import Saml2Client
+from saml2.config import SPConfig
+from saml2.sigver import get_xmlsec_binary, SigverError
+
+from eduid_common.authn import replay
+from eduid_common.authn.eduid_saml2 import BadSAMLResponse, get_authn_response
+from eduid_common.authn.replay import AssertionReplayCache, get_replay_cache
+from eduid_common.authn.utils import get_saml2_config
+
+IDP = 'https://idp.example.com/'
+
+SETTINGS = """
+SAML_CONFIG = {
+    'entityid': 'https://sp.example.com/reloaded',
+    'service': {'sp': {'endpoints': {}}},
+}
+"""
+
+
+class FakeRedis(object):
+
+    def __init__(self):
+        self.data = {}
+        self.calls = 0
+
+    def set(self, key, value, nx=False, ex=None):
+        self.calls += 1
+        if nx and key in self.data:
+            return None
+        self.data[key] = (value, ex)
+        return True
+
+
+class AssertionReplayCacheTests(unittest.TestCase):
+
+    def setUp(self):
+        self.conn = FakeRedis()
+        self.cache = AssertionReplayCache(self.conn, ttl=60, local_size=2)
+
+    def test_check_and_record(self):
+        self.assertTrue(self.cache.check_and_record('id-1', IDP))
+        self.assertEqual(self.conn.data, {'saml2_assertion_id-1 https://idp.example.com/': (1, 60)})
+        self.assertFalse(self.cache.check_and_record('id-1', IDP))
+        # Replays to the same process are detected without asking Redis
+        self.assertEqual(self.conn.calls, 1)
+
+    def test_per_issuer(self):
+        self.assertTrue(self.cache.check_and_record('id-1', IDP))
+        self.assertTrue(self.cache.check_and_record('id-1', 'https://other-idp.example.com/'))
+        self.assertFalse(self.cache.check_and_record('id-1', 'https://other-idp.example.com/'))
+
+    def test_other_process(self):
+        self.assertTrue(self.cache.check_and_record('id-1', IDP))
+        other = AssertionReplayCache(self.conn, ttl=60)
+        self.assertFalse(other.check_and_record('id-1', IDP))
+        self.assertTrue(other.check_and_record('id-2', IDP))
+
+    def test_local_bounded(self):
+        for i in range(5):
+            self.cache.check_and_record('id-{!s}'.format(i), IDP)
+        self.assertEqual(list(self.cache._local.keys()), [(IDP, 'id-3'), (IDP, 'id-4')])
+        # Forgotten locally, but still known by Redis
+        self.assertFalse(self.cache.check_and_record('id-0', IDP))
+
+    def test_local_expiry(self):
+        with patch('eduid_common.authn.replay.time.time', return_value=1000):
+            self.cache.check_and_record('id-1', IDP)
+        # Redis expires the key after the ttl
+        self.conn.data = {}
+        with patch('eduid_common.authn.replay.time.time', return_value=1061):
+            self.assertTrue(self.cache.check_and_record('id-1', IDP))
+
+    def test_not_configured(self):
+        self.assertIsNone(get_replay_cache({}, object()))
+
+    def test_released_on_reload(self):
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        module_path = os.path.join(tmpdir, 'saml2_settings.py')
+        with open(module_path, 'w') as f:
+            f.write(SETTINGS)
+        config = {'SAML2_REPLAY_CACHE': True, 'REDIS_HOST': 'localhost', 'REDIS_PORT': 6379, 'REDIS_DB': 0}
+        caches = []
+        for i in range(3):
+            mtime = time.time() + 10 * i
+            os.utime(module_path, (mtime, mtime))
+            saml2_config = get_saml2_config(module_path)
+            caches.append(get_replay_cache(config, saml2_config))
+            self.assertIs(get_replay_cache(config, saml2_config), caches[-1])
+        self.assertEqual([x for x in replay._replay_caches.values() if x in caches], [caches[-1]])
+
+
+class FakeAuthnResponse(object):
+
+    def __init__(self, assertion_id, info):
+        self.assertion = saml.Assertion(id=assertion_id)
+        self.info = info
+
+    def session_id(self):
+        return 'request-1'
+
+    def session_info(self):
+        return dict(self.info)
+
+
+class GetAuthnResponseTests(unittest.TestCase):
+
+    def setUp(self):
+        try:
+            xmlsec_binary = get_xmlsec_binary()
+        except SigverError:
+            self.skipTest('xmlsec1 not installed')
+        saml2_config = SPConfig()
+        saml2_config.load({
+            'entityid': 'https://sp.example.com/',
+            'xmlsec_binary': xmlsec_binary,
+            'service': {'sp': {'endpoints': {}}},
+        })
+        self.config = {'SAML2_CONFIG': saml2_config}
+        self.cache = AssertionReplayCache(FakeRedis(), ttl=60)
+        patcher = patch('eduid_common.authn.eduid_saml2.get_replay_cache', return_value=self.cache)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def _get_authn_response(self, session, assertion_id, issuer, user):
+        info = {'name_id': saml.NameID(format=saml.NAMEID_FORMAT_TRANSIENT, text=user),
+                'issuer': issuer,
+                'not_on_or_after': int(time.time()) + 60,
+                'ava': {'eppn': [user]},
+                }
+
+        def parse_authn_request_response(client, *args, **kwargs):
+            # Like pysaml2, add the subject to the identity cache of the client
+            client.users.add_information_about_person(info)
+            return FakeAuthnResponse(assertion_id, info)
+
+        with patch.object(Saml2Client, 'parse_authn_request_response', parse_authn_request_response):
+            return get_authn_response(self.config, session, 'response')
+
+    def test_replay_rejected(self):
+        session = {}
+        session_info = self._get_authn_response(session, 'id-1', IDP, 'user1')
+        self.assertEqual(session_info['ava'], {'eppn': ['user1']})
+        identities = dict(session['_saml2_identities'])
+        with self.assertRaises(BadSAMLResponse):
+            self._get_authn_response(session, 'id-1', IDP, 'user2')
+        # The identity of the replayed assertion is not stored
+        self.assertEqual(session['_saml2_identities'], identities)
+
+    def test_other_issuer(self):
+        session = {}
+        self._get_authn_response(session, 'id-1', IDP, 'user1')
+        session_info = self._get_authn_response(session, 'id-1', 'https://other-idp.example.com/', 'user2')
+        self.assertEqual(session_info['ava'], {'eppn': ['user2']})
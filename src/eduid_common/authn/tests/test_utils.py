@@ -0,0 +1,114 @@
+import os
+import time
+import shutil
+import tempfile
+import unittest
+
+from flask import Flask
+
+from eduid_common.authn import utils
+from eduid_common.authn.utils import get_saml2_config, configure_crypto_backend
+from eduid_common.authn.utils import SAMLAttributes, get_saml_attributes, get_saml_attribute
+
+SETTINGS = """
+SAML_CONFIG = {{
+    'entityid': '{entityid}',
+    'service': {{'sp': {{'endpoints': {{}}}}}},
+}}
+"""
+
+
+class GetSaml2ConfigTests(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.module_path = os.path.join(self.tmpdir, 'saml2_settings.py')
+        self._write_settings('https://sp.example.com/one')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def _write_settings(self, entityid, mtime=None):
+        with open(self.module_path, 'w') as f:
+            f.write(SETTINGS.format(entityid=entityid))
+        if mtime is not None:
+            os.utime(self.module_path, (mtime, mtime))
+
+    def test_cached(self):
+        conf = get_saml2_config(self.module_path)
+        self.assertEqual(conf.entityid, 'https://sp.example.com/one')
+        self.assertIs(get_saml2_config(self.module_path), conf)
+        self.assertIsNot(get_saml2_config(self.module_path, use_cache=False), conf)
+
+    def test_reload_on_mtime_change(self):
+        conf = get_saml2_config(self.module_path)
+        self._write_settings('https://sp.example.com/two', mtime=time.time() + 10)
+        conf2 = get_saml2_config(self.module_path)
+        self.assertIsNot(conf2, conf)
+        self.assertEqual(conf2.entityid, 'https://sp.example.com/two')
+
+    def test_configure_crypto_backend(self):
+        conf = get_saml2_config(self.module_path)
+        self.assertIs(configure_crypto_backend(conf), conf)
+        self.assertIs(configure_crypto_backend(conf, conf.crypto_backend), conf)
+        conf2 = configure_crypto_backend(conf, 'XMLSecurity')
+        self.assertIsNot(conf2, conf)
+        self.assertEqual(conf2.crypto_backend, 'XMLSecurity')
+        self.assertEqual(conf2.entityid, conf.entityid)
+        self.assertNotEqual(conf.crypto_backend, 'XMLSecurity')
+        self.assertIs(configure_crypto_backend(conf, 'XMLSecurity'), conf2)
+
+    def test_crypto_backend_released_on_reload(self):
+        released = []
+        self.addCleanup(utils._release_callbacks.remove, released.append)
+        utils.on_saml2_config_released(released.append)
+        confs = []
+        for i in range(3):
+            self._write_settings('https://sp.example.com/reload-{!s}'.format(i), mtime=time.time() + 10 * i)
+            conf = get_saml2_config(self.module_path)
+            confs.append((conf, configure_crypto_backend(conf, 'XMLSecurity')))
+        backend_configs = [key for key in utils._backend_configs
+                           if key[0].entityid.startswith('https://sp.example.com/reload-')]
+        self.assertEqual(backend_configs, [(confs[-1][0], 'XMLSecurity')])
+        self.assertEqual(released, [confs[0][0], confs[0][1], confs[1][0], confs[1][1]])
+
+
+class SAMLAttributesTests(unittest.TestCase):
+
+    def setUp(self):
+        self.session_info = {'ava': {
+            'eduPersonPrincipalName': ['hubba-bubba@idp.example.edu'],
+            'MAIL': ['one@example.edu', 'two@example.edu'],
+            'givenName': ['Hubba'],
+        }}
+
+    def test_get(self):
+        attributes = SAMLAttributes(self.session_info)
+        self.assertEqual(attributes.get('edupersonprincipalname'), ['hubba-bubba@idp.example.edu'])
+        self.assertEqual(attributes.get('mail'), ['one@example.edu', 'two@example.edu'])
+        self.assertIsNone(attributes.get('sn'))
+
+    def test_typed(self):
+        attributes = SAMLAttributes(self.session_info)
+        self.assertEqual(attributes.eppn, 'hubba-bubba@idp.example.edu')
+        self.assertEqual(attributes.mail, ['one@example.edu', 'two@example.edu'])
+        self.assertEqual(attributes.given_name, 'Hubba')
+        self.assertIsNone(attributes.surname)
+        self.assertEqual(attributes.assurance, [])
+
+    def test_created_once_per_request(self):
+        app = Flask(__name__)
+        with app.test_request_context('/'):
+            attributes = get_saml_attributes(self.session_info)
+            self.assertIs(get_saml_attributes(self.session_info), attributes)
+            self.assertIsNot(get_saml_attributes({'ava': {}}), attributes)
+            self.assertEqual(get_saml_attribute(self.session_info, 'GivenName'), ['Hubba'])
+        with app.test_request_context('/'):
+            self.assertIsNot(get_saml_attributes(self.session_info), attributes)
+        # Not kept outside of a request
+        self.assertIsNot(get_saml_attributes(self.session_info), get_saml_attributes(self.session_info))
+        self.assertEqual(get_saml_attribute(self.session_info, 'GivenName'), ['Hubba'])
+
+    def test_no_ava(self):
+        with self.assertRaises(ValueError):
+            get_saml_attribute({}, 'mail')
@@ -74,6 +74,49 @@ class VCCSTestCase(MongoTestCase):
         result3 = self._check_credentials('wxyz') 
         self.assertTrue(result3)
 
+    def test_check_credentials_concurrently(self):
+        vccs_module.add_password(self.user, new_password='wxyz', application='test', vccs=self.vccs_client)
+        vccs_module.configure_password_checks(4)
+        self.addCleanup(vccs_module.configure_password_checks, 0)
+        passwords = self.user.credentials.filter(vccs_module.Password).to_list()
+        self.assertEqual(self._check_credentials('abcd'), passwords[0])
+        self.assertEqual(self._check_credentials('wxyz'), passwords[1])
+        self.assertFalse(self._check_credentials('fghi'))
+
+    def test_check_credentials_backend_unavailable(self):
+        from eduid_common.authn.testing import TestVCCSClient
+        from eduid_common.authn.vccs_guard import VCCSUnavailable
+        from eduid_common.authn.vccs_pool import VCCSConnectionError
+
+        for exc in [VCCSConnectionError('timeout', 500), VCCSUnavailable('VCCS circuit open')]:
+            with patch.object(TestVCCSClient, 'authenticate', side_effect=exc):
+                self.assertFalse(self._check_credentials('abcd'))
+
+    def test_check_credentials_factor_busy(self):
+        from eduid_common.authn.vccs_hashing import PasswordFactorBusy
+
+        with patch.object(vccs_module, 'make_password_factor', side_effect=PasswordFactorBusy('queue full')):
+            self.assertFalse(self._check_credentials('abcd'))
+
+    def test_check_credentials_concurrently_timeout(self):
+        from eduid_common.authn.testing import TestVCCSClient
+        import time
+
+        vccs_module.add_password(self.user, new_password='wxyz', application='test', vccs=self.vccs_client)
+        vccs_module.configure_password_checks(4)
+        self.addCleanup(vccs_module.configure_password_checks, 0)
+        with patch.object(vccs_module, 'get_vccs_timeout', return_value=0.1), \
+                patch.object(vccs_module, 'get_factor_timeout', return_value=0.1), \
+                patch.object(TestVCCSClient, 'authenticate', side_effect=lambda *args: time.sleep(1)):
+            self.assertFalse(self._check_credentials('abcd'))
+
+    def test_check_credentials_backend_error(self):
+        from eduid_common.authn.testing import TestVCCSClient
+        from vccs_client import VCCSClientHTTPError
+
+        with patch.object(TestVCCSClient, 'authenticate', side_effect=VCCSClientHTTPError('dummy', 400)):
+            self.assertFalse(self._check_credentials('abcd'))
+
     def test_change_password(self):
         added = vccs_module.change_password(self.user, new_password='wxyz', old_password='abcd', application='test',
                                             vccs=self.vccs_client)
@@ -0,0 +1,139 @@
+import threading
+import unittest
+
+import vccs_client
+from mock import MagicMock, patch
+
+from eduid_common.authn import vccs_guard
+from eduid_common.authn.vccs_guard import GuardedVCCSClient, VCCSUnavailable
+from eduid_common.authn.vccs_pool import VCCSConnectionError
+from eduid_common.stats import NoOpStats
+
+
+class CountingStats(object):
+
+    def __init__(self):
+        self.counts = {}
+        self.timings = []
+
+    def count(self, name, value=1):
+        self.counts[name] = self.counts.get(name, 0) + value
+
+    def gauge(self, name, value):
+        pass
+
+    def timing(self, name, value):
+        self.timings.append(name)
+
+
+class FakeClient(object):
+
+    base_url = 'http://vccs.example.com/'
+
+    def __init__(self):
+        self.calls = 0
+        self.error = None
+        self.event = None
+
+    def authenticate(self, user_id, factors):
+        self.calls += 1
+        if self.event is not None:
+            self.event.wait(5)
+        if self.error is not None:
+            raise self.error
+        return True
+
+
+class GuardedVCCSClientTests(unittest.TestCase):
+
+    def setUp(self):
+        self.stats = CountingStats()
+        self.client = FakeClient()
+
+    def test_timing(self):
+        guard = GuardedVCCSClient(self.client, self.stats)
+        self.assertTrue(guard.authenticate('user', []))
+        self.client.error = VCCSConnectionError('timeout', 500)
+        with self.assertRaises(VCCSConnectionError):
+            guard.authenticate('user', [])
+        self.assertEqual(self.stats.timings, ['vccs_authenticate_time', 'vccs_authenticate_time'])
+        self.assertEqual(self.stats.counts, {'vccs_authenticate_error': 1})
+
+    def test_circuit_breaker(self):
+        guard = GuardedVCCSClient(self.client, self.stats, failure_threshold=2, reset_timeout=30)
+        self.client.error = VCCSConnectionError('timeout', 500)
+        for _ in range(2):
+            with self.assertRaises(VCCSConnectionError):
+                guard.authenticate('user', [])
+        # Open, the backend is not called
+        with self.assertRaises(VCCSUnavailable):
+            guard.authenticate('user', [])
+        self.assertEqual(self.client.calls, 2)
+        self.assertEqual(self.stats.counts['vccs_circuit_opened'], 1)
+        self.assertEqual(self.stats.counts['vccs_rejected_open'], 1)
+
+        # A failing probe keeps the circuit open
+        guard._open_until = 0
+        with self.assertRaises(VCCSConnectionError):
+            guard.authenticate('user', [])
+        self.assertEqual(self.client.calls, 3)
+        with self.assertRaises(VCCSUnavailable):
+            guard.authenticate('user', [])
+
+        # A successful probe closes it
+        guard._open_until = 0
+        self.client.error = None
+        self.assertTrue(guard.authenticate('user', []))
+        self.assertTrue(guard.authenticate('user', []))
+        self.assertEqual(self.client.calls, 5)
+        self.assertEqual(self.stats.counts['vccs_circuit_opened'], 1)
+
+    def test_error_responses_do_not_open_circuit(self):
+        guard = GuardedVCCSClient(self.client, self.stats, failure_threshold=1)
+        self.client.error = vccs_client.VCCSClientHTTPError('already revoked', 500)
+        for _ in range(3):
+            with self.assertRaises(vccs_client.VCCSClientHTTPError):
+                guard.authenticate('user', [])
+        self.assertEqual(self.client.calls, 3)
+
+    def test_max_concurrent(self):
+        guard = GuardedVCCSClient(self.client, self.stats, max_concurrent=1)
+        self.client.event = threading.Event()
+        thread = threading.Thread(target=guard.authenticate, args=('user', []))
+        thread.start()
+        while not guard._in_flight:
+            thread.join(0.01)
+        with self.assertRaises(VCCSUnavailable):
+            guard.authenticate('user', [])
+        self.client.event.set()
+        thread.join()
+        self.assertTrue(guard.authenticate('user', []))
+        self.assertEqual(self.stats.counts, {'vccs_rejected_busy': 1})
+
+    def test_get_guarded_vccs_client(self):
+        vccs_guard.configure_vccs_guard(stats=self.stats, failure_threshold=3)
+        self.addCleanup(vccs_guard.configure_vccs_guard, stats=NoOpStats(), failure_threshold=0)
+        guard = vccs_guard.get_guarded_vccs_client('http://localhost:1/')
+        self.assertIs(vccs_guard.get_guarded_vccs_client('http://localhost:1/'), guard)
+        self.assertEqual(guard.failure_threshold, 3)
+        self.assertIs(guard.stats, self.stats)
+
+    def test_configure_unchanged(self):
+        vccs_guard.configure_vccs_guard(stats=self.stats, failure_threshold=3)
+        self.addCleanup(vccs_guard.configure_vccs_guard, stats=NoOpStats(), failure_threshold=0)
+        guard = vccs_guard.get_guarded_vccs_client('http://localhost:3/')
+        # As when another app in the process is initialized, the circuit breaker state is kept
+        stats = CountingStats()
+        vccs_guard.configure_vccs_guard(stats=stats, failure_threshold=3)
+        self.assertIs(vccs_guard.get_guarded_vccs_client('http://localhost:3/'), guard)
+        self.assertIs(guard.stats, stats)
+        vccs_guard.configure_vccs_guard(failure_threshold=4)
+        self.assertIsNot(vccs_guard.get_guarded_vccs_client('http://localhost:3/'), guard)
+
+    def test_get_guarded_vccs_client_unlocked(self):
+        guard = vccs_guard.get_guarded_vccs_client('http://localhost:2/')
+        # A client already created is returned without taking the lock
+        lock = MagicMock()
+        lock.__enter__.side_effect = AssertionError('lock taken')
+        with patch.object(vccs_guard, '_guards_lock', lock):
+            self.assertIs(vccs_guard.get_guarded_vccs_client('http://localhost:2/'), guard)
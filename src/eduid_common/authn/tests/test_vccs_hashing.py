@@ -0,0 +1,88 @@
+import time
+import unittest
+
+import vccs_client
+
+from eduid_common.authn import vccs_hashing
+from eduid_common.authn.vccs_hashing import PasswordFactorPool, PasswordFactorBusy, PasswordFactorTimeout
+
+
+class CountingStats(object):
+
+    def __init__(self):
+        self.counts = {}
+        self.gauges = {}
+        self.timings = []
+
+    def count(self, name, value=1):
+        self.counts[name] = self.counts.get(name, 0) + value
+
+    def gauge(self, name, value):
+        self.gauges[name] = value
+
+    def timing(self, name, value):
+        self.timings.append(name)
+
+
+class PasswordFactorPoolTests(unittest.TestCase):
+
+    def setUp(self):
+        self.stats = CountingStats()
+        self.local_factor = vccs_client.VCCSPasswordFactor('abcd', credential_id='1234')
+
+    def test_not_configured(self):
+        vccs_hashing.configure_factor_pool(0)
+        self.assertIsNone(vccs_hashing._factor_pool)
+        factor = vccs_hashing.make_password_factor('abcd', '1234', salt=self.local_factor.salt)
+        self.assertEqual(factor.to_dict('auth'), self.local_factor.to_dict('auth'))
+
+    def test_configured(self):
+        vccs_hashing.configure_factor_pool(1, stats=self.stats)
+        self.addCleanup(vccs_hashing.configure_factor_pool, 0)
+        self.assertEqual(vccs_hashing._factor_pool.queue_size, 4)
+        # The workers are started when the pool is configured
+        self.assertIsNotNone(vccs_hashing._factor_pool._pool)
+        factor = vccs_hashing.make_password_factor('abcd', '1234', salt=self.local_factor.salt)
+        self.assertEqual(factor.to_dict('auth'), self.local_factor.to_dict('auth'))
+        # A new salt is generated in the worker for a new password
+        factor = vccs_hashing.make_password_factor('abcd', '1234')
+        self.assertNotEqual(factor.salt, self.local_factor.salt)
+        self.assertEqual(self.stats.gauges, {'vccs_factor_queue_depth': 1})
+        self.assertEqual(self.stats.timings, ['vccs_factor_hash_time', 'vccs_factor_hash_time'])
+
+    def test_configure_unchanged(self):
+        vccs_hashing.configure_factor_pool(1, stats=self.stats)
+        self.addCleanup(vccs_hashing.configure_factor_pool, 0)
+        pool = vccs_hashing._factor_pool
+        stats = CountingStats()
+        vccs_hashing.configure_factor_pool(1, stats=stats)
+        self.assertIs(vccs_hashing._factor_pool, pool)
+        self.assertIs(pool.stats, stats)
+        vccs_hashing.configure_factor_pool(1, queue_size=2, stats=stats)
+        self.assertIsNot(vccs_hashing._factor_pool, pool)
+        self.assertIsNone(pool._pool)
+
+    def test_error_raised(self):
+        pool = PasswordFactorPool(processes=1, queue_size=2, timeout=10, stats=self.stats)
+        self.addCleanup(lambda: pool._pool.terminate())
+        with self.assertRaises(ValueError):
+            pool.make_password_factor('abcd', '1234', salt='not a salt')
+        self.assertEqual(pool._pending, 0)
+
+    def test_queue_full(self):
+        pool = PasswordFactorPool(processes=1, queue_size=0, timeout=10, stats=self.stats)
+        self.addCleanup(lambda: pool._pool.terminate())
+        with self.assertRaises(PasswordFactorBusy):
+            pool.make_password_factor('abcd', '1234')
+        self.assertEqual(self.stats.counts, {'vccs_factor_rejected': 1})
+
+    def test_timed_out_factor_queued(self):
+        pool = PasswordFactorPool(processes=1, queue_size=1, timeout=0.2, stats=self.stats)
+        self.addCleanup(lambda: pool._pool.terminate())
+        with self.assertRaises(PasswordFactorTimeout):
+            pool.apply(time.sleep, (1,), self.stats)
+        # The timed out computation is still in the queue, and reported in the queue depth
+        with self.assertRaises(PasswordFactorBusy):
+            pool.make_password_factor('abcd', '1234')
+        self.assertEqual(self.stats.gauges, {'vccs_factor_queue_depth': 1})
+        self.assertEqual(self.stats.counts, {'vccs_factor_timeout': 1, 'vccs_factor_rejected': 1})
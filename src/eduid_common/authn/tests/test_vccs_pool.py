@@ -0,0 +1,115 @@
+import os
+import json
+import threading
+import unittest
+
+from six.moves import BaseHTTPServer
+from six.moves.urllib.parse import parse_qs
+
+import vccs_client
+
+from eduid_common.authn import vccs_pool
+from eduid_common.authn.testing import VCCSStandInServer
+from eduid_common.authn.vccs_pool import PooledVCCSClient, get_pooled_vccs_client, configure_vccs_clients
+
+
+class FakeVCCSHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+
+    protocol_version = 'HTTP/1.1'
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers['Content-Length']))
+        self.server.requests.append((self.path, self.client_address, parse_qs(body)))
+        if self.path == '/authenticate':
+            data = json.dumps({'auth_response': {'version': 1, 'authenticated': True}})
+            self.send_response(200)
+        else:
+            data = 'Not found'
+            self.send_response(404)
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, *args):
+        pass
+
+
+class PooledVCCSClientTests(unittest.TestCase):
+
+    def setUp(self):
+        self.server = BaseHTTPServer.HTTPServer(('127.0.0.1', 0), FakeVCCSHandler)
+        self.server.requests = []
+        thread = threading.Thread(target=self.server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        self.url = 'http://127.0.0.1:{!s}/'.format(self.server.server_port)
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def test_keep_alive(self):
+        client = PooledVCCSClient(self.url)
+        response = client._execute_request_response('authenticate', {'request': '{}'})
+        self.assertEqual(json.loads(response)['auth_response']['authenticated'], True)
+        client._execute_request_response('authenticate', {'request': '{}'})
+        self.assertEqual(len(self.server.requests), 2)
+        self.assertEqual(self.server.requests[0][2], {'request': ['{}']})
+        # Both requests were sent over the same connection
+        self.assertEqual(self.server.requests[0][1], self.server.requests[1][1])
+
+    def test_http_error(self):
+        client = PooledVCCSClient(self.url)
+        with self.assertRaises(vccs_client.VCCSClientHTTPError):
+            client._execute_request_response('unknown', {'request': '{}'})
+
+    def test_registry(self):
+        client = get_pooled_vccs_client(self.url)
+        self.assertIsInstance(client, PooledVCCSClient)
+        self.assertIs(get_pooled_vccs_client(self.url), client)
+        self.assertIsNot(get_pooled_vccs_client(self.url + 'other/'), client)
+        self.addCleanup(configure_vccs_clients, read_timeout=vccs_pool._settings['read_timeout'])
+        configure_vccs_clients(read_timeout=1)
+        client2 = get_pooled_vccs_client(self.url)
+        self.assertIsNot(client2, client)
+        self.assertEqual(client2.timeout.read_timeout, 1)
+
+    def test_configure_unchanged(self):
+        client = get_pooled_vccs_client(self.url)
+        configure_vccs_clients(**dict((key, vccs_pool._settings[key])
+                                      for key in ('connect_timeout', 'read_timeout', 'pool_size')))
+        self.assertIs(get_pooled_vccs_client(self.url), client)
+
+    def test_fork_safety(self):
+        client = get_pooled_vccs_client(self.url)
+        # As seen from a forked child process
+        vccs_pool._clients_pid = os.getpid() + 1
+        self.assertIsNot(get_pooled_vccs_client(self.url), client)
+
+
+class VCCSStandInServerTests(unittest.TestCase):
+
+    def setUp(self):
+        self.server = VCCSStandInServer()
+        self.server.start()
+        self.addCleanup(self.server.stop)
+        self.client = PooledVCCSClient(self.server.url)
+
+    def test_password_flow(self):
+        factor = vccs_client.VCCSPasswordFactor('abcd', credential_id='1')
+        self.assertTrue(self.client.add_credentials('user', [factor]))
+        # Adding the same credential again fails
+        self.assertFalse(self.client.add_credentials('user', [factor]))
+
+        good = vccs_client.VCCSPasswordFactor('abcd', credential_id='1', salt=factor.salt)
+        bad = vccs_client.VCCSPasswordFactor('fghi', credential_id='1', salt=factor.salt)
+        self.assertTrue(self.client.authenticate('user', [good]))
+        self.assertFalse(self.client.authenticate('user', [bad]))
+        self.assertFalse(self.client.authenticate('other', [good]))
+
+        revoke = vccs_client.VCCSRevokeFactor('1', 'testing', reference='test')
+        self.assertTrue(self.client.revoke_credentials('user', [revoke]))
+        self.assertFalse(self.client.authenticate('user', [good]))
+        # Revoking an unknown credential is an error, like in the VCCS backend
+        with self.assertRaises(vccs_client.VCCSClientHTTPError):
+            self.client.revoke_credentials('user', [revoke])
@@ -0,0 +1,95 @@
+import os
+import time
+import base64
+import shutil
+import tempfile
+import unittest
+from xml.etree.ElementTree import ParseError
+
+from saml2.config import SPConfig
+from saml2.sigver import get_xmlsec_binary, SigverError
+
+from eduid_common.authn import verification
+from eduid_common.authn.utils import get_saml2_config
+from eduid_common.authn.verification import SAMLVerificationPool, SAMLVerificationBusy, get_verification_pool
+
+SETTINGS = """
+SAML_CONFIG = {{
+    'entityid': 'https://sp.example.com/reloaded',
+    'xmlsec_binary': '{xmlsec_binary}',
+    'service': {{'sp': {{'endpoints': {{}}}}}},
+}}
+"""
+
+
+class CountingStats(object):
+
+    def __init__(self):
+        self.counts = {}
+        self.gauges = {}
+        self.timings = []
+
+    def count(self, name, value=1):
+        self.counts[name] = self.counts.get(name, 0) + value
+
+    def gauge(self, name, value):
+        self.gauges[name] = value
+
+    def timing(self, name, value):
+        self.timings.append(name)
+
+
+class SAMLVerificationPoolTests(unittest.TestCase):
+
+    def setUp(self):
+        try:
+            self.xmlsec_binary = get_xmlsec_binary()
+        except SigverError:
+            self.skipTest('xmlsec1 not installed')
+        self.saml2_config = SPConfig()
+        self.saml2_config.load({
+            'entityid': 'https://sp.example.com/',
+            'xmlsec_binary': self.xmlsec_binary,
+            'service': {'sp': {'endpoints': {}}},
+        })
+        self.stats = CountingStats()
+
+    def test_not_configured(self):
+        self.assertIsNone(get_verification_pool({}, self.saml2_config))
+        pool = get_verification_pool({'SAML2_VERIFY_PROCESSES': 1}, self.saml2_config)
+        self.assertIs(get_verification_pool({'SAML2_VERIFY_PROCESSES': 1}, self.saml2_config), pool)
+        self.assertEqual(pool.queue_size, 4)
+
+    def test_error_raised(self):
+        pool = SAMLVerificationPool(self.saml2_config, processes=1, queue_size=2, timeout=10)
+        self.addCleanup(lambda: pool._pool.terminate())
+        with self.assertRaises(ParseError):
+            pool.verify_authn_response(base64.b64encode(b'<not-xml'), {}, self.stats)
+        self.assertEqual(self.stats.gauges, {'saml2_verify_queue_depth': 1})
+        self.assertEqual(self.stats.timings, ['saml2_verify_time'])
+        self.assertEqual(pool._pending, 0)
+
+    def test_queue_full(self):
+        pool = SAMLVerificationPool(self.saml2_config, processes=1, queue_size=0, timeout=10)
+        with self.assertRaises(SAMLVerificationBusy):
+            pool.verify_authn_response(base64.b64encode(b'<not-xml/>'), {}, self.stats)
+        self.assertEqual(self.stats.counts, {'saml2_verify_rejected': 1})
+
+    def test_pool_closed_on_reload(self):
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        module_path = os.path.join(tmpdir, 'saml2_settings.py')
+        with open(module_path, 'w') as f:
+            f.write(SETTINGS.format(xmlsec_binary=self.xmlsec_binary))
+        pools = []
+        for i in range(3):
+            mtime = time.time() + 10 * i
+            os.utime(module_path, (mtime, mtime))
+            pool = get_verification_pool({'SAML2_VERIFY_PROCESSES': 1}, get_saml2_config(module_path))
+            pool.start()
+            pools.append(pool)
+        self.addCleanup(pools[-1].close)
+        self.assertEqual([x for x in verification._pools.values() if x.saml2_config.entityid.endswith('/reloaded')],
+                         [pools[-1]])
+        self.assertEqual([x._pool for x in pools[:2]], [None, None])
+        self.assertIsNotNone(pools[-1]._pool)
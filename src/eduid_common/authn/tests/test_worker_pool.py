@@ -0,0 +1,96 @@
+import os
+import time
+import unittest
+
+from eduid_common.authn.worker_pool import BoundedProcessPool, WorkerPoolBusy, WorkerPoolTimeout
+from eduid_common.authn.tests.test_verification import CountingStats
+
+
+class ExamplePool(BoundedProcessPool):
+    name = 'Test'
+    metric_prefix = 'test'
+    timing_metric = 'test_time'
+
+
+class Unpicklable(Exception):
+
+    def __reduce__(self):
+        raise TypeError('not picklable')
+
+
+def _raise_unpicklable():
+    raise Unpicklable('error')
+
+
+class BoundedProcessPoolTests(unittest.TestCase):
+
+    def setUp(self):
+        self.stats = CountingStats()
+
+    def _pool(self, queue_size=2, timeout=10, recycle_after=None):
+        pool = ExamplePool(processes=1, queue_size=queue_size, timeout=timeout, recycle_after=recycle_after)
+        pool.start()
+        self.addCleanup(self._terminate, pool)
+        self.addCleanup(pool._pool.terminate)
+        return pool
+
+    @staticmethod
+    def _terminate(pool):
+        if pool._pool is not None:
+            pool._pool.terminate()
+
+    def test_apply(self):
+        pool = self._pool()
+        self.assertEqual(pool.apply(divmod, (7, 2), self.stats), (3, 1))
+        self.assertEqual(pool._pending, 0)
+        self.assertEqual(self.stats.gauges, {'test_queue_depth': 1})
+        self.assertEqual(self.stats.timings, ['test_time'])
+
+    def test_error(self):
+        pool = self._pool()
+        with self.assertRaises(ZeroDivisionError):
+            pool.apply(divmod, (7, 0), self.stats)
+        with self.assertRaises(ValueError):
+            pool.apply(_raise_unpicklable, (), self.stats)
+        self.assertEqual(pool._pending, 0)
+
+    def test_queue_full(self):
+        pool = self._pool(queue_size=0)
+        with self.assertRaises(WorkerPoolBusy):
+            pool.apply(divmod, (7, 2), self.stats)
+        self.assertEqual(self.stats.counts, {'test_rejected': 1})
+
+    def test_slow_call_keeps_slot(self):
+        pool = self._pool(queue_size=1, timeout=0.5)
+        with self.assertRaises(WorkerPoolTimeout):
+            pool.apply(time.sleep, (2,), self.stats)
+        # The worker is still busy with the call that timed out
+        self.assertEqual(pool._pending, 1)
+        with self.assertRaises(WorkerPoolBusy):
+            pool.apply(divmod, (7, 2), self.stats)
+        self.assertEqual(self.stats.counts, {'test_timeout': 1, 'test_rejected': 1})
+        # The slot is released when the worker has finished the call
+        time.sleep(2)
+        self.assertEqual(pool._pending, 0)
+        self.assertEqual(pool.apply(divmod, (7, 2), self.stats), (3, 1))
+
+    def test_worker_died(self):
+        pool = self._pool(queue_size=1, timeout=0.5, recycle_after=1)
+        mp_pool = pool._pool
+        with self.assertRaises(WorkerPoolTimeout):
+            pool.apply(os._exit, (1,), self.stats)
+        # The lost call keeps its slot until the pool is recycled
+        with self.assertRaises(WorkerPoolBusy):
+            pool.apply(divmod, (7, 2), self.stats)
+        time.sleep(1)
+        self.assertEqual(pool.apply(divmod, (7, 2), self.stats), (3, 1))
+        self.assertIsNot(pool._pool, mp_pool)
+        self.assertEqual(pool._pending, 0)
+        self.assertEqual(self.stats.counts, {'test_timeout': 1, 'test_rejected': 1, 'test_recycled': 1})
+
+    def test_close(self):
+        pool = self._pool()
+        mp_pool = pool._pool
+        pool.close()
+        self.assertIsNone(pool._pool)
+        mp_pool.join()
@@ -31,22 +31,162 @@
 #
 
 
+import os
 import imp
+import copy
+import threading
+from flask import g, has_app_context
 from saml2.config import SPConfig
 from pwgen import pwgen
 
 from eduid_common.api.utils import urlappend
+from eduid_common.authn.metadata import get_metadata_files
 
 import logging
 logger = logging.getLogger(__name__)
 
 
-def get_saml2_config(module_path):
+# Parsed SPConfig objects, keyed by settings module path:
+# {module_path: (watched files, their mtimes, SPConfig)}
+_saml2_config_cache = {}
+_saml2_config_lock = threading.Lock()
 
-    module = imp.load_source('saml2_settings', module_path)
 
-    conf = SPConfig()
-    conf.load(module.SAML_CONFIG)
+def _get_mtimes(files):
+    mtimes = []
+    for path in files:
+        try:
+            mtimes.append(os.path.getmtime(path))
+        except OSError:
+            mtimes.append(None)
+    return tuple(mtimes)
+
+
+# Functions called with the SPConfig objects replaced when get_saml2_config
+# reloads a configuration, see on_saml2_config_released
+_release_callbacks = []
+
+
+def on_saml2_config_released(callback):
+    """
+    Register a function to call with an SP configuration from get_saml2_config
+    when it has been replaced by a reloaded configuration, to release what has
+    been set up for it (e.g. a Saml2Client template).
+
+    :param callback: Function taking the released SPConfig
+    :type callback: callable
+    """
+    _release_callbacks.append(callback)
+
+
+def _release_saml2_config(conf):
+    """
+    Release an SP configuration that has been replaced, and the copies of it
+    made by configure_crypto_backend.
+
+    :param conf: SP configuration that has been replaced
+    :type conf: saml2.config.SPConfig
+    """
+    released = [conf]
+    for key in list(_backend_configs.keys()):
+        if key[0] is conf:
+            released.append(_backend_configs.pop(key, None))
+    for this in released:
+        if this is None:
+            continue
+        for callback in _release_callbacks:
+            try:
+                callback(this)
+            except Exception:
+                logger.exception('Failed releasing SAML2 configuration {!r}'.format(this))
+
+
+def _get_cached_saml2_config(module_path):
+    cached = _saml2_config_cache.get(module_path)
+    if cached is not None:
+        files, mtimes, conf = cached
+        if _get_mtimes(files) == mtimes:
+            return conf
+    return None
+
+
+def get_saml2_config(module_path, use_cache=True):
+    """
+    Load the pysaml2 SP configuration from the SAML_CONFIG in a python settings module.
+
+    Loading the configuration parses the federation metadata, which is slow for
+    large federations, so the result is cached per process and only re-loaded
+    when the modification time of the settings module, or of a local metadata
+    file or snapshot it uses (see eduid_common.authn.metadata), changes.
+
+    The returned SPConfig is shared, and must not be modified by the caller.
+
+    :param module_path: Path to the settings module
+    :param use_cache: Whether a cached configuration may be returned
+
+    :type module_path: str | unicode
+    :type use_cache: bool
+    :rtype: saml2.config.SPConfig
+    """
+    if use_cache:
+        conf = _get_cached_saml2_config(module_path)
+        if conf is not None:
+            return conf
+
+    with _saml2_config_lock:
+        if use_cache:
+            # Another thread might have loaded it while we waited for the lock
+            conf = _get_cached_saml2_config(module_path)
+            if conf is not None:
+                return conf
+        logger.debug('Loading SAML2 configuration from {!s}'.format(module_path))
+        files = [module_path]
+        mtimes = _get_mtimes(files)
+        module = imp.load_source('saml2_settings', module_path)
+        files += get_metadata_files(module.SAML_CONFIG)
+        mtimes += _get_mtimes(files[1:])
+
+        conf = SPConfig()
+        conf.load(module.SAML_CONFIG)
+        replaced = _saml2_config_cache.get(module_path)
+        _saml2_config_cache[module_path] = (files, mtimes, conf)
+        if replaced is not None:
+            _release_saml2_config(replaced[2])
+    return conf
+
+
+# SP configurations with the crypto backend overridden: {(SPConfig, crypto_backend): SPConfig}
+_backend_configs = {}
+
+
+def configure_crypto_backend(saml2_config, crypto_backend=None):
+    """
+    Get the SP configuration using a specific pysaml2 crypto backend for
+    signing and signature verification, 'xmlsec1' (the default, forking the
+    xmlsec1 binary for every operation) or 'XMLSecurity' (in-process, using
+    pyXMLSecurity).
+
+    The configuration is not modified, a (shallow) copy with the backend set
+    is returned. The same copy is returned on every call, so that it can be
+    used as a cache key like the configurations from get_saml2_config, until
+    get_saml2_config replaces the configuration (the copy is then released
+    together with it, see on_saml2_config_released).
+
+    :param saml2_config: The SAML2 SP configuration
+    :param crypto_backend: The crypto backend, None to use the one in saml2_config
+
+    :type saml2_config: saml2.config.SPConfig
+    :type crypto_backend: str | unicode | None
+    :rtype: saml2.config.SPConfig
+    """
+    if not crypto_backend or crypto_backend == saml2_config.crypto_backend:
+        return saml2_config
+    key = (saml2_config, crypto_backend)
+    conf = _backend_configs.get(key)
+    if conf is None:
+        conf = copy.copy(saml2_config)
+        conf.crypto_backend = crypto_backend
+        _backend_configs[key] = conf
     return conf
 
 
@@ -61,6 +201,98 @@ def get_location(http_info):
     return header_value
 
 
+class SAMLAttributes(object):
+    """
+    Case insensitive view of the SAML attributes in a pysaml2 session_info,
+    with properties for the attributes used by eduID.
+
+    :param session_info: pysaml2 response.session_info()
+    :type session_info: dict
+    """
+
+    def __init__(self, session_info):
+        if 'ava' not in session_info:
+            raise ValueError('SAML attributes (ava) not found in session_info')
+        self.ava = session_info['ava']
+        logger.debug('SAML attributes received: {!s}'.format(self.ava))
+        self._index = dict([(name.lower(), values) for name, values in self.ava.items()])
+
+    def get(self, attr_name, default=None):
+        """
+        :param attr_name: Attribute name, in any case
+        :type attr_name: str | unicode
+
+        :return: Attribute values
+        :rtype: list | None
+        """
+        return self._index.get(attr_name.lower(), default)
+
+    def get_single(self, attr_name):
+        """
+        :return: The first value of the attribute, or None
+        :rtype: str | unicode | None
+        """
+        values = self.get(attr_name)
+        if not values:
+            return None
+        return values[0]
+
+    @property
+    def eppn(self):
+        return self.get_single('eduPersonPrincipalName')
+
+    @property
+    def mail(self):
+        return self.get('mail', [])
+
+    @property
+    def display_name(self):
+        return self.get_single('displayName')
+
+    @property
+    def given_name(self):
+        return self.get_single('givenName')
+
+    @property
+    def surname(self):
+        return self.get_single('sn')
+
+    @property
+    def nin(self):
+        return self.get_single('norEduPersonNIN')
+
+    @property
+    def assurance(self):
+        return self.get('eduPersonAssurance', [])
+
+
+def get_saml_attributes(session_info):
+    """
+    Get the SAMLAttributes for session_info, created once per session_info
+    and request. Outside of a Flask app context, a new SAMLAttributes is
+    created on every call.
+
+    :param session_info: pysaml2 response.session_info()
+    :type session_info: dict
+
+    :rtype: SAMLAttributes
+    """
+    if not has_app_context():
+        return SAMLAttributes(session_info)
+    # [(ava, SAMLAttributes)] of the current request
+    saml_attributes = getattr(g, 'saml_attributes', None)
+    if saml_attributes is None:
+        saml_attributes = g.saml_attributes = []
+    ava = session_info.get('ava')
+    for cached_ava, attributes in saml_attributes:
+        # The list holds a reference to ava, so its id can not be reused
+        if cached_ava is ava:
+            return attributes
+    attributes = SAMLAttributes(session_info)
+    saml_attributes.append((ava, attributes))
+    return attributes
+
+
 def get_saml_attribute(session_info, attr_name):
     """
     Get value from a SAML attribute received from the SAML IdP.
@@ -78,18 +310,7 @@ def get_saml_attribute(session_info, attr_name):
     :type attr_name: string()
     :rtype: [string()]
     """
-    if not 'ava' in session_info:
-        raise ValueError('SAML attributes (ava) not found in session_info')
-
-    attributes = session_info['ava']
-
-    logger.debug('SAML attributes received: %s' % attributes)
-
-    attr_name = attr_name.lower()
-    # Look for the canonicalized attribute in the SAML assertion attributes
-    for saml_attr, local_fields in attributes.items():
-        if saml_attr.lower() == attr_name:
-            return attributes[saml_attr]
+    return get_saml_attributes(session_info).get(attr_name)
 
 
 def no_authn_views(app, paths):
@@ -109,6 +330,8 @@ def no_authn_views(app, paths):
         no_auth_regex = '^{!s}$'.format(urlappend(app_root, path))
         if no_auth_regex not in app.config['NO_AUTHN_URLS']:
             app.config['NO_AUTHN_URLS'].append(no_auth_regex)
+    # Have eduid_common.authn.middleware.AuthnApp recompile the whitelist
+    app.no_authn_matcher = None
     return app
 
 
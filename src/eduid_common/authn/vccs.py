@@ -30,10 +30,19 @@
 # POSSIBILITY OF SUCH DAMAGE.
 #
 
+import os
+import time
+import threading
+from multiprocessing import TimeoutError
+from multiprocessing.pool import ThreadPool
+
 from bson import ObjectId
 from eduid_userdb.dashboard import DashboardLegacyUser, DashboardUser
 from eduid_userdb.credentials import Password
 from eduid_common.api.decorators import deprecated
+from eduid_common.authn.vccs_guard import get_guarded_vccs_client, get_vccs_stats
+from eduid_common.authn.vccs_hashing import make_password_factor, get_factor_timeout
+from eduid_common.authn.vccs_pool import get_vccs_timeout
 
 import vccs_client
 
@@ -43,16 +52,79 @@ logger = logging.getLogger(__name__)
 
 def get_vccs_client(vccs_url):
     """
-    Instantiate a VCCS client.
+    Get the VCCS client for vccs_url, shared by all threads of the process
+    and keeping its connections to the backend open, see
+    eduid_common.authn.vccs_pool. Calls to the backend are timed and
+    guarded by a circuit breaker, see eduid_common.authn.vccs_guard.
 
     :param vccs_url: VCCS authentication backend URL
     :type vccs_url: string
     :return: vccs client
-    :rtype: VCCSClient
+    :rtype: eduid_common.authn.vccs_guard.GuardedVCCSClient
+    """
+    return get_guarded_vccs_client(vccs_url)
+
+
+# Threads checking the credentials of a user concurrently, see configure_password_checks
+_check_threads = 0
+_check_pool = None
+_check_pool_pid = None
+_check_pool_lock = threading.Lock()
+
+
+def configure_password_checks(threads):
+    """
+    Make check_password check the passwords of users with more than one
+    password concurrently, using a pool of threads shared by all requests.
+
+    The VCCS backend only authenticates a request if all the factors in it
+    match, so the passwords can not be checked in a single request. Checking
+    them concurrently makes the time to check a wrong password independent of
+    the number of passwords the user has.
+
+    The setting is shared by all apps in the process, the pool is kept if
+    the number of threads is unchanged.
+
+    :param threads: Number of threads, 0 to check the passwords one at a time
+    :type threads: int
+    """
+    global _check_threads, _check_pool
+    with _check_pool_lock:
+        if int(threads) == _check_threads:
+            return
+        _check_threads = int(threads)
+        if _check_pool is not None and _check_pool_pid == os.getpid():
+            _check_pool.close()
+        _check_pool = None
+
+
+def _get_check_pool():
+    """
+    :rtype: multiprocessing.pool.ThreadPool | None
+    """
+    global _check_pool, _check_pool_pid
+    if not _check_threads:
+        return None
+    with _check_pool_lock:
+        # The threads of a pool created before a fork do not exist in the child process
+        if _check_pool is None or _check_pool_pid != os.getpid():
+            _check_pool = ThreadPool(_check_threads)
+            _check_pool_pid = os.getpid()
+        return _check_pool
+
+
+def _check_password_credential(vccs, user_id, password, user_password):
     """
-    return vccs_client.VCCSClient(
-        base_url=vccs_url,
-    )
+    :return: Whether password matches user_password, False if it could not be checked
+    :rtype: bool
+    """
+    try:
+        factor = make_password_factor(password, credential_id=str(user_password.key), salt=user_password.salt)
+        return bool(vccs.authenticate(user_id, [factor]))
+    except Exception as exc:
+        logger.error("VCCS authentication threw exception: {!s}".format(exc))
+        get_vccs_stats().count('vccs_check_password_error')
+    return False
 
 
 def check_password(vccs_url, password, user, vccs=None):
@@ -60,6 +132,14 @@ def check_password(vccs_url, password, user, vccs=None):
 
     Returns False or a dict with data about the credential that validated.
 
+    If the user has more than one password and configure_password_checks has
+    been called, the passwords are checked concurrently.
+
+    A password that can not be checked, because the password factor can not
+    be computed or the VCCS backend fails, is logged and does not match. The
+    concurrent checks are given the time of a factor computation and a VCCS
+    call for each round of checks, plus one round for waiting for a thread.
+
     :param vccs_url: URL to VCCS authentication backend
     :param password: plaintext password
     :param user: user dict
@@ -78,17 +158,30 @@ def check_password(vccs_url, password, user, vccs=None):
     if isinstance(user, DashboardLegacyUser):
         user = DashboardUser(data=user._mongo_doc)
 
-    for user_password in user.credentials.filter(Password).to_list():
-        factor = vccs_client.VCCSPasswordFactor(
-            password,
-            credential_id=str(user_password.key),
-            salt=user_password.salt,
-            )
+    user_id = str(user.user_id)
+    user_passwords = user.credentials.filter(Password).to_list()
+    pool = None
+    if len(user_passwords) > 1:
+        pool = _get_check_pool()
+
+    if pool is None:
+        for user_password in user_passwords:
+            if _check_password_credential(vccs, user_id, password, user_password):
+                return user_password
+        return False
+
+    rounds = -(-len(user_passwords) // _check_threads) + 1
+    deadline = time.time() + rounds * (get_factor_timeout() + get_vccs_timeout())
+    results = [pool.apply_async(_check_password_credential, (vccs, user_id, password, user_password))
+               for user_password in user_passwords]
+    # Return the first matching password in the same order as when checking one at a time
+    for user_password, result in zip(user_passwords, results):
         try:
-            if vccs.authenticate(str(user.user_id), [factor]):
+            if result.get(max(deadline - time.time(), 0)):
                 return user_password
-        except Exception as exc:
-            logger.error("VCCS authentication threw exception: {!s}".format(exc))
+        except TimeoutError:
+            logger.error("VCCS authentication of credential {!s} timed out".format(user_password.key))
+            get_vccs_stats().count('vccs_check_password_timeout')
     return False
 
 
@@ -114,7 +207,7 @@ def add_password(user, new_password, application, vccs_url=None, vccs=None):
 
     credential_id = ObjectId()
     # TODO: Init VCCSPasswordFactor with password hash instead of plain text password
-    new_factor = vccs_client.VCCSPasswordFactor(new_password, credential_id=str(credential_id))
+    new_factor = make_password_factor(new_password, credential_id=str(credential_id))
 
     # Add the new password
     if not vccs.add_credentials(str(user.user_id), [new_factor]):
@@ -150,7 +243,7 @@ def reset_password(user, new_password, application, vccs_url=None, vccs=None):
 
     credential_id = ObjectId()
     # TODO: Init VCCSPasswordFactor with password hash instead of plain text password
-    new_factor = vccs_client.VCCSPasswordFactor(new_password, credential_id=str(credential_id))
+    new_factor = make_password_factor(new_password, credential_id=str(credential_id))
 
     # Revoke all existing passwords
     user = revoke_passwords(user, 'password reset', application=application, vccs=vccs)
@@ -191,7 +284,7 @@ def change_password(user, new_password, old_password, application, vccs_url=None
 
     credential_id = ObjectId()
     # TODO: Init VCCSPasswordFactor with password hash instead of plain text password
-    new_factor = vccs_client.VCCSPasswordFactor(new_password, credential_id=str(credential_id))
+    new_factor = make_password_factor(new_password, credential_id=str(credential_id))
     del new_password  # don't need it anymore, try to forget it
 
     # Check the old password and turn it in to a RevokeFactor
@@ -251,7 +344,7 @@ def add_credentials(vccs_url, old_password, new_password, user, source='dashboar
         vccs = get_vccs_client(vccs_url)
 
     credential_id = ObjectId()
-    new_factor = vccs_client.VCCSPasswordFactor(new_password, credential_id=str(credential_id))
+    new_factor = make_password_factor(new_password, credential_id=str(credential_id))
 
     old_factor = None
     checked_password = None
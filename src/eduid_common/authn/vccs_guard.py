@@ -0,0 +1,230 @@
+# -*- coding: utf-8 -*-
+"""
+Protection of the web workers from a slow or unreachable VCCS backend.
+
+The clients returned by get_guarded_vccs_client time every call to the VCCS
+backend, and can limit the number of threads per process waiting for the
+backend, and fail fast while the backend is failing:
+
+  * With VCCS_MAX_CONCURRENT set, calls beyond that many concurrent calls are
+    rejected at once instead of tying up another thread.
+
+  * With VCCS_BREAKER_FAILURES set, the circuit opens after that many
+    consecutive calls failing with VCCSConnectionError (connection errors and
+    timeouts, not error responses from the backend). While open, calls are
+    rejected at once. After VCCS_BREAKER_RESET_TIMEOUT seconds (default 30), a
+    single call is let through as a probe, closing the circuit again if it
+    succeeds and keeping it open for another period if it fails.
+
+Rejected calls raise VCCSUnavailable, a VCCSConnectionError, so callers treat
+them like a backend that can not be reached.
+
+Metrics (see eduid_common.stats):
+
+    vccs_<method>_time      timing (ms) of authenticate, add_credentials and revoke_credentials
+    vccs_<method>_error     count, calls failing with VCCSConnectionError
+    vccs_rejected_busy      count, calls rejected because of VCCS_MAX_CONCURRENT
+    vccs_rejected_open      count, calls rejected because the circuit was open
+    vccs_circuit_opened     count, times the circuit has opened
+"""
+
+from __future__ import absolute_import
+
+import os
+import time
+import threading
+
+from eduid_common.authn.vccs_pool import get_pooled_vccs_client, VCCSConnectionError
+from eduid_common.stats import NoOpStats
+
+import logging
+logger = logging.getLogger(__name__)
+
+
+class VCCSUnavailable(VCCSConnectionError):
+    """
+    The call was rejected without contacting the VCCS backend.
+    """
+    def __init__(self, reason):
+        super(VCCSUnavailable, self).__init__(reason, 503)
+
+
+class GuardedVCCSClient(object):
+    """
+    VCCS client wrapper with timing, a concurrency limit and a circuit breaker.
+
+    :param client: The VCCS client to wrap
+    :param stats: Statistics object
+    :param max_concurrent: Max number of concurrent calls, 0 for no limit
+    :param failure_threshold: Consecutive failures opening the circuit, 0 to never open it
+    :param reset_timeout: Seconds the circuit stays open before a probe is let through
+
+    :type client: vccs_client.VCCSClient
+    :type stats: eduid_common.stats.NoOpStats | eduid_common.stats.Statsd
+    :type max_concurrent: int
+    :type failure_threshold: int
+    :type reset_timeout: int | float
+    """
+
+    def __init__(self, client, stats, max_concurrent=0, failure_threshold=0, reset_timeout=30):
+        self.client = client
+        self.stats = stats
+        self.max_concurrent = max_concurrent
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self._lock = threading.Lock()
+        self._in_flight = 0
+        self._failures = 0
+        # The circuit is open until this time, None when closed
+        self._open_until = None
+        self._probing = False
+
+    @property
+    def base_url(self):
+        return self.client.base_url
+
+    def authenticate(self, user_id, factors):
+        return self._call('authenticate', user_id, factors)
+
+    def add_credentials(self, user_id, factors):
+        return self._call('add_credentials', user_id, factors)
+
+    def revoke_credentials(self, user_id, factors):
+        return self._call('revoke_credentials', user_id, factors)
+
+    def _enter(self, now):
+        """
+        :return: Whether the call is a probe of an open circuit
+        :rtype: bool
+        """
+        with self._lock:
+            probe = False
+            if self._open_until is not None:
+                if now < self._open_until or self._probing:
+                    self.stats.count('vccs_rejected_open')
+                    raise VCCSUnavailable('VCCS circuit open')
+                self._probing = probe = True
+            if self.max_concurrent and self._in_flight >= self.max_concurrent:
+                self._probing = False
+                self.stats.count('vccs_rejected_busy')
+                raise VCCSUnavailable('Too many concurrent VCCS calls ({!s})'.format(self._in_flight))
+            self._in_flight += 1
+            return probe
+
+    def _exit(self, probe, failed):
+        with self._lock:
+            self._in_flight -= 1
+            if probe:
+                self._probing = False
+            if not failed:
+                if self._open_until is not None and probe:
+                    logger.info('VCCS backend {!s} recovered, closing circuit'.format(self.base_url))
+                    self._open_until = None
+                self._failures = 0
+                return
+            self._failures += 1
+            if self.failure_threshold and (probe or self._failures >= self.failure_threshold):
+                if not probe:
+                    logger.warning('VCCS backend {!s} failed {!s} times, opening circuit for {!s}s'.format(
+                        self.base_url, self._failures, self.reset_timeout))
+                    self.stats.count('vccs_circuit_opened')
+                self._open_until = time.time() + self.reset_timeout
+
+    def _call(self, method, user_id, factors):
+        t0 = time.time()
+        probe = self._enter(t0)
+        failed = False
+        try:
+            return getattr(self.client, method)(user_id, factors)
+        except VCCSConnectionError:
+            failed = True
+            self.stats.count('vccs_{!s}_error'.format(method))
+            raise
+        finally:
+            self._exit(probe, failed)
+            self.stats.timing('vccs_{!s}_time'.format(method), int((time.time() - t0) * 1000))
+
+
+# Settings for the clients created by get_guarded_vccs_client, see configure_vccs_guard
+_settings = {
+    'stats': NoOpStats(),
+    'max_concurrent': 0,
+    'failure_threshold': 0,
+    'reset_timeout': 30.0,
+}
+
+# {vccs_url: GuardedVCCSClient}
+_guards = {}
+_guards_pid = None
+_guards_lock = threading.Lock()
+
+
+def configure_vccs_guard(stats=None, max_concurrent=None, failure_threshold=None, reset_timeout=None):
+    """
+    Set the statistics object, concurrency limit and circuit breaker settings
+    of the clients created by get_guarded_vccs_client from now on.
+
+    The settings are shared by all apps in the process. The clients already
+    created, and the state of their circuit breakers, are kept if the
+    concurrency limit and circuit breaker settings are unchanged; they are
+    given the new statistics object.
+
+    :type stats: eduid_common.stats.NoOpStats | eduid_common.stats.Statsd | None
+    :type max_concurrent: int | None
+    :type failure_threshold: int | None
+    :type reset_timeout: int | float | None
+    """
+    with _guards_lock:
+        settings = dict(_settings)
+        if stats is not None:
+            settings['stats'] = stats
+        if max_concurrent is not None:
+            settings['max_concurrent'] = int(max_concurrent)
+        if failure_threshold is not None:
+            settings['failure_threshold'] = int(failure_threshold)
+        if reset_timeout is not None:
+            settings['reset_timeout'] = float(reset_timeout)
+        limits_changed = any(settings[key] != _settings[key]
+                             for key in ('max_concurrent', 'failure_threshold', 'reset_timeout'))
+        _settings.update(settings)
+        if limits_changed:
+            _guards.clear()
+            return
+        for guard in _guards.values():
+            guard.stats = _settings['stats']
+
+
+def get_vccs_stats():
+    """
+    :return: The statistics object of the guarded VCCS clients
+    :rtype: eduid_common.stats.NoOpStats | eduid_common.stats.Statsd
+    """
+    return _settings['stats']
+
+
+def get_guarded_vccs_client(vccs_url):
+    """
+    Get the guarded VCCS client for vccs_url of this process, wrapping the
+    client from eduid_common.authn.vccs_pool.get_pooled_vccs_client.
+
+    :param vccs_url: VCCS authentication backend URL
+    :type vccs_url: str | unicode
+
+    :rtype: GuardedVCCSClient
+    """
+    global _guards_pid
+    client = get_pooled_vccs_client(vccs_url)
+    if _guards_pid == os.getpid():
+        guard = _guards.get(vccs_url)
+        if guard is not None and guard.client is client:
+            return guard
+    with _guards_lock:
+        if _guards_pid != os.getpid():
+            _guards.clear()
+            _guards_pid = os.getpid()
+        guard = _guards.get(vccs_url)
+        # The pooled client is replaced when reconfigured, or in a forked child
+        if guard is None or guard.client is not client:
+            guard = GuardedVCCSClient(client, **_settings)
+            _guards[vccs_url] = guard
+    return guard
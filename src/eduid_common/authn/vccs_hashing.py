@@ -0,0 +1,176 @@
+# -*- coding: utf-8 -*-
+"""
+Computation of VCCS password factors in a pool of worker processes.
+
+Creating a vccs_client.VCCSPasswordFactor does deliberately expensive key
+stretching, holding the GIL of the web worker while doing it. After
+configure_factor_pool has been called with processes > 0, make_password_factor
+computes the factors in a pool of that many worker processes instead, so that
+other threads of the web worker keep running during login peaks.
+
+Settings (see eduid_common.api.app):
+
+    VCCS_FACTOR_PROCESSES:  number of worker processes, 0 (default) to compute the factors in the calling thread
+    VCCS_FACTOR_QUEUE_SIZE: max number of factors queued in the pool or being computed, default 4 per process
+    VCCS_FACTOR_TIMEOUT:    seconds to wait for a factor, default 10
+
+A factor that timed out is still computed by the workers, and keeps its
+place in the queue until it is done. A lost factor (a dead worker) restarts
+the pool once it is VCCS_FACTOR_QUEUE_SIZE / VCCS_FACTOR_PROCESSES + 2
+timeouts old (see eduid_common.authn.worker_pool).
+
+Metrics (see eduid_common.stats):
+
+    vccs_factor_queue_depth  gauge, factors queued or being computed, including timed out ones
+    vccs_factor_hash_time    timing (ms), including the time spent waiting
+    vccs_factor_rejected     count, factors rejected because the queue was full
+    vccs_factor_timeout      count, factor computations that timed out
+    vccs_factor_recycled     count, pools restarted because a factor was lost
+"""
+
+from __future__ import absolute_import
+
+import threading
+
+import vccs_client
+
+from eduid_common.authn.worker_pool import BoundedProcessPool, WorkerPoolBusy, WorkerPoolTimeout
+from eduid_common.stats import NoOpStats
+
+import logging
+logger = logging.getLogger(__name__)
+
+
+class PasswordFactorBusy(WorkerPoolBusy):
+    """
+    The password factor queue is full.
+    """
+    pass
+
+
+class PasswordFactorTimeout(WorkerPoolTimeout):
+    """
+    The password factor was not computed in time.
+    """
+    pass
+
+
+def _make_factor(password, credential_id, salt):
+    return vccs_client.VCCSPasswordFactor(password, credential_id=credential_id, salt=salt)
+
+
+class PasswordFactorPool(BoundedProcessPool):
+    """
+    A pool of worker processes computing VCCS password factors.
+
+    :param processes: Number of worker processes
+    :param queue_size: Max number of factors queued or being computed
+    :param timeout: Seconds to wait for a factor
+    :param stats: Statistics object
+
+    :type processes: int
+    :type queue_size: int
+    :type timeout: int | float
+    :type stats: eduid_common.stats.NoOpStats | eduid_common.stats.Statsd
+    """
+
+    name = 'VCCS password factor'
+    metric_prefix = 'vccs_factor'
+    timing_metric = 'vccs_factor_hash_time'
+    busy_error = PasswordFactorBusy
+    timeout_error = PasswordFactorTimeout
+
+    def __init__(self, processes, queue_size, timeout, stats):
+        super(PasswordFactorPool, self).__init__(processes, queue_size, timeout)
+        self.stats = stats
+
+    def make_password_factor(self, password, credential_id, salt=None):
+        """
+        :param password: Plaintext password
+        :param credential_id: Credential id
+        :param salt: Salt of an existing password credential, None for a new one
+
+        :type password: str | unicode
+        :type credential_id: str
+        :type salt: str | None
+
+        :rtype: vccs_client.VCCSPasswordFactor
+        """
+        return self.apply(_make_factor, (password, credential_id, salt), self.stats)
+
+
+_factor_pool = None
+_factor_timeout = 10.0
+_factor_pool_lock = threading.Lock()
+
+
+def configure_factor_pool(processes, queue_size=None, timeout=10, stats=None):
+    """
+    Start the factor pool, called when the app is initialized.
+
+    The pool is shared by all apps in the process. The running pool, and
+    the factors queued in it, are kept if the settings are unchanged; it is
+    given the new statistics object.
+
+    :param processes: Number of worker processes, 0 to compute the factors in the calling thread
+    :param queue_size: Max number of factors queued or being computed, default 4 per process
+    :param timeout: Seconds to wait for a factor
+    :param stats: Statistics object
+
+    :type processes: int
+    :type queue_size: int | None
+    :type timeout: int | float
+    :type stats: eduid_common.stats.NoOpStats | eduid_common.stats.Statsd | None
+    """
+    global _factor_pool, _factor_timeout
+    processes = int(processes)
+    if queue_size is None:
+        queue_size = 4 * processes
+    queue_size = int(queue_size)
+    if stats is None:
+        stats = NoOpStats()
+    with _factor_pool_lock:
+        _factor_timeout = float(timeout)
+        pool = _factor_pool
+        if pool is not None and (pool.processes, pool.queue_size, pool.timeout) == (processes, queue_size,
+                                                                                    _factor_timeout):
+            pool.stats = stats
+            return
+        if pool is not None:
+            pool.close()
+            _factor_pool = None
+        if not processes:
+            return
+        _factor_pool = PasswordFactorPool(processes, queue_size, _factor_timeout, stats)
+        _factor_pool.start()
+
+
+def get_factor_timeout():
+    """
+    :return: Seconds to wait for a factor
+    :rtype: float
+    """
+    return _factor_timeout
+
+
+def make_password_factor(password, credential_id, salt=None):
+    """
+    Create a VCCS password factor, in the factor pool if one is configured.
+
+    :param password: Plaintext password
+    :param credential_id: Credential id
+    :param salt: Salt of an existing password credential, None for a new one
+
+    :type password: str | unicode
+    :type credential_id: str
+    :type salt: str | None
+
+    :rtype: vccs_client.VCCSPasswordFactor
+
+    :raise PasswordFactorBusy: The factor pool queue is full
+    :raise PasswordFactorTimeout: The factor was not computed in time
+    """
+    pool = _factor_pool
+    if pool is None:
+        return _make_factor(password, credential_id, salt)
+    return pool.make_password_factor(password, credential_id, salt)
@@ -0,0 +1,136 @@
+# -*- coding: utf-8 -*-
+"""
+Reusable VCCS clients with HTTP keep-alive.
+
+vccs_client.VCCSClient opens a new HTTP(S) connection for every request to
+the VCCS backend. The clients returned by get_pooled_vccs_client are shared
+by all threads of a process, one per VCCS URL, and send their requests over
+a pool of kept-alive connections.
+
+The connection pools are not shared with forked child processes, a process
+that finds that it has been forked starts over with new clients.
+"""
+
+from __future__ import absolute_import
+
+import os
+import threading
+
+import urllib3
+import vccs_client
+
+import logging
+logger = logging.getLogger(__name__)
+
+# Defaults for the clients created by get_pooled_vccs_client, see configure_vccs_clients
+_settings = {
+    'connect_timeout': 5.0,
+    'read_timeout': 30.0,
+    'pool_size': 10,
+}
+
+
+class VCCSConnectionError(vccs_client.VCCSClientHTTPError):
+    """
+    The VCCS backend could not be reached, or did not respond in time.
+    """
+    pass
+
+
+class PooledVCCSClient(vccs_client.VCCSClient):
+    """
+    VCCS client sending its requests over kept-alive connections.
+
+    :param base_url: VCCS authentication backend URL
+    :param connect_timeout: Seconds to wait for a connection to the backend
+    :param read_timeout: Seconds to wait for a response from the backend
+    :param pool_size: Max number of idle connections to keep open
+
+    :type base_url: str | unicode
+    :type connect_timeout: float
+    :type read_timeout: float
+    :type pool_size: int
+    """
+
+    def __init__(self, base_url, connect_timeout=5.0, read_timeout=30.0, pool_size=10):
+        super(PooledVCCSClient, self).__init__(base_url=base_url)
+        self.timeout = urllib3.Timeout(connect=connect_timeout, read=read_timeout)
+        self.pool = urllib3.PoolManager(num_pools=1, maxsize=pool_size, timeout=self.timeout, retries=False)
+
+    def _execute_request_response(self, service, values):
+        url = '{!s}/{!s}'.format(self.base_url.rstrip('/'), service)
+        try:
+            response = self.pool.request('POST', url, fields=values, encode_multipart=False)
+        except urllib3.exceptions.HTTPError as exc:
+            raise VCCSConnectionError('Failed connecting to VCCS backend: {!r}'.format(exc), 500)
+        if response.status != 200:
+            raise vccs_client.VCCSClientHTTPError('Bad response from VCCS backend: {!s}'.format(response.reason),
+                                                  response.status)
+        return response.data
+
+
+# {vccs_url: PooledVCCSClient}
+_clients = {}
+_clients_pid = None
+_clients_lock = threading.Lock()
+
+
+def configure_vccs_clients(connect_timeout=None, read_timeout=None, pool_size=None):
+    """
+    Set the timeouts and pool size of the clients created by get_pooled_vccs_client
+    from now on.
+
+    The settings are shared by all apps in the process. The clients already
+    created, and their open connections, are kept if the settings are unchanged.
+
+    :type connect_timeout: float | None
+    :type read_timeout: float | None
+    :type pool_size: int | None
+    """
+    with _clients_lock:
+        settings = dict(_settings)
+        if connect_timeout is not None:
+            settings['connect_timeout'] = float(connect_timeout)
+        if read_timeout is not None:
+            settings['read_timeout'] = float(read_timeout)
+        if pool_size is not None:
+            settings['pool_size'] = int(pool_size)
+        if settings == _settings:
+            return
+        _settings.update(settings)
+        _clients.clear()
+
+
+def get_vccs_timeout():
+    """
+    :return: The max number of seconds a call to the VCCS backend takes, connecting and reading the response
+    :rtype: float
+    """
+    return _settings['connect_timeout'] + _settings['read_timeout']
+
+
+def get_pooled_vccs_client(vccs_url):
+    """
+    Get the VCCS client for vccs_url of this process.
+
+    :param vccs_url: VCCS authentication backend URL
+    :type vccs_url: str | unicode
+
+    :rtype: PooledVCCSClient
+    """
+    global _clients_pid
+    if _clients_pid == os.getpid():
+        client = _clients.get(vccs_url)
+        if client is not None:
+            return client
+    with _clients_lock:
+        if _clients_pid != os.getpid():
+            # Connections opened by the parent process must not be used in a forked child
+            _clients.clear()
+            _clients_pid = os.getpid()
+        client = _clients.get(vccs_url)
+        if client is None:
+            logger.debug('Creating VCCS client for {!s}'.format(vccs_url))
+            client = PooledVCCSClient(vccs_url, **_settings)
+            _clients[vccs_url] = client
+    return client
@@ -0,0 +1,166 @@
+# -*- coding: utf-8 -*-
+"""
+Verification of SAML authentication responses in a pool of worker processes.
+
+Parsing a SAML response and verifying its signature is CPU bound, and blocks
+the request thread (and, with the xmlsec1 backend, forks a process per
+verification). With SAML2_VERIFY_PROCESSES set, get_authn_response hands the
+verification to a pool of that many worker processes instead, so that ACS
+throughput scales with the number of cores.
+
+Settings:
+
+    SAML2_VERIFY_PROCESSES:  number of worker processes, 0 (default) to verify in the request thread
+    SAML2_VERIFY_QUEUE_SIZE: max number of responses being verified or waiting, default 4 per process
+    SAML2_VERIFY_TIMEOUT:    seconds to wait for a verification, default 10
+
+Metrics (see eduid_common.stats):
+
+    saml2_verify_queue_depth  gauge, responses being verified or waiting
+    saml2_verify_time         timing (ms), including the time spent waiting
+    saml2_verify_rejected     count, responses rejected because the queue was full
+    saml2_verify_timeout      count, verifications that timed out
+"""
+
+from __future__ import absolute_import
+
+import threading
+
+from saml2 import BINDING_HTTP_POST, SAMLError
+from saml2.client import Saml2Client
+from saml2.population import Population
+
+from eduid_common.authn.utils import on_saml2_config_released
+from eduid_common.authn.worker_pool import BoundedProcessPool, WorkerPoolBusy, WorkerPoolTimeout
+
+import logging
+logger = logging.getLogger(__name__)
+
+
+class SAMLVerificationBusy(WorkerPoolBusy):
+    """
+    The verification queue is full.
+    """
+    pass
+
+
+class SAMLVerificationTimeout(WorkerPoolTimeout):
+    """
+    The verification did not finish in time.
+    """
+    pass
+
+
+# The Saml2Client of a worker process
+_worker_client = None
+
+
+def _init_worker(saml2_config):
+    global _worker_client
+    _worker_client = Saml2Client(saml2_config)
+
+
+def _verify_authn_response(raw_response, outstanding_queries):
+    """
+    Parse and verify a SAML authentication response in a worker process.
+
+    :return: (session_id, session_info, assertion_id, add_to_identity_cache), or None for an unusable response
+    :rtype: tuple | None
+    """
+    client = _worker_client
+    # Only keep the identities of the current response
+    client.users = Population()
+    response = client.parse_authn_request_response(raw_response, BINDING_HTTP_POST, outstanding_queries)
+    if response is None:
+        return None
+    # parse_authn_request_response adds the subject to the identity cache when the assertion has a NameID
+    add_to_identity_cache = bool(client.users.subjects())
+    return response.session_id(), response.session_info(), response.assertion.id, add_to_identity_cache
+
+
+class SAMLVerificationPool(BoundedProcessPool):
+    """
+    A pool of worker processes verifying SAML responses for one SP configuration.
+
+    :param saml2_config: The SAML2 SP configuration
+    :param processes: Number of worker processes
+    :param queue_size: Max number of responses being verified or waiting
+    :param timeout: Seconds to wait for a verification
+
+    :type saml2_config: saml2.config.SPConfig
+    :type processes: int
+    :type queue_size: int
+    :type timeout: int | float
+    """
+
+    name = 'SAML verification'
+    metric_prefix = 'saml2_verify'
+    timing_metric = 'saml2_verify_time'
+    busy_error = SAMLVerificationBusy
+    timeout_error = SAMLVerificationTimeout
+    error_class = SAMLError
+
+    def __init__(self, saml2_config, processes, queue_size, timeout):
+        # The workers are forked, so the config is not pickled
+        super(SAMLVerificationPool, self).__init__(processes, queue_size, timeout,
+                                                   initializer=_init_worker, initargs=(saml2_config,))
+        self.saml2_config = saml2_config
+
+    def verify_authn_response(self, raw_response, outstanding_queries, stats):
+        """
+        :param raw_response: The SAML response, as POSTed to the ACS
+        :param outstanding_queries: The outstanding queries of the session
+        :param stats: Statistics object
+
+        :type raw_response: str | unicode
+        :type outstanding_queries: dict
+        :type stats: eduid_common.stats.NoOpStats | eduid_common.stats.Statsd
+
+        :return: (session_id, session_info, assertion_id, add_to_identity_cache),
+                 or None for an unusable response
+        :rtype: tuple | None
+        """
+        return self.apply(_verify_authn_response, (raw_response, outstanding_queries), stats)
+
+
+# {SPConfig: SAMLVerificationPool}
+_pools = {}
+_pools_lock = threading.Lock()
+
+
+def _release_pool(saml2_config):
+    with _pools_lock:
+        pool = _pools.pop(saml2_config, None)
+    if pool is not None:
+        pool.close()
+
+on_saml2_config_released(_release_pool)
+
+
+def get_verification_pool(config, saml2_config):
+    """
+    The pool is closed when get_saml2_config replaces saml2_config. It is
+    started by warm_up_saml2_client when the app is initialized.
+
+    :param config: The app configuration
+    :param saml2_config: The SAML2 SP configuration
+
+    :type config: dict
+    :type saml2_config: saml2.config.SPConfig
+
+    :return: The verification pool for saml2_config, or None if not configured
+    :rtype: SAMLVerificationPool | None
+    """
+    processes = int(config.get('SAML2_VERIFY_PROCESSES', 0))
+    if not processes:
+        return None
+    pool = _pools.get(saml2_config)
+    if pool is None:
+        with _pools_lock:
+            pool = _pools.get(saml2_config)
+            if pool is None:
+                queue_size = int(config.get('SAML2_VERIFY_QUEUE_SIZE', 4 * processes))
+                timeout = float(config.get('SAML2_VERIFY_TIMEOUT', 10))
+                pool = SAMLVerificationPool(saml2_config, processes, queue_size, timeout)
+                _pools[saml2_config] = pool
+    return pool
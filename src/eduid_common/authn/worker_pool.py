@@ -0,0 +1,246 @@
+# -*- coding: utf-8 -*-
+"""
+A pool of worker processes with a bounded queue, for CPU bound work that
+would otherwise hold the GIL of a web worker (see verification and
+vccs_hashing).
+
+The queue is bounded by the calls queued in the pool or being run by a
+worker, including calls the caller has stopped waiting for, so that a pool
+that can not keep up rejects new calls instead of building up a backlog.
+
+The pool should be started when the app is initialized (start()). Forking
+the workers from a request thread, while other threads may hold locks, can
+leave a worker deadlocked on a lock that was copied in its locked state.
+The workers re-create the logging locks when they start, and a pool started
+from another thread than the main thread is logged.
+
+Metrics (see eduid_common.stats), <prefix> set by the subclass:
+
+    <prefix>_queue_depth  gauge, calls running or queued
+    <prefix>_rejected     count, calls rejected because the queue was full
+    <prefix>_timeout      count, calls that timed out
+    <prefix>_recycled     count, pools restarted because a call was lost
+"""
+
+from __future__ import absolute_import
+
+import os
+import time
+import pickle
+import functools
+import itertools
+import logging
+import threading
+import multiprocessing
+
+logger = logging.getLogger(__name__)
+
+
+class WorkerPoolBusy(Exception):
+    """
+    The queue of the worker pool is full.
+    """
+    pass
+
+
+class WorkerPoolTimeout(Exception):
+    """
+    The call to the worker pool did not finish in time.
+    """
+    pass
+
+
+def _reinit_logging_locks():
+    # Another thread of the parent process may have held one of the locks when forking
+    logging._lock = threading.RLock()
+    for ref in getattr(logging, '_handlerList', []):
+        handler = ref() if callable(ref) else ref
+        if handler is not None:
+            handler.createLock()
+
+
+def _init_worker(initializer, initargs):
+    _reinit_logging_locks()
+    if initializer is not None:
+        initializer(*initargs)
+
+
+def _call_in_worker(func, args, error_class):
+    """
+    Call func in a worker process.
+
+    Exceptions are returned rather than raised, so that an exception that
+    can not be pickled reaches the parent process as error_class.
+
+    :return: ('ok', result) or ('error', exception)
+    :rtype: tuple
+    """
+    try:
+        return 'ok', func(*args)
+    except Exception as e:
+        try:
+            pickle.loads(pickle.dumps(e))
+        except Exception:
+            e = error_class(repr(e))
+        return 'error', e
+
+
+class BoundedProcessPool(object):
+    """
+    A pool of worker processes, rejecting calls when too many are running or waiting.
+
+    A call keeps its place in the queue until the worker has finished it,
+    also when the caller has stopped waiting for it, so that the work queued
+    in the pool is bounded by queue_size. The result of a call never arrives
+    if its worker dies (or hangs), so when a call is still not finished after
+    recycle_after seconds, the pool is terminated and replaced by a new one.
+
+    Subclasses set the name used in log messages and errors, the metric
+    names and the exceptions raised.
+
+    :param processes: Number of worker processes
+    :param queue_size: Max number of calls running or waiting
+    :param timeout: Seconds to wait for a call
+    :param initializer: Called with initargs in each worker process when it starts
+    :param recycle_after: Seconds after which an unfinished call is considered lost,
+                          default the time to work through a full queue of calls taking timeout seconds
+
+    :type processes: int
+    :type queue_size: int
+    :type timeout: int | float
+    :type initializer: callable | None
+    :type initargs: tuple
+    :type recycle_after: int | float | None
+    """
+
+    name = 'worker pool'
+    metric_prefix = 'worker_pool'
+    timing_metric = 'worker_pool_time'
+    busy_error = WorkerPoolBusy
+    timeout_error = WorkerPoolTimeout
+    # Raised in place of exceptions in the workers that can not be pickled
+    error_class = ValueError
+
+    def __init__(self, processes, queue_size, timeout, initializer=None, initargs=(), recycle_after=None):
+        self.processes = processes
+        self.queue_size = queue_size
+        self.timeout = timeout
+        self.initializer = initializer
+        self.initargs = initargs
+        if recycle_after is None:
+            recycle_after = (queue_size // max(processes, 1) + 2) * timeout
+        self.recycle_after = recycle_after
+        # {call number: time queued} of the calls not finished by the workers
+        self._unfinished = {}
+        self._calls = itertools.count()
+        self._lock = threading.Lock()
+        self._pool = None
+        self._pid = None
+
+    @property
+    def _pending(self):
+        return len(self._unfinished)
+
+    def _get_pool(self):
+        # A pool created before a fork is not usable in the child process
+        if self._pool is None or self._pid != os.getpid():
+            if threading.current_thread().name != 'MainThread':
+                logger.warning('Starting {!s} processes from thread {!s}, '
+                               'the pool should be started when the app is initialized'.format(
+                                   self.name, threading.current_thread().name))
+            logger.info('Starting {!s} {!s} processes'.format(self.processes, self.name))
+            self._pool = multiprocessing.Pool(self.processes, initializer=_init_worker,
+                                              initargs=(self.initializer, self.initargs))
+            self._pid = os.getpid()
+            self._unfinished = {}
+        return self._pool
+
+    def _take_lost_pool(self, now):
+        """
+        :return: The pool, removed, if it has a call that should have been finished long ago
+        :rtype: multiprocessing.pool.Pool | None
+        """
+        if self._pool is None or self._pid != os.getpid() or not self._unfinished:
+            return None
+        if now - min(self._unfinished.values()) < self.recycle_after:
+            return None
+        pool = self._pool
+        self._pool = None
+        return pool
+
+    def _done(self, pool, call, _result):
+        # Called by the result handler thread of pool when the worker has finished the call
+        with self._lock:
+            if self._pool is pool:
+                self._unfinished.pop(call, None)
+
+    def start(self):
+        """
+        Start the worker processes, if not already started in this process.
+        """
+        with self._lock:
+            self._get_pool()
+
+    def close(self):
+        """
+        Stop the worker processes once the calls already queued are done.
+        """
+        with self._lock:
+            if self._pool is not None and self._pid == os.getpid():
+                self._pool.close()
+            self._pool = None
+
+    def apply(self, func, args, stats):
+        """
+        Call func(*args) in a worker process.
+
+        :param func: A module level function
+        :param args: Arguments, that can be pickled
+        :param stats: Statistics object
+
+        :type func: callable
+        :type args: tuple
+        :type stats: eduid_common.stats.NoOpStats | eduid_common.stats.Statsd
+
+        :return: The return value of func
+        :raise busy_error: The queue is full
+        :raise timeout_error: func did not return in time
+        """
+        t0 = time.time()
+        with self._lock:
+            lost_pool = self._take_lost_pool(t0)
+        if lost_pool is not None:
+            # Not terminated with the lock held, the result handler thread may be waiting for it
+            logger.error('{!s} call unfinished after {!s}s, restarting the pool'.format(self.name, self.recycle_after))
+            stats.count('{!s}_recycled'.format(self.metric_prefix))
+            lost_pool.terminate()
+        with self._lock:
+            pool = self._get_pool()
+            depth = self._pending
+            full = depth >= self.queue_size
+            if not full:
+                call = next(self._calls)
+                self._unfinished[call] = t0
+                depth += 1
+
+        stats.gauge('{!s}_queue_depth'.format(self.metric_prefix), depth)
+        if full:
+            stats.count('{!s}_rejected'.format(self.metric_prefix))
+            raise self.busy_error('{!s} queue full ({!s})'.format(self.name, depth))
+        try:
+            result = pool.apply_async(_call_in_worker, (func, args, self.error_class),
+                                      callback=functools.partial(self._done, pool, call))
+            status, value = result.get(self.timeout)
+        except multiprocessing.TimeoutError:
+            # The call keeps its place in the queue until the worker has finished it
+            stats.count('{!s}_timeout'.format(self.metric_prefix))
+            raise self.timeout_error('{!s} timed out after {!s}s'.format(self.name, self.timeout))
+        except Exception:
+            # The pool failed the call (e.g. a result that can not be pickled), the callback is not called
+            self._done(pool, call, None)
+            raise
+        finally:
+            stats.timing(self.timing_metric, int((time.time() - t0) * 1000))
+        if status == 'error':
+            raise value
+        return value
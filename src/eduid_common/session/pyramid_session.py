@@ -31,35 +31,13 @@
 #
 
 import os, binascii
-import collections
-from time import time
 from eduid_common.session.session import SessionManager
+from eduid_common.session.request_session import RequestSession
 
 import logging
 logger = logging.getLogger(__name__)
 
 
-def manage(action):
-    '''
-    Decorator which causes a cookie to be set when a session method
-    is called.
-
-    :param action: Whether the session data has been changed or just accessed.
-                   When it has been changed, the call to session.commit()
-                   implies setting the ttl on the backend, so there is no need
-                   to set it explicitly.
-    :type action: str ('accessed'|'changed')
-    '''
-    def outer(wrapped):
-        def accessed(session, *arg, **kw):
-            renew_backend = action == 'accessed'
-            session.renew_ttl(renew_backend=renew_backend)
-            return wrapped(session, *arg, **kw)
-        accessed.__doc__ = wrapped.__doc__
-        return accessed
-    return outer
-
-
 class SessionFactory(object):
     '''
     Session factory implementing the pyramid.interfaces.ISessionFactory
@@ -85,158 +63,100 @@ class SessionFactory(object):
         '''
         Create a session object for the given request.
 
+        The session data is not loaded from redis until it is used, and it
+        is written back (at most once) in a response callback.
+
         :param request: the request
         :type request: pyramid.request.Request
 
         :return: the session
         :rtype: Session
         '''
-        raise NotImplementedError()
+        session_name = request.registry.settings.get('session.key')
+        token = request.cookies.get(session_name, None)
+        session = Session(request, self.manager, token=token)
+        request.add_response_callback(session.save_callback)
+        return session
 
 
-class Session(collections.MutableMapping):
+class Session(RequestSession):
     '''
     Session implementing the pyramid.interfaces.ISession interface.
     It uses the Session defined in eduid_common.session.session
     to store the session data in redis.
+
+    The session is loaded lazily and written to redis at most once per
+    request, see eduid_common.session.request_session.
     '''
 
-    def __init__(self, request, base_session, new=False):
+    def __init__(self, request, manager, token=None, read_only=False):
         '''
         :param request: the request
         :type request: pyramid.request.Request
-        :param base_session: The underlying session object
-        :type base_session: eduid_common.session.session.Session
-        :param new: whether the session is new or not.
-        :type new: bool
-        '''
+        :param manager: The session manager providing the underlying session object
+        :type manager: eduid_common.session.session.SessionManager
+        :param token: The session token from the request cookie, if any
+        :type token: str | unicode | None
+        :param read_only: whether the session data should be left untouched
+                          in the backend at the end of the request.
+        :type read_only: bool
+        '''
+        settings = request.registry.settings
+        debug = str(settings.get('pyramid.debug_all', False)).lower() in ('true', 'yes', 'on', '1')
+        super(Session, self).__init__(manager, token=token, read_only=read_only, debug=debug)
         self.request = request
-        self._session = base_session
-        self._created = time()
-        self._new = new
-        self._ttl_reset = False
-
-    @manage('accessed')
-    def __getitem__(self, key, default=None):
-        return self._session.__getitem__(key, default=None)
-
-    @manage('changed')
-    def __setitem__(self, key, value):
-        self._session[key] = value
-        self._session.commit()
-
-    @manage('changed')
-    def __delitem__(self, key):
-        del self._session[key]
-        self._session.commit()
-
-    @manage('accessed')
-    def __iter__(self):
-        return self._session.__iter__()
-
-    @manage('accessed')
-    def __len__(self):
-        return len(self._session)
-
-    @manage('accessed')
-    def __contains__(self, key):
-        return self._session.__contains__(key)
-
-    @property
-    def created(self):
-        '''
-        See pyramid.interfaces.ISession
-        '''
-        return self._created
-
-    @property
-    def new(self):
-        '''
-        See pyramid.interfaces.ISession
-        '''
-        return self._new
-
-    def invalidate(self):
-        '''
-        See pyramid.interfaces.ISession
-        '''
-        self._session.clear()
-        name = self.request.registry.settings.get('session.key')
-        domain = self.request.registry.settings.get('session.cookie_domain')
-        path = self.request.registry.settings.get('session.cookie_path')
-
-        def rm_cookie_callback(request, response):
-            response.set_cookie(
-                    name=name,
-                    value=None,
-                    domain=domain,
-                    path=path,
-                    max_age=0
-                    )
-            return True
-
-        self.request.add_response_callback(rm_cookie_callback)
 
     def changed(self):
         '''
         See pyramid.interfaces.ISession
         '''
-        self._session.commit()
+        self.mark_changed()
 
-    @manage('changed')
     def flash(self, msg, queue='', allow_duplicate=True):
         '''
         See pyramid.interfaces.ISession
         '''
         if not queue:
             queue = 'default'
-        if 'flash_messages' not in self._session:
-            self._session['flash_messages'] = {'default': []}
-        if queue not in self._session['flash_messages']:
-            self._session['flash_messages'][queue] = []
+        if 'flash_messages' not in self:
+            self['flash_messages'] = {'default': []}
+        if queue not in self['flash_messages']:
+            self['flash_messages'][queue] = []
         if not allow_duplicate:
-            if msg in self._session['flash_messages'][queue]:
+            if msg in self['flash_messages'][queue]:
                 return
-        self._session['flash_messages'][queue].append(msg)
-        self._session.commit()
+        self['flash_messages'][queue].append(msg)
+        self.changed()
 
-    @manage('changed')
     def pop_flash(self, queue=''):
         '''
         See pyramid.interfaces.ISession
         '''
         if not queue:
             queue = 'default'
-        if 'flash_messages' not in self._session:
-            self._session['flash_messages'] = {'default': []}
-        if queue in self._session['flash_messages']:
-            msgs = self._session['flash_messages'].pop(queue)
-            self._session.commit()
+        flash_messages = self.get('flash_messages', {})
+        if queue in flash_messages:
+            msgs = flash_messages.pop(queue)
+            self.changed()
             return msgs
         return []
 
-    @manage('accessed')
     def peek_flash(self, queue=''):
         '''
         See pyramid.interfaces.ISession
         '''
         if not queue:
             queue = 'default'
-        if 'flash_messages' not in self._session:
-            self._session['flash_messages'] = {'default': []}
-        return self._session['flash_messages'].get(queue, [])
+        return self.get('flash_messages', {}).get(queue, [])
 
-    @manage('changed')
     def new_csrf_token(self):
         '''
         See pyramid.interfaces.ISession
         '''
         token = binascii.hexlify(os.urandom(20))
         self['_csrft_'] = token
-        self._session.commit()
         return token
 
-    @manage('accessed')
     def get_csrf_token(self):
         '''
         See pyramid.interfaces.ISession
@@ -246,53 +166,58 @@ class Session(collections.MutableMapping):
             token = self.new_csrf_token()
         return token
 
-    def persist(self):
+    def save_callback(self, request, response):
         '''
-        Store the session data in the redis backend,
-        and renew the ttl for it.
-        '''
-        self._session.commit()
-
-    def renew_ttl(self, renew_backend):
-        '''
-        Reset the ttl for the session, both in the cookie and
-        (if `renew_backend==True`) in the redis backend.
+        Response callback writing the session to redis, if it has been
+        changed, and setting (or removing) the session cookie.
 
-        :param renew_backend: whether to renew the ttl in the redis backend
-        :type renew_backend: bool
+        :param request: the request
+        :type request: pyramid.request.Request
+        :param response: the response
+        :type response: pyramid.response.Response
         '''
-        if not self._ttl_reset:
-            self.set_cookie()
-            if renew_backend:
-                self._session.renew_ttl()
-            self._ttl_reset = True
+        if not self.loaded:
+            # Session not used in this request, nothing to save
+            return
+        if self._invalidated:
+            self.rm_cookie(response)
+            return
+        self.commit()
+        self.set_cookie(response)
 
-    def set_cookie(self):
+    def set_cookie(self, response):
         '''
         Set the session cookie with the token
+
+        :param response: the response
+        :type response: pyramid.response.Response
         '''
-        token = self._session.token
         settings = self.request.registry.settings
-        session_name = settings.get('session.key')
-        domain = settings.get('session.cookie_domain')
-        path = settings.get('session.cookie_path')
-        secure = settings.get('session.cookie_secure')
-        httponly = settings.get('session.cookie_httponly')
-        max_age = settings.get('session.cookie_max_age')
+        response.set_cookie(
+                name=settings.get('session.key'),
+                value=self.token,
+                domain=settings.get('session.cookie_domain'),
+                path=settings.get('session.cookie_path'),
+                secure=settings.get('session.cookie_secure'),
+                httponly=settings.get('session.cookie_httponly'),
+                max_age=settings.get('session.cookie_max_age')
+                )
 
-        def set_cookie_callback(request, response):
-            response.set_cookie(
-                    name=session_name,
-                    value=token,
-                    domain=domain,
-                    path=path,
-                    secure=secure,
-                    httponly=httponly,
-                    max_age=max_age
-                    )
-            return True
+    def rm_cookie(self, response):
+        '''
+        Remove the session cookie
 
-        self.request.add_response_callback(set_cookie_callback)
+        :param response: the response
+        :type response: pyramid.response.Response
+        '''
+        settings = self.request.registry.settings
+        response.set_cookie(
+                name=settings.get('session.key'),
+                value=None,
+                domain=settings.get('session.cookie_domain'),
+                path=settings.get('session.cookie_path'),
+                max_age=0
+                )
 
     def delete(self):
         '''
@@ -0,0 +1,156 @@
+"""
+Accounting of the I/O between the session code and the Redis backend.
+
+All Redis clients handed out by the SessionManager are instances of
+InstrumentedStrictRedis, which records the number of commands, round trips
+and payload bytes of every command and pipeline it executes.
+
+The numbers are collected in RedisIOStats objects. There is one per request
+(see start_request_tracking/stop_request_tracking, used by the Flask session
+factory), and any number of explicitly started ones, e.g. in tests:
+
+    with track_redis_io() as stats:
+        do_something()
+    assert stats.round_trips <= 2
+
+The tracking is per thread, matching how requests are processed.
+"""
+
+import threading
+
+import redis
+
+try:
+    from redis.client import StrictPipeline as _BasePipeline  # redis < 3.0
+except ImportError:
+    from redis.client import Pipeline as _BasePipeline
+
+from contextlib import contextmanager
+
+_local = threading.local()
+
+
+class RedisIOStats(object):
+    """
+    Redis commands, round trips and payload bytes.
+    """
+
+    def __init__(self):
+        self.commands = 0
+        self.round_trips = 0
+        self.bytes_sent = 0
+        self.bytes_received = 0
+
+    def add(self, commands, bytes_sent, bytes_received):
+        self.commands += commands
+        self.round_trips += 1
+        self.bytes_sent += bytes_sent
+        self.bytes_received += bytes_received
+
+    def to_dict(self):
+        return {'commands': self.commands,
+                'round_trips': self.round_trips,
+                'bytes_sent': self.bytes_sent,
+                'bytes_received': self.bytes_received,
+                }
+
+    def __str__(self):
+        return 'commands={}, round_trips={}, bytes_sent={}, bytes_received={}'.format(
+            self.commands, self.round_trips, self.bytes_sent, self.bytes_received)
+
+
+def start_request_tracking():
+    """
+    Start collecting the Redis I/O of the current request (thread).
+
+    :return: The stats object for the request
+    :rtype: RedisIOStats
+    """
+    _local.request = RedisIOStats()
+    return _local.request
+
+
+def stop_request_tracking():
+    """
+    Stop collecting the Redis I/O of the current request (thread).
+
+    :return: The stats object for the request, or None if tracking was not started
+    :rtype: RedisIOStats | None
+    """
+    stats = getattr(_local, 'request', None)
+    _local.request = None
+    return stats
+
+
+@contextmanager
+def track_redis_io():
+    """
+    Collect the Redis I/O done in the current thread while the context is active.
+    """
+    stats = RedisIOStats()
+    trackers = getattr(_local, 'trackers', None)
+    if trackers is None:
+        trackers = _local.trackers = []
+    trackers.append(stats)
+    try:
+        yield stats
+    finally:
+        trackers.remove(stats)
+
+
+def _record(commands, bytes_sent, bytes_received):
+    request_stats = getattr(_local, 'request', None)
+    if request_stats is not None:
+        request_stats.add(commands, bytes_sent, bytes_received)
+    for stats in getattr(_local, 'trackers', []):
+        stats.add(commands, bytes_sent, bytes_received)
+
+
+def _payload_size(value):
+    """
+    Approximate number of bytes on the wire for a command argument or result.
+    """
+    if value is None:
+        return 0
+    if isinstance(value, (list, tuple)):
+        return sum([_payload_size(x) for x in value])
+    if isinstance(value, (bytes, type(u''))):
+        return len(value)
+    return len(str(value))
+
+
+class InstrumentedStrictRedis(redis.StrictRedis):
+    """
+    StrictRedis recording its I/O, see the module documentation.
+    """
+
+    def execute_command(self, *args, **options):
+        result = None
+        try:
+            result = super(InstrumentedStrictRedis, self).execute_command(*args, **options)
+            return result
+        finally:
+            _record(1, _payload_size(args), _payload_size(result))
+
+    def pipeline(self, transaction=True, shard_hint=None):
+        return InstrumentedPipeline(self.connection_pool, self.response_callbacks, transaction, shard_hint)
+
+
+class InstrumentedPipeline(_BasePipeline):
+    """
+    Pipeline recording its I/O, see the module documentation.
+
+    All commands in a pipeline are sent in a single round trip.
+    """
+
+    def execute(self, raise_on_error=True):
+        commands = len(self.command_stack)
+        if not commands:
+            return []
+        bytes_sent = sum([_payload_size(args) for args, _options in self.command_stack])
+        result = None
+        try:
+            result = super(InstrumentedPipeline, self).execute(raise_on_error=raise_on_error)
+            return result
+        finally:
+            _record(commands, bytes_sent, _payload_size(result))
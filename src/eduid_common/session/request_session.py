@@ -0,0 +1,385 @@
+#
+# Copyright (c) 2016 NORDUnet A/S
+# All rights reserved.
+#
+#   Redistribution and use in source and binary forms, with or
+#   without modification, are permitted provided that the following
+#   conditions are met:
+#
+#     1. Redistributions of source code must retain the above copyright
+#        notice, this list of conditions and the following disclaimer.
+#     2. Redistributions in binary form must reproduce the above
+#        copyright notice, this list of conditions and the following
+#        disclaimer in the documentation and/or other materials provided
+#        with the distribution.
+#     3. Neither the name of the NORDUnet nor the names of its
+#        contributors may be used to endorse or promote products derived
+#        from this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS
+# "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT
+# LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS
+# FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE
+# COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT,
+# INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING,
+# BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;
+# LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+# CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT
+# LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN
+# ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+#
+"""
+Request scoped sessions, shared by the Flask (eduid_common.api.session)
+and Pyramid (eduid_common.session.pyramid_session) session implementations.
+
+A RequestSession wraps a backend session (eduid_common.session.session.Session)
+and keeps the number of Redis round trips per request to a minimum:
+
+ * The backend session is loaded lazily, on first access. Requests that
+   never touch the session do not talk to Redis at all.
+ * When an existing session is loaded, its ttl is renewed in the same
+   round trip (GET and EXPIRE are pipelined).
+ * Changes are only kept in memory, and written to Redis once, when the
+   framework calls commit() at the end of the request.
+
+This gives the following budget per request:
+
+    session not used:            0 round trips
+    existing session read:       1 round trip  (GET + EXPIRE)
+    existing session changed:    2 round trips (GET + EXPIRE, SETEX)
+    new session:                 1 round trip  (SETEX)
+
+Changes to mutable values stored in the session (e.g. appending to a list)
+can not be detected, the framework specific way of flagging the session as
+changed has to be used for those (`session.modified = True` in Flask,
+`session.changed()` in Pyramid).
+
+Objects that keep their own view of some session data (e.g. the SAML caches
+in eduid_common.authn.cache) can register a commit hook with
+add_commit_hook(), to write their changes back to the session right before
+it is stored, as part of the same write.
+
+Data that is large and only needed by a few views can be kept out of the
+session, in a sub session (see RequestSession.sub_session). A sub session is
+stored under a separate Redis key, derived from the session id, and is only
+loaded (one more round trip) and written by the requests that use it. The
+modules using a sub session register its namespace with
+register_sub_session_namespace, so that invalidating a session also clears
+the sub sessions that were not used in the request.
+"""
+
+import binascii
+import collections
+from time import time
+
+from eduid_common.session.session import derive_key, SESSION_KEY_BITS
+
+import logging
+logger = logging.getLogger(__name__)
+
+
+# Namespaces of the sub sessions in use, cleared when a session is invalidated
+_sub_session_namespaces = set()
+
+
+def register_sub_session_namespace(namespace):
+    """
+    Register the namespace of a sub session, so that RequestSession.invalidate
+    clears it even in requests that do not use it.
+
+    :param namespace: Name of the sub session, e.g. 'saml2'
+    :type namespace: str
+    """
+    _sub_session_namespaces.add(namespace)
+
+
+class ReadOnlySessionError(Exception):
+    """
+    Raised, when running in debug mode, on an attempt to
+    modify a session that has been opened read-only.
+    """
+    pass
+
+
+class RequestSession(collections.MutableMapping):
+    """
+    Lazily loaded session, written to the backend at most once per request.
+    """
+
+    def __init__(self, manager, token=None, read_only=False, debug=False, stats=None):
+        """
+        :param manager: The session manager providing backend sessions
+        :param token: The session token received in the request cookie, if any
+        :param read_only: Whether the session should be opened read-only
+        :param debug: Whether writes to a read-only session should raise an exception
+        :param stats: Statistics object to count writes to read-only sessions with
+
+        :type manager: eduid_common.session.session.SessionManager
+        :type token: str | unicode | None
+        :type read_only: bool
+        :type debug: bool
+        :type stats: eduid_common.stats.NoOpStats | eduid_common.stats.Statsd | None
+        """
+        self._manager = manager
+        self._token = token
+        self._base_session = None
+        self._created = time()
+        self._new = token is None
+        self._changed = False
+        self._persisted = False
+        self._invalidated = False
+        self._read_only = read_only
+        self._commit_hooks = []
+        self._sub_sessions = {}
+        self.debug = debug
+        self.stats = stats
+
+    @property
+    def _session(self):
+        """
+        The backend session, loaded on first use.
+
+        :rtype: eduid_common.session.session.Session
+        """
+        if self._base_session is None:
+            self._load()
+        return self._base_session
+
+    def _load(self):
+        """
+        Fetch the session from the backend, or create a new one if the request
+        did not carry a token or the session could not be found.
+        """
+        if self._token is None:
+            self._base_session = self._manager.get_session(data={})
+            logger.debug('Created new session {}'.format(self._base_session.session_id))
+            return
+        try:
+            self._base_session = self._manager.get_session(token=self._token, renew_ttl=True)
+            logger.debug('Loaded existing session {}'.format(self._base_session.session_id))
+        except (KeyError, ValueError):
+            self._base_session = self._manager.get_session(data={})
+            self._new = True
+            logger.warning('Re-created missing session {}'.format(self._base_session.session_id))
+
+    @property
+    def loaded(self):
+        """
+        Whether the session has been used (and hence loaded) during this request.
+        """
+        return self._base_session is not None
+
+    def __getitem__(self, key):
+        return self._session.__getitem__(key)
+
+    def __setitem__(self, key, value):
+        self._check_writable(key)
+        self._session[key] = value
+        self._changed = True
+
+    def __delitem__(self, key):
+        self._check_writable(key)
+        del self._session[key]
+        self._changed = True
+
+    def __iter__(self):
+        return self._session.__iter__()
+
+    def __len__(self):
+        return len(self._session)
+
+    def __contains__(self, key):
+        return self._session.__contains__(key)
+
+    @property
+    def token(self):
+        """
+        Return the token in the session,
+        or the empty string if the session has been invalidated.
+        """
+        if self._invalidated:
+            return ''
+        return self._session.token
+
+    @property
+    def new(self):
+        """
+        Whether the session was created during this request.
+        """
+        if self._token is not None and not self.loaded:
+            # A missing session is only detected when it is loaded
+            self._load()
+        return self._new
+
+    @property
+    def created(self):
+        """
+        Created timestamp
+        """
+        return self._created
+
+    @property
+    def read_only(self):
+        """
+        Whether the session is read-only for the current request.
+        """
+        return self._read_only
+
+    @read_only.setter
+    def read_only(self, val):
+        self._read_only = val
+
+    def _check_writable(self, key):
+        """
+        Guard against writes to a read-only session.
+
+        In debug mode the write is refused with a ReadOnlySessionError, so that
+        views that need to write to the session are found during development.
+        In production the write is counted and logged, and the session falls
+        back to read-write for the rest of the request so that no data is lost.
+
+        :param key: the session key about to be written
+        :type key: str | unicode
+        """
+        if not self._read_only:
+            return
+        if self.debug:
+            raise ReadOnlySessionError('Attempt to write key {!r} to a read-only session'.format(key))
+        logger.warning('Write of key {!r} to a read-only session, falling back to read-write'.format(key))
+        if self.stats is not None:
+            self.stats.count('session_read_only_write')
+        self._read_only = False
+
+    def mark_changed(self):
+        """
+        Flag the session as changed, after changing a mutable value stored in it.
+        """
+        self._check_writable(None)
+        self._changed = True
+
+    def add_commit_hook(self, callback):
+        """
+        Register a callable to be called (once) right before the session data
+        is stored in the backend, by commit() or persist().
+
+        :param callback: Callable taking no arguments
+        :type callback: callable
+        """
+        self._commit_hooks.append(callback)
+
+    def _run_commit_hooks(self):
+        while self._commit_hooks:
+            self._commit_hooks.pop(0)()
+
+    def persist(self):
+        """
+        Store the session data in the redis backend right away,
+        and renew the ttl for it.
+        """
+        self._run_commit_hooks()
+        self._session.commit()
+        self._persisted = True
+        self._changed = False
+
+    def commit(self):
+        """
+        Store the session data in the redis backend if it is new or has been
+        changed during the request. Meant to be called once, at the end of
+        the request.
+        """
+        if not self.loaded or self._invalidated:
+            return
+        self._run_commit_hooks()
+        if self._changed or (self._new and not self._persisted):
+            self.persist()
+        for sub_session in self._sub_sessions.values():
+            sub_session.commit()
+
+    def sub_session(self, namespace):
+        """
+        Get the sub session for namespace, loaded on first use and committed
+        together with this session.
+
+        :param namespace: Name of the sub session, e.g. 'saml2'
+        :type namespace: str
+
+        :rtype: RequestSubSession
+        """
+        if namespace not in self._sub_sessions:
+            register_sub_session_namespace(namespace)
+            self._sub_sessions[namespace] = RequestSubSession(self, namespace)
+        return self._sub_sessions[namespace]
+
+    def invalidate(self):
+        """
+        Invalidate the session, clearing the data from redis, together with
+        the data of all registered sub sessions.
+        """
+        # The sub session keys are derived from the session id, so they go first
+        for namespace in sorted(_sub_session_namespaces.union(self._sub_sessions)):
+            self.sub_session(namespace).invalidate()
+        self._clear()
+
+    def _clear(self):
+        self._session.clear()
+        self._commit_hooks = []
+        self._invalidated = True
+        self._changed = False
+
+
+class RequestSubSession(RequestSession):
+    """
+    Session data kept under a separate Redis key, derived from the id of a
+    parent session, with the same ttl.
+
+    The ttl is only renewed when the sub session is loaded, so a sub session
+    that is not used while the parent session is kept alive will expire
+    before the parent session.
+    """
+
+    def __init__(self, parent, namespace):
+        """
+        :param parent: The session this is a sub session of
+        :param namespace: Name of the sub session
+
+        :type parent: RequestSession
+        :type namespace: str
+        """
+        super(RequestSubSession, self).__init__(parent._manager, read_only=parent.read_only,
+                                                debug=parent.debug, stats=parent.stats)
+        self._parent = parent
+        self.namespace = namespace
+
+    def _session_id(self):
+        parent_id = binascii.unhexlify(self._parent._session.session_id)
+        return derive_key(self._manager.secret, parent_id, self.namespace.encode('ascii'), SESSION_KEY_BITS // 8)
+
+    def _load(self):
+        session_id = self._session_id()
+        try:
+            self._base_session = self._manager.get_session(session_id=session_id, renew_ttl=True)
+            self._new = False
+        except KeyError:
+            self._base_session = self._manager.get_session(session_id=session_id, data={})
+            self._new = True
+        logger.debug('Loaded {!s} sub session {}'.format(self.namespace, self._base_session.session_id))
+
+    def commit(self):
+        """
+        Store the sub session data in the redis backend if it has been changed.
+        An unchanged new sub session is not stored.
+        """
+        if not self.loaded or self._invalidated:
+            return
+        self._run_commit_hooks()
+        if self._changed:
+            self.persist()
+
+    def invalidate(self):
+        """
+        Invalidate the sub session, clearing the data from redis without loading it first.
+        """
+        if not self.loaded:
+            self._base_session = self._manager.get_session(session_id=self._session_id(), data={})
+        self._clear()
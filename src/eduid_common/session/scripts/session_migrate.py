@@ -0,0 +1,330 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Copy all sessions from one Redis deployment to another, e.g. when moving
+to a new Redis cluster, so that users are not logged out by the move.
+
+The source and target are described by yaml files with the same settings
+as used by the session manager (see eduid_common.session.session.get_redis_pool),
+so both plain Redis and Sentinel deployments are supported:
+
+    REDIS_HOST: redis.example.com
+    REDIS_PORT: 6379
+    REDIS_DB: 0
+
+or
+
+    REDIS_SENTINEL_HOSTS: [sentinel1.example.com, sentinel2.example.com]
+    REDIS_SENTINEL_SERVICE_NAME: redis-cluster
+    REDIS_PORT: 26379
+
+The keys are streamed with SCAN, and each batch is read from the source and
+written to the target in one pipelined round trip each. The remaining ttl of
+every session is preserved. By default DUMP/RESTORE is used; --mode get uses
+GET/PSETEX instead, for targets where RESTORE is not permitted.
+
+The SCAN cursor is saved in a state file after every batch, so an interrupted
+migration is resumed where it stopped when the script is started again. The
+state file also records the source, target and match pattern, and a run with
+other ones refuses to resume from it.
+"""
+
+import os
+import sys
+import json
+import time
+import argparse
+
+import redis
+import yaml
+
+from eduid_common.session.session import get_redis_pool
+
+VERBOSE = False
+
+
+def load_yaml(file_path):
+    """
+    :param file_path: Full path to a file with Redis configuration in yaml
+    :type file_path: str | unicode
+
+    :return: dict representation of the yaml
+    :rtype: dict
+    """
+    try:
+        with open(file_path) as f:
+            if VERBOSE:
+                print('Loading configuration from {!s}'.format(file_path))
+            return yaml.safe_load(f)
+    except IOError as e:
+        sys.stderr.writelines(str(e) + '\n')
+        sys.exit(1)
+
+
+def init_redis_client(config):
+    """
+    :param config: Redis settings, as used by get_redis_pool
+    :type config: dict
+
+    :rtype: redis.StrictRedis
+    """
+    return redis.StrictRedis(connection_pool=get_redis_pool(config))
+
+
+class StateMismatch(ValueError):
+    """
+    The state file was written by a migration between other deployments.
+    """
+    pass
+
+
+def redis_identity(client):
+    """
+    Describe the deployment a client connects to, for telling state files apart.
+
+    :param client: Redis client
+    :type client: redis.StrictRedis
+
+    :rtype: str
+    """
+    pool = client.connection_pool
+    kwargs = pool.connection_kwargs
+    db = kwargs.get('db', 0)
+    service_name = getattr(pool, 'service_name', None)
+    if service_name:
+        sentinels = sorted(['{!s}:{!s}'.format(x.connection_pool.connection_kwargs.get('host'),
+                                               x.connection_pool.connection_kwargs.get('port'))
+                            for x in pool.sentinel_manager.sentinels])
+        return 'sentinel://{!s}/{!s}/{!s}'.format(','.join(sentinels), service_name, db)
+    if kwargs.get('path'):
+        return 'unix://{!s}/{!s}'.format(kwargs['path'], db)
+    return 'redis://{!s}:{!s}/{!s}'.format(kwargs.get('host'), kwargs.get('port'), db)
+
+
+def load_cursor(state_file, identity):
+    """
+    :param state_file: Path to the file holding the SCAN cursor of an interrupted run
+    :type state_file: str | unicode
+    :param identity: Source, target and match pattern of this run
+    :type identity: dict
+
+    :return: The saved cursor, or 0 to start from the beginning
+    :rtype: int
+
+    :raise StateMismatch: The state file belongs to a run with another source, target or pattern
+    """
+    if not state_file or not os.path.exists(state_file):
+        return 0
+    with open(state_file) as f:
+        try:
+            state = json.load(f)
+        except ValueError:
+            state = None
+    if not isinstance(state, dict) or 'cursor' not in state:
+        raise StateMismatch('State file {!s} is not from this version of the script, '
+                            'remove it to start over'.format(state_file))
+    saved = dict((k, state.get(k)) for k in identity)
+    if saved != identity:
+        raise StateMismatch('State file {!s} belongs to another migration ({!r}), '
+                            'remove it to start over'.format(state_file, saved))
+    cursor = int(state['cursor'])
+    if VERBOSE:
+        print('Resuming from cursor {!s}'.format(cursor))
+    return cursor
+
+
+def save_cursor(state_file, identity, cursor):
+    """
+    Atomically save the SCAN cursor, so that a crash never leaves a truncated state file.
+
+    :param state_file: Path to the state file
+    :type state_file: str | unicode
+    :param identity: Source, target and match pattern of this run
+    :type identity: dict
+    :param cursor: SCAN cursor to resume from
+    :type cursor: int
+    """
+    if not state_file:
+        return
+    state = dict(identity)
+    state['cursor'] = cursor
+    tmp = '{!s}.tmp'.format(state_file)
+    with open(tmp, 'w') as f:
+        json.dump(state, f)
+        f.write('\n')
+    os.rename(tmp, state_file)
+
+
+def read_batch(source, keys, mode):
+    """
+    Fetch the values and remaining ttls (in milliseconds) of a batch of keys
+    from the source, in one round trip.
+
+    :param source: Source Redis client
+    :type source: redis.StrictRedis
+    :param keys: Keys to read
+    :type keys: list
+    :param mode: 'dump' or 'get'
+    :type mode: str
+
+    :return: (key, value, pttl) tuples for the keys that still exist
+    :rtype: list
+    """
+    pipe = source.pipeline(transaction=False)
+    for key in keys:
+        if mode == 'dump':
+            pipe.dump(key)
+        else:
+            pipe.get(key)
+        pipe.pttl(key)
+    res = pipe.execute()
+    batch = []
+    for i, key in enumerate(keys):
+        value, pttl = res[2 * i], res[2 * i + 1]
+        # pttl is -2 if the key has expired since it was returned by SCAN
+        if value is None or pttl == -2:
+            continue
+        batch.append((key, value, pttl))
+    return batch
+
+
+def write_batch(target, batch, mode, replace):
+    """
+    Write a batch of keys to the target, in one round trip.
+
+    :param target: Target Redis client
+    :type target: redis.StrictRedis
+    :param batch: (key, value, pttl) tuples as returned by read_batch
+    :type batch: list
+    :param mode: 'dump' or 'get'
+    :type mode: str
+    :param replace: Whether to overwrite keys already present in the target
+    :type replace: bool
+
+    :return: Number of keys written
+    :rtype: int
+    """
+    pipe = target.pipeline(transaction=False)
+    for key, value, pttl in batch:
+        # pttl is -1 for keys without a ttl
+        if mode == 'dump':
+            pipe.restore(key, max(pttl, 0), value, replace=replace)
+        elif pttl > 0:
+            pipe.set(key, value, px=pttl, nx=not replace)
+        else:
+            pipe.set(key, value, nx=not replace)
+    written = 0
+    for res in pipe.execute(raise_on_error=False):
+        if isinstance(res, redis.ResponseError):
+            # RESTORE fails with BUSYKEY for keys already present in the target
+            if VERBOSE:
+                print('Skipped key: {!s}'.format(res))
+            continue
+        if res:
+            written += 1
+    return written
+
+
+def migrate(source, target, match='*', batch_size=500, mode='dump', replace=False, max_rate=0,
+            state_file=None, report_interval=10):
+    """
+    Copy all keys matching `match' from source to target.
+
+    :param source: Source Redis client
+    :type source: redis.StrictRedis
+    :param target: Target Redis client
+    :type target: redis.StrictRedis
+    :param match: SCAN MATCH pattern
+    :type match: str
+    :param batch_size: SCAN COUNT hint, and number of keys per pipeline
+    :type batch_size: int
+    :param mode: 'dump' for DUMP/RESTORE or 'get' for GET/SET PX
+    :type mode: str
+    :param replace: Whether to overwrite keys already present in the target
+    :type replace: bool
+    :param max_rate: Maximum number of keys per second, 0 for no limit
+    :type max_rate: int
+    :param state_file: File to save the SCAN cursor in, for resuming
+    :type state_file: str | unicode | None
+    :param report_interval: Seconds between progress reports
+    :type report_interval: int
+
+    :return: (keys scanned, keys written)
+    :rtype: tuple
+
+    :raise StateMismatch: The state file belongs to a run with another source, target or pattern
+    """
+    identity = {'source': redis_identity(source),
+                'target': redis_identity(target),
+                'match': match,
+                }
+    cursor = load_cursor(state_file, identity)
+    scanned = written = 0
+    start = last_report = time.time()
+    while True:
+        cursor, keys = source.scan(cursor=cursor, match=match, count=batch_size)
+        cursor = int(cursor)
+        if keys:
+            batch = read_batch(source, keys, mode)
+            written += write_batch(target, batch, mode, replace)
+            scanned += len(keys)
+        save_cursor(state_file, identity, cursor)
+
+        now = time.time()
+        if max_rate:
+            # Sleep until the average rate is below the limit
+            ahead = float(scanned) / max_rate - (now - start)
+            if ahead > 0:
+                time.sleep(ahead)
+                now = time.time()
+        if now - last_report >= report_interval:
+            print('{!s} keys scanned, {!s} written, {:.1f} keys/s'.format(
+                scanned, written, scanned / max(now - start, 0.001)))
+            last_report = now
+
+        if cursor == 0:
+            break
+
+    if state_file and os.path.exists(state_file):
+        # Finished, the next run should start over
+        os.unlink(state_file)
+    elapsed = max(time.time() - start, 0.001)
+    print('Done: {!s} keys scanned, {!s} written in {:.1f}s ({:.1f} keys/s)'.format(
+        scanned, written, elapsed, scanned / elapsed))
+    return scanned, written
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Copy sessions between Redis deployments.')
+    parser.add_argument('-s', '--source', required=True, help='Path to the yaml configuration of the source Redis.')
+    parser.add_argument('-t', '--target', required=True, help='Path to the yaml configuration of the target Redis.')
+    parser.add_argument('-m', '--match', default='*', help='Only copy keys matching this pattern.')
+    parser.add_argument('-b', '--batch-size', default=500, type=int, help='Number of keys per round trip.')
+    parser.add_argument('--mode', choices=['dump', 'get'], default='dump',
+                        help='Copy with DUMP/RESTORE or with GET/SET PX.')
+    parser.add_argument('--replace', action='store_true', default=False,
+                        help='Overwrite keys already present in the target.')
+    parser.add_argument('-r', '--max-rate', default=0, type=int, help='Maximum number of keys per second.')
+    parser.add_argument('--state-file', default='session_migrate.state',
+                        help='File to save progress in, for resuming an interrupted migration.')
+    parser.add_argument('--report-interval', default=10, type=int, help='Seconds between progress reports.')
+    parser.add_argument('-v', '--verbose', action='store_true', default=False)
+    args = parser.parse_args()
+
+    if args.verbose:
+        global VERBOSE
+        VERBOSE = True
+
+    source = init_redis_client(load_yaml(args.source))
+    target = init_redis_client(load_yaml(args.target))
+
+    try:
+        migrate(source, target, match=args.match, batch_size=args.batch_size, mode=args.mode,
+                replace=args.replace, max_rate=args.max_rate, state_file=args.state_file,
+                report_interval=args.report_interval)
+    except (redis.RedisError, StateMismatch) as e:
+        sys.stderr.writelines(str(e) + '\n')
+        sys.exit(1)
+
+if __name__ == '__main__':
+    main()
@@ -81,6 +81,7 @@ import json
 import hashlib
 import collections
 import redis
+import redis.connection
 import redis.sentinel
 import nacl.secret
 import nacl.utils
@@ -88,6 +89,8 @@ import nacl.encoding
 import base64
 from saml2.saml import NameID
 
+from eduid_common.session.redis_io import InstrumentedStrictRedis
+
 import logging
 logger = logging.getLogger(__name__)
 
@@ -99,18 +102,79 @@ HMAC_DIGEST_SIZE = 256 / 8
 SESSION_KEY_BITS = 256
 
 
+class SentinelManagedSSLConnection(redis.sentinel.SentinelManagedConnection, redis.connection.SSLConnection):
+    """
+    TLS connection to the master of a Sentinel managed Redis service.
+
+    Included in redis-py from version 4.0, defined here for older versions.
+    """
+    pass
+
+
+def _get_ssl_kwargs(cfg):
+    """
+    TLS settings for the Redis connections, from the REDIS_SSL_* settings.
+
+    :param cfg: Redis connection settings dict
+    :type cfg: dict
+
+    :rtype: dict
+    """
+    kwargs = {
+        'ssl_keyfile': cfg.get('REDIS_SSL_KEYFILE'),
+        'ssl_certfile': cfg.get('REDIS_SSL_CERTFILE'),
+        'ssl_ca_certs': cfg.get('REDIS_SSL_CA_CERTS'),
+        'ssl_cert_reqs': cfg.get('REDIS_SSL_CERT_REQS', 'required'),
+    }
+    if cfg.get('REDIS_SSL_CHECK_HOSTNAME'):
+        kwargs['ssl_check_hostname'] = True
+    return kwargs
+
+
 def get_redis_pool(cfg):
-    port = cfg['REDIS_PORT']
+    """
+    Create a Redis connection pool. Supported deployments are
+
+      * Redis Sentinel (REDIS_SENTINEL_HOSTS, REDIS_SENTINEL_SERVICE_NAME and REDIS_PORT)
+      * a Unix domain socket (REDIS_SOCKET_PATH and REDIS_DB), for a co-located Redis
+      * TCP (REDIS_HOST, REDIS_PORT and REDIS_DB)
+
+    Connections to the Redis server, or to the master of a Sentinel managed
+    service, use TLS when REDIS_SSL is set. Client certificates and the CA are
+    configured with REDIS_SSL_KEYFILE, REDIS_SSL_CERTFILE, REDIS_SSL_CA_CERTS,
+    REDIS_SSL_CERT_REQS and REDIS_SSL_CHECK_HOSTNAME.
+
+    :param cfg: Redis connection settings dict
+    :type cfg: dict
+
+    :rtype: redis.ConnectionPool
+    """
+    use_ssl = bool(cfg.get('REDIS_SSL'))
     if cfg.get('REDIS_SENTINEL_HOSTS') and cfg.get('REDIS_SENTINEL_SERVICE_NAME'):
+        port = cfg['REDIS_PORT']
         _hosts = cfg['REDIS_SENTINEL_HOSTS']
         _name = cfg['REDIS_SENTINEL_SERVICE_NAME']
         host_port = [(x, port) for x in _hosts]
         manager = redis.sentinel.Sentinel(host_port, socket_timeout=0.1)
-        pool = redis.sentinel.SentinelConnectionPool(_name, manager)
+        if use_ssl:
+            connection_class = getattr(redis.sentinel, 'SentinelManagedSSLConnection', SentinelManagedSSLConnection)
+            pool = redis.sentinel.SentinelConnectionPool(_name, manager, connection_class=connection_class,
+                                                         **_get_ssl_kwargs(cfg))
+        else:
+            pool = redis.sentinel.SentinelConnectionPool(_name, manager)
+    elif cfg.get('REDIS_SOCKET_PATH'):
+        db = cfg['REDIS_DB']
+        pool = redis.ConnectionPool(connection_class=redis.connection.UnixDomainSocketConnection,
+                                    path=cfg['REDIS_SOCKET_PATH'], db=db)
     else:
+        port = cfg['REDIS_PORT']
         db = cfg['REDIS_DB']
         host = cfg['REDIS_HOST']
-        pool = redis.ConnectionPool(host=host, port=port, db=db)
+        if use_ssl:
+            pool = redis.ConnectionPool(connection_class=redis.connection.SSLConnection,
+                                        host=host, port=port, db=db, **_get_ssl_kwargs(cfg))
+        else:
+            pool = redis.ConnectionPool(host=host, port=port, db=db)
     return pool
 
 
@@ -152,26 +216,30 @@ class SessionManager(object):
         self.whitelist = whitelist
         self.raise_on_unknown = raise_on_unknown
 
-    def get_session(self, token=None, session_id=None, data=None):
+    def get_session(self, token=None, session_id=None, data=None, renew_ttl=False):
         """
         Create or fetch a session for the given token or data.
 
         :param token: the token containing the session_id for the session
         :param session_id: the session_id to look for
         :param data: the data for the (new) session
+        :param renew_ttl: whether to renew the ttl of an existing session
+                          in the same round trip as it is fetched
 
         :type token: str | unicode | None
         :type session_id: bytes
         :type data: dict | None
+        :type renew_ttl: bool
 
         :return: the session
         :rtype: Session
         """
-        conn = redis.StrictRedis(connection_pool=self.pool)
+        conn = InstrumentedStrictRedis(connection_pool=self.pool)
         return Session(conn, token=token, session_id=session_id, data=data,
                        secret=self.secret, ttl=self.ttl,
                        whitelist=self.whitelist,
                        raise_on_unknown=self.raise_on_unknown,
+                       renew_ttl=renew_ttl,
                        )
 
 
@@ -182,7 +250,7 @@ class Session(collections.MutableMapping):
 
     def __init__(self, conn, token=None, session_id=None,
                  data=None, secret='', ttl=None,
-                 whitelist=None, raise_on_unknown=False):
+                 whitelist=None, raise_on_unknown=False, renew_ttl=False):
         """
         Retrive or create a session for the given token or data.
 
@@ -209,6 +277,8 @@ class Session(collections.MutableMapping):
         :param whitelist: list of allowed keys for the sessions
         :param raise_on_unknown: Whether to raise an exception on an attempt
                                  to set a session key not in whitelist
+        :param renew_ttl: Whether to renew the ttl of an existing session
+                          when fetching it
 
         :type conn: redis.StrictRedis
         :type token: str or None
@@ -218,6 +288,7 @@ class Session(collections.MutableMapping):
         :type ttl: int
         :type whitelist: list
         :type raise_on_unknown: bool
+        :type renew_ttl: bool
         """
         self.conn = conn
         self.ttl = ttl
@@ -234,7 +305,14 @@ class Session(collections.MutableMapping):
             logger.debug('Looking for session using session_id {!r}'.format(self.session_id))
 
             # Fetch session from self.conn (Redis)
-            _encrypted_data = self.conn.get(self.session_id)
+            if renew_ttl:
+                # Renew the ttl in the same round trip
+                pipe = self.conn.pipeline(transaction=False)
+                pipe.get(self.session_id)
+                pipe.expire(self.session_id, self.ttl)
+                _encrypted_data, _ = pipe.execute()
+            else:
+                _encrypted_data = self.conn.get(self.session_id)
             if not _encrypted_data:
                 logger.debug('Session not found: {!r}'.format(self.session_id))
                 raise KeyError('Session not found: {!r}'.format(self.session_id))
@@ -0,0 +1,104 @@
+# -*- coding: utf-8 -*-
+"""
+Test helpers for code using the session Redis backend.
+"""
+
+import time
+import shutil
+import atexit
+import random
+import tempfile
+import subprocess
+from contextlib import contextmanager
+
+import redis
+
+from eduid_common.session.redis_io import track_redis_io
+
+
+class RedisIOAssertionsMixin(object):
+    """
+    Assertions on the Redis I/O of the code under test, for unittest.TestCase
+    subclasses.
+    """
+
+    @contextmanager
+    def assertMaxRedisRoundTrips(self, max_round_trips):
+        """
+        Assert that the code in the context does at most `max_round_trips'
+        round trips to the session Redis backend, e.g.
+
+            with self.assertMaxRedisRoundTrips(2):
+                response = client.get('/')
+
+        :param max_round_trips: Upper bound for the number of round trips
+        :type max_round_trips: int
+        """
+        with track_redis_io() as stats:
+            yield stats
+        self.assertLessEqual(stats.round_trips, max_round_trips,
+                             'Too many Redis round trips: {!s}'.format(stats))
+
+
+class RedisTemporaryInstance(object):
+    """Singleton to manage a temporary Redis instance
+
+    Use this for testing purpose only. The instance is automatically destroyed
+    at the end of the program.
+
+    """
+    _instance = None
+
+    @classmethod
+    def get_instance(cls):
+        if cls._instance is None:
+            cls._instance = cls()
+            atexit.register(cls._instance.shutdown)
+        return cls._instance
+
+    def __init__(self):
+        self._tmpdir = tempfile.mkdtemp()
+        self._port = random.randint(40000, 65535)
+        self._process = subprocess.Popen(['docker', 'run', '--rm',
+                                          '-p', '{!s}:6379'.format(self._port),
+                                          '-v', '{!s}:/data'.format(self._tmpdir),
+                                          '-e', 'extra_args=--daemonize no --bind 0.0.0.0',
+                                          'docker.sunet.se/eduid/redis:latest',
+                                          ],
+                                         stdout=open('/tmp/redis-temp.log', 'wb'),
+                                         stderr=subprocess.STDOUT)
+        for i in range(10):
+            time.sleep(0.2)
+            try:
+                self._conn = redis.Redis('localhost', self._port, 0)
+                self._conn.set('dummy', 'dummy')
+            except redis.exceptions.ConnectionError:
+                continue
+            else:
+                break
+        else:
+            self.shutdown()
+            assert False, 'Cannot connect to the redis test instance'
+
+    @property
+    def conn(self):
+        return self._conn
+
+    @property
+    def port(self):
+        return self._port
+
+    def shutdown(self):
+        if self._process:
+            self._process.terminate()
+            self._process.wait()
+            self._process = None
+        shutil.rmtree(self._tmpdir, ignore_errors=True)
+
+    def get_uri(self):
+        """
+        Convenience function to get a redis URI to the temporary database.
+
+        :return: host, port, dbname
+        """
+        return 'localhost', self.port, 0
@@ -0,0 +1,92 @@
+from unittest import TestCase
+
+from eduid_common.session.pyramid_session import SessionFactory
+from eduid_common.session.tests.test_request_session import CountingRedisConn, FakeSessionManager
+
+
+class FakeRegistry(object):
+
+    def __init__(self, settings):
+        self.settings = settings
+
+
+class FakeRequest(object):
+
+    def __init__(self, settings, cookies=None):
+        self.registry = FakeRegistry(settings)
+        self.cookies = cookies or {}
+        self.response_callbacks = []
+
+    def add_response_callback(self, callback):
+        self.response_callbacks.append(callback)
+
+    def finish(self, response):
+        for callback in self.response_callbacks:
+            callback(self, response)
+
+
+class FakeResponse(object):
+
+    def __init__(self):
+        self.cookies = {}
+
+    def set_cookie(self, name, value, **kwargs):
+        self.cookies[name] = value
+
+
+class TestPyramidSession(TestCase):
+
+    def setUp(self):
+        self.settings = {
+            'session.key': 'sessid',
+            'session.secret': 's3cr3t',
+            'session.cookie_max_age': '60',
+            'REDIS_HOST': 'localhost',
+            'REDIS_PORT': '6379',
+            'REDIS_DB': '0',
+        }
+        self.factory = SessionFactory(self.settings)
+        self.conn = CountingRedisConn()
+        self.factory.manager = FakeSessionManager(self.conn)
+        base = self.factory.manager.get_session(data={'user_eppn': 'hubba-bubba'})
+        base.commit()
+        self.token = base.token
+        self.conn.round_trips = []
+
+    def _request(self):
+        return FakeRequest(self.settings, cookies={'sessid': self.token})
+
+    def test_flash_write_once(self):
+        request = self._request()
+        session = self.factory(request)
+        session.flash('one')
+        session.flash('two')
+        session.flash('two', allow_duplicate=False)
+        session.get_csrf_token()
+        response = FakeResponse()
+        request.finish(response)
+        self.assertEqual(self.conn.round_trips, [['get', 'expire'], ['setex']])
+        self.assertEqual(response.cookies['sessid'], self.token)
+
+        session2 = self.factory(self._request())
+        self.assertEqual(session2.peek_flash(), ['one', 'two'])
+        self.assertEqual(session2.pop_flash(), ['one', 'two'])
+        self.assertEqual(session2.pop_flash(), [])
+
+    def test_not_used(self):
+        request = self._request()
+        self.factory(request)
+        response = FakeResponse()
+        request.finish(response)
+        self.assertEqual(self.conn.round_trips, [])
+        self.assertEqual(response.cookies, {})
+
+    def test_invalidate(self):
+        request = self._request()
+        session = self.factory(request)
+        session.invalidate()
+        response = FakeResponse()
+        request.finish(response)
+        self.assertEqual(response.cookies, {'sessid': None})
+        with self.assertRaises(KeyError):
+            self.factory.manager.get_session(token=self.token)
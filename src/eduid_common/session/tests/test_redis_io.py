@@ -0,0 +1,66 @@
+from unittest import TestCase
+
+from eduid_common.session import redis_io
+from eduid_common.session.redis_io import start_request_tracking, stop_request_tracking, track_redis_io
+from eduid_common.session.session import SessionManager
+from eduid_common.session.testing import RedisIOAssertionsMixin, RedisTemporaryInstance
+
+
+class TestRedisIO(TestCase):
+
+    def tearDown(self):
+        stop_request_tracking()
+
+    def test_request_tracking(self):
+        stats = start_request_tracking()
+        redis_io._record(2, 10, 20)
+        redis_io._record(1, 5, 0)
+        self.assertIs(stop_request_tracking(), stats)
+        self.assertEqual(stats.to_dict(), {'commands': 3, 'round_trips': 2, 'bytes_sent': 15, 'bytes_received': 20})
+        # Nothing is recorded when tracking has been stopped
+        redis_io._record(1, 1, 1)
+        self.assertEqual(stats.round_trips, 2)
+        self.assertIsNone(stop_request_tracking())
+
+    def test_nested_trackers(self):
+        request_stats = start_request_tracking()
+        with track_redis_io() as outer:
+            redis_io._record(1, 1, 1)
+            with track_redis_io() as inner:
+                redis_io._record(1, 1, 1)
+        redis_io._record(1, 1, 1)
+        self.assertEqual(inner.round_trips, 1)
+        self.assertEqual(outer.round_trips, 2)
+        self.assertEqual(request_stats.round_trips, 3)
+
+    def test_payload_size(self):
+        self.assertEqual(redis_io._payload_size(('SETEX', 'key', 10, b'data')), 5 + 3 + 2 + 4)
+        self.assertEqual(redis_io._payload_size([b'abc', None, True]), 3 + 0 + 4)
+
+
+class TestRedisIOAssertions(RedisIOAssertionsMixin, TestCase):
+
+    def setUp(self):
+        self.redis_instance = RedisTemporaryInstance.get_instance()
+        self.manager = SessionManager({'REDIS_HOST': 'localhost', 'REDIS_PORT': self.redis_instance.port,
+                                       'REDIS_DB': 0}, ttl=60, secret='s3cr3t')
+        session = self.manager.get_session(data={'foo': 'bar'})
+        session.commit()
+        self.token = session.token
+
+    def test_load_and_commit(self):
+        with self.assertMaxRedisRoundTrips(2) as stats:
+            session = self.manager.get_session(token=self.token, renew_ttl=True)
+            session['foo'] = 'baz'
+            session.commit()
+        # GET and EXPIRE pipelined, then SETEX
+        self.assertEqual(stats.to_dict()['round_trips'], 2)
+        self.assertEqual(stats.commands, 3)
+        self.assertGreater(stats.bytes_sent, 0)
+        self.assertGreater(stats.bytes_received, 0)
+
+    def test_too_many_round_trips(self):
+        with self.assertRaises(AssertionError):
+            with self.assertMaxRedisRoundTrips(1):
+                session = self.manager.get_session(token=self.token, renew_ttl=True)
+                session.commit()
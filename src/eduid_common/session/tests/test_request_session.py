@@ -0,0 +1,175 @@
+import binascii
+from unittest import TestCase
+
+from eduid_common.session.session import Session
+from eduid_common.session.request_session import RequestSession, ReadOnlySessionError
+from eduid_common.session.tests.test_session import FakeRedisConn, FakePipeline
+
+
+class CountingPipeline(FakePipeline):
+
+    def execute(self):
+        self.conn.round_trips.append([name for name, _args in self.commands])
+        return [getattr(self.conn.fake, name)(*args) for name, args in self.commands]
+
+
+class CountingRedisConn(object):
+    """
+    Records the commands sent to a FakeRedisConn, one list per round trip.
+    """
+
+    def __init__(self):
+        self.fake = FakeRedisConn()
+        self.round_trips = []
+
+    def pipeline(self, transaction=True):
+        return CountingPipeline(self)
+
+    def __getattr__(self, name):
+        def command(*args):
+            self.round_trips.append([name])
+            return getattr(self.fake, name)(*args)
+        return command
+
+
+class FakeSessionManager(object):
+
+    def __init__(self, conn, secret='s3cr3t', ttl=10):
+        self.conn = conn
+        self.secret = secret
+        self.ttl = ttl
+
+    def get_session(self, token=None, session_id=None, data=None, renew_ttl=False):
+        return Session(self.conn, token=token, session_id=session_id, data=data,
+                       secret=self.secret, ttl=self.ttl, renew_ttl=renew_ttl)
+
+
+class TestRequestSession(TestCase):
+
+    def setUp(self):
+        self.conn = CountingRedisConn()
+        self.manager = FakeSessionManager(self.conn)
+        base = self.manager.get_session(data={'user_eppn': 'hubba-bubba'})
+        base.commit()
+        self.token = base.token
+        self.conn.round_trips = []
+
+    def test_not_used(self):
+        session = RequestSession(self.manager, token=self.token)
+        session.commit()
+        self.assertFalse(session.loaded)
+        self.assertEqual(self.conn.round_trips, [])
+
+    def test_read(self):
+        session = RequestSession(self.manager, token=self.token)
+        self.assertEqual(session['user_eppn'], 'hubba-bubba')
+        self.assertEqual(session.get('foo'), None)
+        session.commit()
+        self.assertEqual(self.conn.round_trips, [['get', 'expire']])
+
+    def test_write_once(self):
+        session = RequestSession(self.manager, token=self.token)
+        session['foo'] = 'bar'
+        session['bar'] = 'baz'
+        del session['foo']
+        session.commit()
+        self.assertEqual(self.conn.round_trips, [['get', 'expire'], ['setex']])
+
+        session2 = RequestSession(self.manager, token=self.token)
+        self.assertEqual(dict(session2), {'user_eppn': 'hubba-bubba', 'bar': 'baz'})
+
+    def test_new_session(self):
+        session = RequestSession(self.manager)
+        session['foo'] = 'bar'
+        session.commit()
+        self.assertTrue(session.new)
+        self.assertEqual(self.conn.round_trips, [['setex']])
+
+    def test_missing_session(self):
+        self.conn.fake.delete(self.manager.get_session(token=self.token).session_id)
+        session = RequestSession(self.manager, token=self.token)
+        self.assertTrue(session.new)
+        self.assertNotEqual(session.token, self.token)
+
+    def test_mark_changed(self):
+        session = RequestSession(self.manager, token=self.token)
+        session['foo'] = {'bar': []}
+        session.commit()
+        session = RequestSession(self.manager, token=self.token)
+        session['foo']['bar'].append('baz')
+        session.mark_changed()
+        session.commit()
+        session = RequestSession(self.manager, token=self.token)
+        self.assertEqual(session['foo'], {'bar': ['baz']})
+
+    def test_invalidate(self):
+        session = RequestSession(self.manager, token=self.token)
+        session.invalidate()
+        session.commit()
+        self.assertEqual(session.token, '')
+        with self.assertRaises(KeyError):
+            self.manager.get_session(token=self.token)
+
+    def test_read_only_debug(self):
+        session = RequestSession(self.manager, token=self.token, read_only=True, debug=True)
+        with self.assertRaises(ReadOnlySessionError):
+            session['foo'] = 'bar'
+
+    def test_commit_hook(self):
+        session = RequestSession(self.manager, token=self.token)
+        calls = []
+
+        def hook():
+            calls.append(1)
+            session['foo'] = 'bar'
+
+        self.assertEqual(session['user_eppn'], 'hubba-bubba')
+        session.add_commit_hook(hook)
+        session.commit()
+        session.commit()
+        self.assertEqual(calls, [1])
+        self.assertEqual(self.conn.round_trips, [['get', 'expire'], ['setex']])
+        session = RequestSession(self.manager, token=self.token)
+        self.assertEqual(session['foo'], 'bar')
+
+    def test_sub_session(self):
+        session = RequestSession(self.manager, token=self.token)
+        sub = session.sub_session('saml2')
+        self.assertIs(session.sub_session('saml2'), sub)
+        self.assertFalse(sub.loaded)
+        sub['foo'] = 'bar'
+        session.commit()
+        self.assertEqual(self.conn.round_trips, [['get', 'expire'], ['get', 'expire'], ['setex']])
+
+        self.conn.round_trips = []
+        session = RequestSession(self.manager, token=self.token)
+        self.assertEqual(dict(session), {'user_eppn': 'hubba-bubba'})
+        session.commit()
+        # The sub session is not loaded unless used
+        self.assertEqual(self.conn.round_trips, [['get', 'expire']])
+        self.assertEqual(session.sub_session('saml2')['foo'], 'bar')
+        self.assertNotEqual(session.sub_session('saml2')._session.session_id, session._session.session_id)
+        self.assertEqual(session.sub_session('other').get('foo'), None)
+
+    def test_sub_session_unchanged(self):
+        session = RequestSession(self.manager, token=self.token)
+        self.assertEqual(session.sub_session('saml2').get('foo'), None)
+        session.commit()
+        self.assertEqual(self.conn.round_trips, [['get', 'expire'], ['get', 'expire']])
+
+    def test_invalidate_sub_sessions(self):
+        session = RequestSession(self.manager, token=self.token)
+        session.sub_session('saml2')['foo'] = 'bar'
+        session.commit()
+        sub_session_id = binascii.unhexlify(session.sub_session('saml2')._session.session_id)
+        self.manager.get_session(session_id=sub_session_id)
+
+        self.conn.round_trips = []
+        session = RequestSession(self.manager, token=self.token)
+        session.invalidate()
+        session.commit()
+        # The sub session is cleared without being loaded
+        self.assertEqual(self.conn.round_trips[0], ['get', 'expire'])
+        self.assertEqual(set(x[0] for x in self.conn.round_trips[1:]), {'delete'})
+        with self.assertRaises(KeyError):
+            self.manager.get_session(session_id=sub_session_id)
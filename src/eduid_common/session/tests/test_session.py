@@ -2,13 +2,35 @@ from unittest import TestCase
 
 import time
 
-from eduid_common.session.session import Session, derive_key
+import redis.connection
+import redis.sentinel
+
+from eduid_common.session.session import Session, derive_key, get_redis_pool
+
+class FakePipeline(object):
+
+    def __init__(self, conn):
+        self.conn = conn
+        self.commands = []
+
+    def __getattr__(self, name):
+        def queue(*args):
+            self.commands.append((name, args))
+            return self
+        return queue
+
+    def execute(self):
+        return [getattr(self.conn, name)(*args) for name, args in self.commands]
+
 
 class FakeRedisConn(object):
 
     def __init__(self):
         self._data = {}
 
+    def pipeline(self, transaction=True):
+        return FakePipeline(self)
+
     def setex(self, key, ttl, data):
         self._data[key] = {'expire': int(time.time()) + ttl,
                            'data': data,
@@ -24,6 +46,12 @@ class FakeRedisConn(object):
         if key in self._data:
             del self._data[key]
 
+    def expire(self, key, ttl):
+        if key in self._data:
+            self._data[key]['expire'] = int(time.time()) + ttl
+            return True
+        return False
+
 
 class TestSession(TestCase):
 
@@ -83,3 +111,30 @@ class TestSession(TestCase):
                           secret=secret, ttl=ttl, whitelist=whitelist,
                           raise_on_unknown=raise_on_unknown)
         return session
+
+
+class TestGetRedisPool(TestCase):
+
+    def test_tcp(self):
+        pool = get_redis_pool({'REDIS_HOST': 'localhost', 'REDIS_PORT': 6379, 'REDIS_DB': 0})
+        self.assertIs(pool.connection_class, redis.connection.Connection)
+        self.assertEqual(pool.connection_kwargs['host'], 'localhost')
+
+    def test_unix_socket(self):
+        pool = get_redis_pool({'REDIS_SOCKET_PATH': '/var/run/redis/redis.sock', 'REDIS_DB': 1})
+        self.assertIs(pool.connection_class, redis.connection.UnixDomainSocketConnection)
+        self.assertEqual(pool.connection_kwargs['path'], '/var/run/redis/redis.sock')
+        self.assertEqual(pool.connection_kwargs['db'], 1)
+
+    def test_ssl(self):
+        pool = get_redis_pool({'REDIS_HOST': 'redis.example.com', 'REDIS_PORT': 6380, 'REDIS_DB': 0,
+                               'REDIS_SSL': True, 'REDIS_SSL_CA_CERTS': '/etc/ssl/ca.pem'})
+        self.assertTrue(issubclass(pool.connection_class, redis.connection.SSLConnection))
+        self.assertEqual(pool.connection_kwargs['ssl_ca_certs'], '/etc/ssl/ca.pem')
+        self.assertEqual(pool.connection_kwargs['ssl_cert_reqs'], 'required')
+
+    def test_sentinel_ssl(self):
+        pool = get_redis_pool({'REDIS_SENTINEL_HOSTS': ['sentinel1', 'sentinel2'], 'REDIS_PORT': 26379,
+                               'REDIS_SENTINEL_SERVICE_NAME': 'redis-cluster', 'REDIS_SSL': True})
+        self.assertTrue(issubclass(pool.connection_class, redis.connection.SSLConnection))
+        self.assertTrue(issubclass(pool.connection_class, redis.sentinel.SentinelManagedConnection))
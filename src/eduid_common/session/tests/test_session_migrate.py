@@ -0,0 +1,96 @@
+import os
+import imp
+import json
+import shutil
+import tempfile
+from unittest import TestCase
+
+import redis
+
+from eduid_common.session.testing import RedisTemporaryInstance
+
+# The scripts are not a package
+session_migrate = imp.load_source(
+    'session_migrate', os.path.join(os.path.dirname(__file__), '..', 'scripts', 'session_migrate.py'))
+
+
+class TestSessionMigrate(TestCase):
+
+    def setUp(self):
+        self.redis_instance = RedisTemporaryInstance.get_instance()
+        self.source = redis.StrictRedis('localhost', self.redis_instance.port, 1)
+        self.target = redis.StrictRedis('localhost', self.redis_instance.port, 2)
+        self.source.flushdb()
+        self.target.flushdb()
+        self.tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmpdir)
+        self.state_file = os.path.join(self.tmpdir, 'session_migrate.state')
+
+    def _migrate(self, **kwargs):
+        return session_migrate.migrate(self.source, self.target, state_file=self.state_file,
+                                       report_interval=3600, **kwargs)
+
+    def test_copy_preserves_ttl(self):
+        for mode in ['dump', 'get']:
+            self.target.flushdb()
+            self.source.setex('with_ttl', 1000, 'data1')
+            self.source.set('without_ttl', 'data2')
+            self.assertEqual(self._migrate(mode=mode), (2, 2))
+            self.assertEqual(self.target.get('with_ttl'), b'data1')
+            self.assertEqual(self.target.get('without_ttl'), b'data2')
+            self.assertTrue(990 < self.target.ttl('with_ttl') <= 1000)
+            self.assertEqual(self.target.ttl('without_ttl'), -1)
+            self.assertFalse(os.path.exists(self.state_file))
+
+    def test_skip_existing(self):
+        self.source.setex('existing', 1000, 'new')
+        self.source.setex('missing', 1000, 'new')
+        for mode in ['dump', 'get']:
+            self.target.flushdb()
+            self.target.set('existing', 'old')
+            self.assertEqual(self._migrate(mode=mode, replace=False), (2, 1))
+            self.assertEqual(self.target.get('existing'), b'old')
+            self.assertEqual(self.target.get('missing'), b'new')
+
+            self.assertEqual(self._migrate(mode=mode, replace=True), (2, 2))
+            self.assertEqual(self.target.get('existing'), b'new')
+
+    def test_resume(self):
+        for i in range(1000):
+            self.source.set('key{!s}'.format(i), 'value')
+        cursor, first_keys = self.source.scan(cursor=0, count=10)
+        self.assertNotEqual(int(cursor), 0)
+        identity = {'source': session_migrate.redis_identity(self.source),
+                    'target': session_migrate.redis_identity(self.target),
+                    'match': '*',
+                    }
+        session_migrate.save_cursor(self.state_file, identity, int(cursor))
+
+        scanned, written = self._migrate(batch_size=10)
+        self.assertEqual(written, 1000 - len(first_keys))
+        # The keys handled before the interruption are not copied again
+        for key in first_keys:
+            self.assertFalse(self.target.exists(key))
+        self.assertEqual(self.target.dbsize(), 1000 - len(first_keys))
+        self.assertFalse(os.path.exists(self.state_file))
+
+    def test_state_of_other_migration(self):
+        self.source.set('key', 'value')
+        other = redis.StrictRedis('localhost', self.redis_instance.port, 3)
+        identity = {'source': session_migrate.redis_identity(other),
+                    'target': session_migrate.redis_identity(self.target),
+                    'match': '*',
+                    }
+        session_migrate.save_cursor(self.state_file, identity, 1234)
+        with self.assertRaises(session_migrate.StateMismatch):
+            self._migrate()
+        # The state file is kept, and nothing is copied
+        with open(self.state_file) as f:
+            self.assertEqual(json.load(f)['cursor'], 1234)
+        self.assertEqual(self.target.dbsize(), 0)
+
+    def test_old_state_file(self):
+        with open(self.state_file, 'w') as f:
+            f.write('1234\n')
+        with self.assertRaises(session_migrate.StateMismatch):
+            self._migrate()
@@ -31,6 +31,18 @@ class NoOpStats(object):
                 name = '{!s}.{!s}'.format(self.prefix, name)
             self.logger.info('No-op stats count: {!r} {!r}'.format(name, value))
 
+    def timing(self, name, value):
+        if self.logger:
+            if self.prefix:
+                name = '{!s}.{!s}'.format(self.prefix, name)
+            self.logger.info('No-op stats timing: {!r} {!r}'.format(name, value))
+
+    def gauge(self, name, value):
+        if self.logger:
+            if self.prefix:
+                name = '{!s}.{!s}'.format(self.prefix, name)
+            self.logger.info('No-op stats gauge: {!r} {!r}'.format(name, value))
+
 
 class Statsd(object):
 
@@ -44,3 +56,12 @@ class Statsd(object):
         # for .count
         self.client.incr('{}.count'.format(name), count=value)
 
+    def timing(self, name, value):
+        """
+        :param value: Duration in milliseconds
+        """
+        self.client.timing(name, value)
+
+    def gauge(self, name, value):
+        self.client.gauge(name, value)
+